@@ -10,7 +10,8 @@ import sys
 import timeit
 from StringIO import StringIO
 from genshi.builder import tag
-from genshi.template import MarkupTemplate, NewTextTemplate
+from genshi.template import CompiledMarkupTemplate, MarkupTemplate, \
+                            NewTextTemplate
 
 try:
     from elementtree import ElementTree as et
@@ -48,13 +49,17 @@ except ImportError:
 table = [dict(a=1,b=2,c=3,d=4,e=5,f=6,g=7,h=8,i=9,j=10)
           for x in range(1000)]
 
-genshi_tmpl = MarkupTemplate("""
+genshi_source = """
 <table xmlns:py="http://genshi.edgewall.org/">
 <tr py:for="row in table">
 <td py:for="c in row.values()" py:content="c"/>
 </tr>
 </table>
-""")
+"""
+
+genshi_tmpl = MarkupTemplate(genshi_source)
+
+genshi_compiled_tmpl = CompiledMarkupTemplate(genshi_source)
 
 genshi_tmpl2 = MarkupTemplate("""
 <table xmlns:py="http://genshi.edgewall.org/">$table</table>
@@ -103,6 +108,11 @@ def test_genshi():
     stream = genshi_tmpl.generate(table=table)
     stream.render('html', strip_whitespace=False)
 
+def test_genshi_compiled():
+    """Genshi compiled template"""
+    stream = genshi_compiled_tmpl.generate(table=table)
+    stream.render('html', strip_whitespace=False)
+
 def test_genshi_text():
     """Genshi text template"""
     stream = genshi_text_tmpl.generate(table=table)
@@ -195,10 +205,29 @@ if neo_cgi:
         cs.render()
 
 
-def run(which=None, number=10):
-    tests = ['test_builder', 'test_genshi', 'test_genshi_text',
-             'test_genshi_builder', 'test_mako', 'test_kid', 'test_kid_et',
-             'test_et', 'test_cet', 'test_clearsilver', 'test_django']
+def count_evaluations(test):
+    """Run the given test once, and return the number of calls to `eval()` made
+    by Genshi and the number of globals dictionaries that were allocated for
+    them."""
+    from genshi.template import eval as evalmod
+    dicts = {}
+    calls = [0]
+    def _eval(code, _globals, _locals):
+        calls[0] += 1
+        dicts[id(_globals)] = _globals # keep it alive so the id is not reused
+        return eval(code, _globals, _locals)
+    evalmod.eval = _eval
+    try:
+        getattr(sys.modules[__name__], test)()
+    finally:
+        del evalmod.eval
+    return calls[0], len(dicts)
+
+def run(which=None, number=10, allocations=False):
+    tests = ['test_builder', 'test_genshi', 'test_genshi_compiled',
+             'test_genshi_text', 'test_genshi_builder', 'test_mako',
+             'test_kid', 'test_kid_et', 'test_et', 'test_cet',
+             'test_clearsilver', 'test_django']
 
     if which:
         tests = filter(lambda n: n[5:] in which, tests)
@@ -212,7 +241,13 @@ def run(which=None, number=10):
             result = '   (not installed?)'
         else:
             result = '%16.2f ms' % (1000 * time)
-        print '%-35s %s' % (getattr(sys.modules[__name__], test).__doc__, result)
+        if allocations:
+            calls, dicts = count_evaluations(test)
+            if calls:
+                result += '  (%d evaluations, %d globals dicts)' % (calls,
+                                                                   dicts)
+        doc = getattr(sys.modules[__name__], test).__doc__
+        print '%-35s %s' % (doc, result)
 
 
 if __name__ == '__main__':
@@ -230,4 +265,4 @@ if __name__ == '__main__':
             stats.print_callees()
             stats.print_callers()
     else:
-        run(which)
+        run(which, allocations='-a' in sys.argv)
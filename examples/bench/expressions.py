@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+# Template expression benchmarks
+#
+# Objective: Measure the per-expression cost of evaluating simple variable
+# lookups and attribute chains, comparing the direct lookup used by
+# `Expression.evaluate()` with evaluation of the compiled code
+
+import sys
+import timeit
+
+from genshi.template.base import Context
+from genshi.template.eval import Expression
+
+__all__ = ['name', 'attr', 'attr_chain', 'item', 'arithmetic']
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+DATA = {
+    'name': 'joe',
+    'obj': Row(attr='value'),
+    'row': Row(a=Row(b=42)),
+    'items': {'key': 'value'},
+    'num': 21
+}
+
+EXPRESSIONS = {
+    'name': 'name',
+    'attr': 'obj.attr',
+    'attr_chain': 'row.a.b',
+    'item': 'items.key',
+    'arithmetic': 'num * 2'
+}
+
+
+def run(names, number=100000, lookup='strict'):
+    ctxt = Context(**DATA)
+    for name in names:
+        expr = Expression(EXPRESSIONS[name], lookup=lookup)
+        def evaluate():
+            return expr.evaluate(ctxt)
+        def evaluate_code():
+            return eval(expr.code, expr._globals(ctxt), {'__data__': ctxt})
+        assert evaluate() == evaluate_code()
+        direct = timeit.Timer(evaluate).timeit(number=number) / number
+        code = timeit.Timer(evaluate_code).timeit(number=number) / number
+        print '%-12s %-12r  evaluate: %6.3f us  compiled code: %6.3f us' % (
+            name, EXPRESSIONS[name], direct * 1000000, code * 1000000)
+
+
+if __name__ == '__main__':
+    names = [arg for arg in sys.argv[1:] if arg[0] != '-']
+    if not names:
+        names = __all__
+    lookup = '-l' in sys.argv and 'lenient' or 'strict'
+    run(names, lookup=lookup)
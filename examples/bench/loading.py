@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+# Template loading benchmarks
+#
+# Objective: Measure how long threads wait for cached templates while other
+# threads are loading templates, with per-template locking in the loader
+# compared to a single lock held for the whole load
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from genshi.template import TemplateLoader
+
+
+class SerialLoader(TemplateLoader):
+    """Loader that holds one lock for every load, including cache hits."""
+
+    def __init__(self, *args, **kwargs):
+        TemplateLoader.__init__(self, *args, **kwargs)
+        self._serial_lock = threading.RLock()
+
+    def load(self, *args, **kwargs):
+        self._serial_lock.acquire()
+        try:
+            return TemplateLoader.load(self, *args, **kwargs)
+        finally:
+            self._serial_lock.release()
+
+
+def write_templates(dirname, count, rows=200):
+    """Write `count` templates of about `rows` dynamic table rows each."""
+    for num in range(count):
+        source = ['<table xmlns:py="http://genshi.edgewall.org/">']
+        for row in range(rows):
+            source.append('<tr py:if="show%d"><td py:for="x in items">'
+                          '${x.name} ${x.value * %d}</td></tr>' % (row, row))
+        source.append('</table>')
+        fileobj = open(os.path.join(dirname, 'tmpl%d.html' % num), 'w')
+        try:
+            fileobj.write('\n'.join(source))
+        finally:
+            fileobj.close()
+
+
+def run_threads(loader, names, threads):
+    """Load the given templates in the given number of threads, while another
+    thread keeps loading a cached template; return the total time for the
+    loads and the slowest cache hit."""
+    loader.load('tmpl0.html')
+    done = []
+    waits = []
+
+    def hits():
+        while not done:
+            start = time.time()
+            loader.load('tmpl0.html')
+            waits.append(time.time() - start)
+            time.sleep(0.001)
+
+    def loads(names):
+        for name in names:
+            loader.load(name)
+
+    workers = [threading.Thread(target=loads, args=[names[idx::threads]])
+               for idx in range(threads)]
+    reader = threading.Thread(target=hits)
+    reader.start()
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    total = time.time() - start
+    done.append(True)
+    reader.join()
+    return total, max(waits)
+
+
+def run(count=20, threads=4):
+    dirname = tempfile.mkdtemp(suffix='genshi_bench')
+    try:
+        write_templates(dirname, count + 1)
+        names = ['tmpl%d.html' % num for num in range(1, count + 1)]
+        print 'Loading %d templates in %d threads:' % (count, threads)
+        for label, cls in [('single lock', SerialLoader),
+                           ('per-template locks', TemplateLoader)]:
+            loader = cls([dirname], max_cache_size=count + 1)
+            total, wait = run_threads(loader, names, threads)
+            print '  %-20s %8.2f ms total, cache hits waited up to %8.2f ms' % (
+                  label, total * 1000, wait * 1000)
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    run(*args)
@@ -0,0 +1,72 @@
+# -*- encoding: utf-8 -*-
+# Markup escaping benchmarks
+#
+# Objective: Compare the `Markup` class of the `genshi._speedups` C extension
+# with the pure-Python implementation in `genshi.core`, for the operations
+# used when rendering templates
+
+import imp
+import sys
+import timeit
+
+import genshi
+from genshi import core
+
+__all__ = ['escape_plain', 'escape_special', 'escape_unicode', 'escape_markup',
+           'join', 'unescape', 'format', 'add']
+
+TEXT = u'The quick brown fox jumps over the lazy dog. ' * 4
+SPECIAL = u'<a href="/search?q=fox&lang=en">"Fox" & <b>dog</b></a> ' * 4
+UNICODE = u'Der schnelle braune Fuchs & der faule Hund – “ok”. ' * 4
+
+OPERATIONS = {
+    'escape_plain': lambda Markup: Markup.escape(TEXT),
+    'escape_special': lambda Markup: Markup.escape(SPECIAL),
+    'escape_unicode': lambda Markup: Markup.escape(UNICODE),
+    'escape_markup': lambda Markup: Markup.escape(Markup(TEXT)),
+    'join': lambda Markup: Markup(u'<br/>').join([TEXT, SPECIAL, TEXT]),
+    'unescape': lambda Markup: Markup(SPECIAL).unescape(),
+    'format': lambda Markup: Markup(u'<p>%s</p>') % SPECIAL,
+    'add': lambda Markup: Markup(u'<p>') + SPECIAL
+}
+
+
+def python_markup():
+    """Return the `Markup` class of a copy of `genshi.core` that does not use
+    the C extension."""
+    speedups = sys.modules.get('genshi._speedups')
+    sys.modules['genshi._speedups'] = None # make the import fail
+    try:
+        fileobj, pathname, description = imp.find_module('core',
+                                                         genshi.__path__)
+        try:
+            return imp.load_module('_core', fileobj, pathname,
+                                   description).Markup
+        finally:
+            fileobj.close()
+    finally:
+        if speedups is None:
+            del sys.modules['genshi._speedups']
+        else:
+            sys.modules['genshi._speedups'] = speedups
+
+
+def run(names, number=100000):
+    pure = python_markup()
+    if core.Markup is pure or core.Markup.__module__ != 'genshi._speedups':
+        print 'The genshi._speedups extension is not available'
+        return
+    for name in names:
+        operation = OPERATIONS[name]
+        assert unicode(operation(core.Markup)) == unicode(operation(pure))
+        python = timeit.Timer(lambda: operation(pure)).timeit(number=number)
+        c = timeit.Timer(lambda: operation(core.Markup)).timeit(number=number)
+        print '%-16s python: %7.3f us  C: %7.3f us  (%4.1fx)' % (
+            name, python / number * 1000000, c / number * 1000000, python / c)
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    if not names:
+        names = __all__
+    run(names)
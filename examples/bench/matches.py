@@ -0,0 +1,46 @@
+# -*- encoding: utf-8 -*-
+# Template language benchmarks
+#
+# Objective: Measure the cost of match templates on a page with many of them,
+# as found in layout templates
+
+import sys
+import timeit
+
+from genshi.template import MarkupTemplate
+
+def match_template(rules, generic=0):
+    """Return a template defining the given number of match templates for
+    elements with distinct names, of which `generic` use paths that are not
+    restricted to a single element name, followed by a table of 1000 cells."""
+    source = ['<html xmlns:py="http://genshi.edgewall.org/">']
+    for num in range(rules - generic):
+        source.append('<py:match path="widget%d">'
+                      '<div class="widget">${select("*")}</div>'
+                      '</py:match>' % num)
+    for num in range(generic):
+        source.append('<py:match path="body/section%d">'
+                      '<div class="section">${select("*")}</div>'
+                      '</py:match>' % num)
+    source.append('<py:match path="body" once="true"><body>'
+                  '<widget0><p>Header</p></widget0>${select("*")}'
+                  '</body></py:match>')
+    source.append('<body><table><tr py:for="row in table">'
+                  '<td py:for="cell in row">$cell</td></tr></table></body>')
+    source.append('</html>')
+    return MarkupTemplate(''.join(source))
+
+def run(rules, number=10):
+    table = [range(10) for row in range(100)]
+    for generic in (0, 5, rules):
+        tmpl = match_template(rules, generic)
+        def render():
+            return tmpl.generate(table=table).render('xhtml')
+        time = timeit.Timer(render).timeit(number=number) / number
+        print '%3d match templates (%2d with generic paths): %8.2f ms' % (
+              rules + 1, generic, time * 1000)
+
+
+if __name__ == '__main__':
+    rules = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    run(rules and rules[0] or 49)
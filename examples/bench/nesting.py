@@ -0,0 +1,56 @@
+# -*- encoding: utf-8 -*-
+# Template language benchmarks
+#
+# Objective: Measure how rendering and variable lookups scale with the depth
+# of the context stack, using nested loops and function calls
+
+import sys
+import timeit
+
+from genshi.template import MarkupTemplate
+from genshi.template.base import Context
+
+def nested_template(depth):
+    """Return a template that nests `depth` levels of loops, each of them
+    calling a function defined in the template."""
+    source = ['<div xmlns:py="http://genshi.edgewall.org/">',
+              '<py:def function="cell(value)"><b>${title}: $value</b></py:def>']
+    for level in range(depth):
+        source.append('<div py:for="v%d in items">' % level)
+    source.append('${cell(v%d)}' % (depth - 1))
+    source.extend(['</div>'] * depth)
+    source.append('</div>')
+    return MarkupTemplate(''.join(source))
+
+def render_nested(depth, number=20):
+    tmpl = nested_template(depth)
+    def render():
+        # Keep the total number of cells constant across depths
+        items = range(int(round(1000 ** (1.0 / depth))))
+        return tmpl.generate(title='Title', items=items).render('xhtml')
+    return timeit.Timer(render).timeit(number=number) / number
+
+def lookup(depth, number=100000):
+    ctxt = Context(title='Title')
+    for level in range(depth):
+        ctxt.push({'v%d' % level: level})
+    def get():
+        return ctxt.get('title')
+    return timeit.Timer(get).timeit(number=number) / number
+
+def run(depths):
+    print 'Rendering about 1000 cells in nested loops:'
+    for depth in depths:
+        print '  depth %3d: %8.2f ms' % (depth, render_nested(depth) * 1000)
+    print
+    print 'Looking up a variable from the bottom scope:'
+    for depth in depths:
+        print '  %3d scopes: %6.3f us' % (depth * 2 + 1,
+                                          lookup(depth * 2) * 1000000)
+
+
+if __name__ == '__main__':
+    depths = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    if not depths:
+        depths = [1, 2, 3, 5, 10]
+    run(depths)
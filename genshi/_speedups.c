@@ -56,6 +56,155 @@ PyDoc_STRVAR(Markup__doc__,
 "Marks a string as being safe for inclusion in HTML/XML output without\n\
 needing to be escaped.");
 
+#if PY_VERSION_HEX >= 0x03030000
+/* Use the flexible string representation of PEP 393 */
+#   define PEP393
+#endif
+
+#ifdef PEP393
+
+/* Count the characters in `data` that need to be replaced in `inn`, and add
+   the additional length of the replacements to `len` */
+#define COUNT_SPECIAL(type)                                                   \
+    {                                                                         \
+        type *p = (type *) data, *end = p + length;                           \
+        for (; p < end; p++) {                                                \
+            switch (*p) {                                                     \
+                case '&': len += 4; inn++;                             break; \
+                case '"': if (quotes) { len += 4; inn++; }             break; \
+                case '<':                                                     \
+                case '>': len += 3; inn++;                             break; \
+            }                                                                 \
+        }                                                                     \
+    }
+
+/* Copy `data` to `outdata`, replacing the `inn` special characters, and
+   copying the runs of characters between them as a whole */
+#define REPLACE_SPECIAL(type)                                                 \
+    {                                                                         \
+        type *p = (type *) data, *end = p + length, *start = p;               \
+        type *outp = (type *) outdata;                                        \
+        for (; inn && p < end; p++) {                                         \
+            switch (*p) {                                                     \
+                case '&': repl = "&amp;"; replen = 5;                  break; \
+                case '"':                                                     \
+                    if (!quotes) {                                            \
+                        continue;                                             \
+                    }                                                         \
+                    repl = "&#34;"; replen = 5;                        break; \
+                case '<': repl = "&lt;"; replen = 4;                   break; \
+                case '>': repl = "&gt;"; replen = 4;                   break; \
+                default:  continue;                                           \
+            }                                                                 \
+            memcpy(outp, start, (p - start) * sizeof(type));                  \
+            outp += p - start;                                                \
+            for (j = 0; j < replen; j++) {                                    \
+                *outp++ = repl[j];                                            \
+            }                                                                 \
+            start = p + 1;                                                    \
+            inn--;                                                            \
+        }                                                                     \
+        /* copy rest of string once we have replaced everything */            \
+        memcpy(outp, start, (end - start) * sizeof(type));                    \
+    }
+
+static PyObject *
+to_markup(PyObject *text)
+{
+    PyObject *args, *ret;
+
+    args = PyTuple_New(1);
+    if (args == NULL) {
+        Py_DECREF(text);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(args, 0, text);
+    ret = MarkupType.tp_new(&MarkupType, args, NULL);
+    Py_DECREF(args);
+    return ret;
+}
+
+static PyObject *
+escape(PyObject *text, int quotes)
+{
+    PyObject *in, *out;
+    int kind;
+    void *data, *outdata;
+    const char *repl;
+    Py_ssize_t length, len, inn, j, replen;
+
+    if (PyUnicode_CheckExact(text)) {
+        /* Plain strings have no __html__ method, and need no conversion */
+        Py_INCREF(text);
+        in = text;
+    } else {
+        if (PyObject_TypeCheck(text, &MarkupType)) {
+            Py_INCREF(text);
+            return text;
+        }
+        if (PyObject_HasAttrString(text, "__html__")) {
+            out = PyObject_CallMethod(text, "__html__", NULL);
+            if (out == NULL) {
+                return NULL;
+            }
+            return to_markup(out);
+        }
+        in = PyObject_Str(text);
+        if (in == NULL) {
+            return NULL;
+        }
+    }
+#if PY_VERSION_HEX < 0x030C0000
+    if (PyUnicode_READY(in) < 0) {
+        Py_DECREF(in);
+        return NULL;
+    }
+#endif
+    kind = PyUnicode_KIND(in);
+    data = PyUnicode_DATA(in);
+    length = PyUnicode_GET_LENGTH(in);
+
+    /* First we need to figure out how many characters need to be replaced,
+       and how long the escaped string will be */
+    inn = 0;
+    len = length;
+    switch (kind) {
+        case PyUnicode_1BYTE_KIND:
+            COUNT_SPECIAL(Py_UCS1);                                    break;
+        case PyUnicode_2BYTE_KIND:
+            COUNT_SPECIAL(Py_UCS2);                                    break;
+        default:
+            COUNT_SPECIAL(Py_UCS4);
+    }
+
+    /* Do we need to escape anything at all? */
+    if (!inn) {
+        return to_markup(in);
+    }
+
+    /* The replacements are ASCII, so the output uses the same kind */
+    out = PyUnicode_New(len, PyUnicode_MAX_CHAR_VALUE(in));
+    if (out == NULL) {
+        Py_DECREF(in);
+        return NULL;
+    }
+    outdata = PyUnicode_DATA(out);
+
+    switch (kind) {
+        case PyUnicode_1BYTE_KIND:
+            REPLACE_SPECIAL(Py_UCS1);                                  break;
+        case PyUnicode_2BYTE_KIND:
+            REPLACE_SPECIAL(Py_UCS2);                                  break;
+        default:
+            REPLACE_SPECIAL(Py_UCS4);
+    }
+
+    Py_DECREF(in);
+    return to_markup(out);
+}
+
+#else
+
 static PyObject *
 escape(PyObject *text, int quotes)
 {
@@ -169,6 +318,8 @@ escape(PyObject *text, int quotes)
     return ret;
 }
 
+#endif /* PEP393 */
+
 PyDoc_STRVAR(escape__doc__,
 "Create a Markup instance from a string and escape special characters\n\
 it may contain (<, >, & and \").\n\
@@ -258,13 +409,14 @@ Markup_join(PyObject *self, PyObject *args, PyObject *kwds)
     }
     while ((tmp = PyIter_Next(it))) {
         tmp2 = escape(tmp, quotes);
-        if (tmp2 == NULL) {
+        Py_DECREF(tmp);
+        if (tmp2 == NULL || PyList_Append(seq2, tmp2) < 0) {
+            Py_XDECREF(tmp2);
             Py_DECREF(seq2);
             Py_DECREF(it);
             return NULL;
         }
-        PyList_Append(seq2, tmp2);
-        Py_DECREF(tmp);
+        Py_DECREF(tmp2);
     }
     Py_DECREF(it);
     if (PyErr_Occurred()) {
@@ -662,7 +814,7 @@ struct PyModuleDef module_def = {
     NULL                   /*m_free*/
 };
 
-PyObject *
+PyMODINIT_FUNC
 PyInit__speedups(void)
 #else
 PyMODINIT_FUNC
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Benchmarks for the separate phases of processing templates and streams.
+
+Unlike the benchmarks in ``examples/bench``, which mostly measure rendering a
+template as a whole, this suite times every phase on its own: loading
+templates with a new loader, parsing, preparing, generating the event stream,
+serializing it with each of the serializers, writing the output to a file
+token by token and in batches, XPath selection, transformations and
+translation. For every phase, the time per run, the number of events
+processed per second, and the peak memory used by a run are reported::
+
+  python -m genshi.bench
+
+The results can be written to a JSON file, and compared with the results of
+an earlier run, in which case phases that became slower by more than a given
+tolerance are reported, and make the tool exit with a non-zero status::
+
+  python -m genshi.bench -o baseline.json
+  python -m genshi.bench -b baseline.json
+
+The peak memory is measured using ``tracemalloc`` where available, and
+otherwise as the growth of the maximum resident set size of a child process
+running the phase once, so the figures are only comparable between runs on
+the same Python version and platform.
+"""
+
+from optparse import OptionParser
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer as timer
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from genshi import __version__
+from genshi.core import Stream
+from genshi.filters.i18n import Translator
+from genshi.filters.transform import Transformer
+from genshi.input import XML
+from genshi.output import BUFFER_SIZE, encode, get_serializer
+from genshi.template.loader import TemplateLoader, event_count
+from genshi.template.markup import MarkupTemplate
+
+__all__ = ['PHASES', 'compare', 'main', 'run']
+__docformat__ = 'restructuredtext en'
+
+
+PAGE = """<html xmlns:py="http://genshi.edgewall.org/">
+  <head><title>$title</title></head>
+  <body>
+    <h1 class="title">$title</h1>
+    <ul>
+      <li py:for="item in items" class="${item['kind']}">${item['name']}</li>
+    </ul>
+    <table>
+      <tr py:for="row in table">
+        <td py:for="cell in row" py:content="cell" class="cell"/>
+      </tr>
+    </table>
+    <p py:if="footer" class="footer">Generated by <em>Genshi</em></p>
+  </body>
+</html>"""
+
+LAYOUT = """<html xmlns:py="http://genshi.edgewall.org/" py:strip="">
+  <py:match path="body" once="true"><body>
+    <div id="header"><h1>Benchmark</h1></div>
+    ${select('*|text()')}
+    <div id="footer">Genshi $version</div>
+  </body></py:match>
+</html>"""
+
+I18N_PAGE = """<html xmlns:py="http://genshi.edgewall.org/"
+      xmlns:i18n="http://genshi.edgewall.org/i18n">
+  <body>
+    <h1>Welcome</h1>
+    <p py:for="row in table" i18n:msg="num">Row ${row[0]} of the table</p>
+    <table>
+      <tr py:for="row in table">
+        <td title="Label">Value</td><td py:for="cell in row">$cell</td>
+      </tr>
+    </table>
+  </body>
+</html>"""
+
+TRANSLATIONS = {
+    'Welcome': 'Willkommen',
+    'Row %(num)s of the table': 'Zeile %(num)s der Tabelle',
+    'Label': 'Bezeichnung',
+    'Value': 'Wert'
+}
+
+
+def _data(rows):
+    return {
+        'title': 'Genshi benchmark', 'footer': True, 'version': __version__,
+        'items': [{'kind': idx % 2 and 'odd' or 'even', 'name': 'Item %d' % idx}
+                  for idx in range(rows)],
+        'table': [range(idx, idx + 10) for idx in range(rows)]
+    }
+
+
+def _timed(func, *args):
+    """Return a benchmark function calling the given function with the given
+    arguments the given number of times."""
+    def bench(number):
+        start = timer()
+        for idx in xrange(number):
+            func(*args)
+        return timer() - start
+    return bench
+
+
+def _consume(stream):
+    for event in stream:
+        pass
+
+
+def loader_cold(rows):
+    """Load 20 templates including a layout with a new template loader."""
+    dirname = tempfile.mkdtemp(suffix='genshi_bench')
+    names = []
+    for idx in range(20):
+        names.append('page%d.html' % idx)
+        fileobj = open(os.path.join(dirname, names[-1]), 'w')
+        try:
+            fileobj.write(PAGE.replace('<head>', '<xi:include href="layout.html"'
+                ' xmlns:xi="http://www.w3.org/2001/XInclude" /><head>'))
+        finally:
+            fileobj.close()
+    fileobj = open(os.path.join(dirname, 'layout.html'), 'w')
+    try:
+        fileobj.write(LAYOUT)
+    finally:
+        fileobj.close()
+
+    def load():
+        loader = TemplateLoader([dirname], max_cache_size=len(names) + 1)
+        return [loader.load(name) for name in names]
+    events = sum([event_count(tmpl) for tmpl in load()])
+    return _timed(load), events, lambda: shutil.rmtree(dirname)
+
+
+def parse(rows):
+    """Parse a template, without preparing it."""
+    return _timed(MarkupTemplate, PAGE), len(MarkupTemplate(PAGE)._stream)
+
+
+def prepare(rows):
+    """Prepare a parsed template for rendering."""
+    def bench(number):
+        templates = [MarkupTemplate(PAGE) for idx in xrange(number)]
+        start = timer()
+        for tmpl in templates:
+            tmpl.stream
+        return timer() - start
+    return bench, event_count(MarkupTemplate(PAGE))
+
+
+def generate(rows):
+    """Generate the event stream of a prepared template."""
+    tmpl = MarkupTemplate(PAGE)
+    data = _data(rows)
+    def func():
+        _consume(tmpl.generate(**data))
+    return _timed(func), len(list(tmpl.generate(**data)))
+
+
+def _serialize(method):
+    def phase(rows):
+        events = list(MarkupTemplate(PAGE).generate(**_data(rows)))
+        serializer = get_serializer(method)
+        def func():
+            ''.join(serializer(iter(events)))
+        return _timed(func), len(events)
+    phase.__name__ = 'serialize_%s' % method
+    phase.__doc__ = 'Serialize a generated event stream as %s.' % \
+                    method.upper()
+    return phase
+
+serialize_xml = _serialize('xml')
+serialize_xhtml = _serialize('xhtml')
+serialize_html = _serialize('html')
+serialize_text = _serialize('text')
+
+
+def _write(buffer_size):
+    def phase(rows):
+        events = list(MarkupTemplate(PAGE).generate(**_data(rows)))
+        serializer = get_serializer('html')
+        out = open(os.devnull, 'wb', 0)
+        def func():
+            encode(serializer(iter(events)), 'html', 'utf-8', out,
+                   buffer_size=buffer_size)
+        return _timed(func), len(events), out.close
+    return phase
+
+write_unbuffered = _write(0)
+write_unbuffered.__name__ = 'write_unbuffered'
+write_unbuffered.__doc__ = """Serialize a generated event stream as HTML and
+write it to an unbuffered file, one string per token."""
+
+write_buffered = _write(BUFFER_SIZE)
+write_buffered.__name__ = 'write_buffered'
+write_buffered.__doc__ = """Serialize a generated event stream as HTML and
+write it to an unbuffered file in batches of `BUFFER_SIZE` characters."""
+
+
+def xpath(rows):
+    """Select the table cells of a parsed document using XPath."""
+    html = MarkupTemplate(PAGE).generate(**_data(rows)).render('xml')
+    events = list(XML(html))
+    def func():
+        _consume(Stream(events).select('//td[@class="cell"]'))
+    return _timed(func), len(events)
+
+
+def transformer(rows):
+    """Add an attribute to the table rows of a parsed document using a
+    `Transformer`."""
+    html = MarkupTemplate(PAGE).generate(**_data(rows)).render('xml')
+    events = list(XML(html))
+    transform = Transformer('.//tr').attr('class', 'row')
+    def func():
+        _consume(Stream(events) | transform)
+    return _timed(func), len(events)
+
+
+def i18n(rows):
+    """Generate the event stream of a template translated by a
+    `Translator`."""
+    tmpl = MarkupTemplate(I18N_PAGE)
+    Translator(lambda msgid: TRANSLATIONS.get(msgid, msgid)).setup(tmpl)
+    data = _data(rows)
+    def func():
+        _consume(tmpl.generate(**data))
+    return _timed(func), len(list(tmpl.generate(**data)))
+
+
+PHASES = [loader_cold, parse, prepare, generate, serialize_xml,
+          serialize_xhtml, serialize_html, serialize_text, write_unbuffered,
+          write_buffered, xpath, transformer, i18n]
+"""The benchmarked phases, as functions that take the number of rows of the
+benchmark data and return a benchmark function, which runs the phase a given
+number of times and returns the time taken, and the number of events
+processed per run, optionally followed by a clean-up function."""
+
+
+def _measure(bench, repeat=3, min_time=0.2):
+    number = 1
+    while 1:
+        elapsed = bench(number)
+        if elapsed >= min_time or number >= 1000000:
+            break
+        if elapsed > 0:
+            number = max(number * 2, int(number * min_time * 1.2 / elapsed))
+        else:
+            number *= 10
+    best = elapsed / number
+    for idx in range(repeat - 1):
+        best = min(best, bench(number) / number)
+    return best
+
+
+def _peak_memory(bench):
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            bench(1)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    scale = 1024 # ru_maxrss is in kilobytes...
+    if sys.platform == 'darwin':
+        scale = 1 # ...except on Mac OS X
+    fdin, fdout = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(fdin)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            bench(1)
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(fdout, str((after - before) * scale).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(fdout)
+    try:
+        output = os.read(fdin, 64)
+    finally:
+        os.close(fdin)
+        os.waitpid(pid, 0)
+    if not output:
+        return None
+    return int(output)
+
+
+def run(phases=None, rows=100, repeat=3, min_time=0.2, memory=True):
+    """Run the benchmarks.
+
+    :param phases: the names of the phases to run; defaults to all `PHASES`
+    :param rows: the number of rows of the benchmark data
+    :param repeat: the number of times to time every phase, of which the best
+                   time is reported
+    :param min_time: the minimum number of seconds one timing should take;
+                     phases are run as often as needed to reach it
+    :param memory: whether to measure the peak memory used by the phases
+    :return: a dictionary with the results, suitable for serialization as
+             JSON; the results of the phases are found under the ``phases``
+             key, as dictionaries with the keys ``seconds`` (the time per
+             run), ``events``, ``events_per_sec`` and ``peak_memory`` (in
+             bytes, or ``None`` if not measured)
+    :rtype: `dict`
+    :raise ValueError: if an unknown phase is requested
+    """
+    known = dict([(phase.__name__, phase) for phase in PHASES])
+    if phases is None:
+        phases = [phase.__name__ for phase in PHASES]
+    for name in phases:
+        if name not in known:
+            raise ValueError('Unknown benchmark phase %r' % name)
+
+    results = {}
+    for name in phases:
+        setup = known[name](rows)
+        bench, events = setup[:2]
+        try:
+            seconds = _measure(bench, repeat=repeat, min_time=min_time)
+            peak = None
+            if memory:
+                peak = _peak_memory(bench)
+        finally:
+            if len(setup) > 2:
+                setup[2]()
+        results[name] = {
+            'seconds': seconds, 'events': events, 'peak_memory': peak,
+            'events_per_sec': seconds and events / seconds or None
+        }
+    return {
+        'genshi': __version__, 'python': sys.version.split()[0],
+        'rows': rows, 'phases': results
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare benchmark results with the results of an earlier run.
+
+    :param results: the results returned by `run()`
+    :param baseline: the results of the earlier run
+    :param tolerance: the fraction by which a phase may become slower before
+                      it is considered a regression
+    :return: a list of ``(phase, baseline_seconds, seconds, ratio,
+             regressed)`` tuples for the phases found in both results
+    :rtype: `list`
+    """
+    retval = []
+    old_phases = baseline.get('phases', {})
+    for name in [phase.__name__ for phase in PHASES]:
+        new, old = results['phases'].get(name), old_phases.get(name)
+        if not new or not old or not old['seconds']:
+            continue
+        ratio = new['seconds'] / old['seconds']
+        retval.append((name, old['seconds'], new['seconds'], ratio,
+                       ratio > 1 + tolerance))
+    return retval
+
+
+def _report(results, comparison, out):
+    changes = dict([(entry[0], entry) for entry in comparison])
+    out.write('Genshi %s, Python %s, %d rows\n\n' % (results['genshi'],
+              results['python'], results['rows']))
+    out.write('%-16s %12s %14s %12s %10s\n' % ('phase', 'ms per run',
+              'events/sec', 'peak KB', 'change'))
+    for name in [phase.__name__ for phase in PHASES]:
+        result = results['phases'].get(name)
+        if result is None:
+            continue
+        peak = result['peak_memory']
+        change = ''
+        if name in changes:
+            change = '%+.1f%%' % ((changes[name][3] - 1) * 100)
+            if changes[name][4]:
+                change += ' !'
+        out.write('%-16s %12.3f %14.0f %12s %10s\n' % (name,
+                  result['seconds'] * 1000, result['events_per_sec'] or 0,
+                  peak is not None and '%d' % (peak // 1024) or 'n/a',
+                  change))
+
+
+def main(args=None):
+    """Entry point of the benchmark tool.
+
+    :param args: the command-line arguments, excluding the program name;
+                 defaults to ``sys.argv[1:]``
+    :return: the exit status: 0 on success, 1 if a phase regressed compared
+             to the baseline, and 2 for usage errors
+    """
+    parser = OptionParser(usage='python -m genshi.bench [options] [phase...]',
+                          description='Benchmark the phases of processing '
+                                      'templates and markup streams.')
+    parser.add_option('-n', '--rows', dest='rows', type='int', default=100,
+                      help='the number of rows of the benchmark data '
+                           '(default: 100)')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                      help='the number of timings per phase, of which the '
+                           'best is reported (default: 3)')
+    parser.add_option('-t', '--min-time', dest='min_time', type='float',
+                      default=0.2,
+                      help='the minimum duration of a timing in seconds '
+                           '(default: 0.2)')
+    parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                      help='write the results to the given JSON file')
+    parser.add_option('-b', '--baseline', dest='baseline', metavar='FILE',
+                      help='compare the results to those in the given JSON '
+                           'file')
+    parser.add_option('--tolerance', dest='tolerance', type='float',
+                      default=0.1,
+                      help='the fraction by which a phase may become slower '
+                           'than the baseline (default: 0.1)')
+    parser.add_option('--json', dest='json', action='store_true',
+                      default=False,
+                      help='print the results as JSON instead of a table')
+    parser.add_option('--no-memory', dest='memory', action='store_false',
+                      default=True, help='do not measure the peak memory')
+    parser.add_option('-l', '--list', dest='list', action='store_true',
+                      default=False, help='list the phases and exit')
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+
+    if options.list:
+        for phase in PHASES:
+            sys.stdout.write('%-16s %s\n' % (phase.__name__,
+                             ' '.join(phase.__doc__.split())))
+        return 0
+
+    baseline = None
+    try:
+        if options.baseline:
+            fileobj = open(options.baseline)
+            try:
+                baseline = json.load(fileobj)
+            finally:
+                fileobj.close()
+        results = run(args or None, rows=options.rows, repeat=options.repeat,
+                      min_time=options.min_time, memory=options.memory)
+    except (IOError, ValueError), e:
+        sys.stderr.write('error: %s\n' % e)
+        return 2
+
+    comparison = []
+    if baseline is not None:
+        comparison = compare(results, baseline, options.tolerance)
+        results['baseline'] = dict([(name, ratio) for name, old, new, ratio,
+                                    regressed in comparison])
+    if options.output:
+        fileobj = open(options.output, 'w')
+        try:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+        finally:
+            fileobj.close()
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        _report(results, comparison, sys.stdout)
+
+    regressed = [entry[0] for entry in comparison if entry[4]]
+    if regressed:
+        sys.stderr.write('regressions: %s\n' % ', '.join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -183,6 +183,39 @@ class Stream(object):
         generator = self.serialize(method=method, **kwargs)
         return encode(generator, method=method, encoding=encoding, out=out)
 
+    def iter_encoded(self, method=None, encoding='utf-8', chunk_size=None,
+                     flush_after=None, **kwargs):
+        """Return an iterator over the serialized and encoded stream, in
+        strings of roughly the given size.
+        
+        This is meant for sending large documents to a client, for example as
+        the body of a WSGI response, without building the whole document in
+        memory first, and without writing every single tag separately. Any
+        additional keyword arguments are passed to the serializer.
+        
+        :param method: determines how the stream is serialized, as for
+                       `render()`
+        :param encoding: how the output strings should be encoded; if set to
+                         `None`, `unicode` objects are produced
+        :param chunk_size: the number of characters to collect before
+                           encoding and yielding them; defaults to
+                           `genshi.output.BUFFER_SIZE`
+        :param flush_after: a string, such as ``'</head>'``, after which the
+                            output produced so far is yielded right away
+        :return: an iterator over the encoded strings
+        
+        :see: `genshi.output.iterencode`, `genshi.output.wsgi_response`
+        :since: version 0.8
+        """
+        from genshi.output import BUFFER_SIZE, iterencode
+        if method is None:
+            method = self.serializer or 'xml'
+        if chunk_size is None:
+            chunk_size = BUFFER_SIZE
+        generator = self.serialize(method=method, **kwargs)
+        return iterencode(generator, method, encoding, chunk_size,
+                          flush_after)
+
     def select(self, path, namespaces=None, variables=None):
         """Return a new stream that contains the events matching the given
         XPath expression.
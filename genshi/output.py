@@ -15,19 +15,29 @@
 streams.
 """
 
+import codecs
+from copy import copy
 from itertools import chain
 import re
 
+from genshi import stats
 from genshi.core import escape, Attrs, Markup, Namespace, QName, StreamEventKind
 from genshi.core import START, END, TEXT, XML_DECL, DOCTYPE, START_NS, END_NS, \
                         START_CDATA, END_CDATA, PI, COMMENT, XML_NAMESPACE
 
-__all__ = ['encode', 'get_serializer', 'DocType', 'XMLSerializer',
-           'XHTMLSerializer', 'HTMLSerializer', 'TextSerializer']
+__all__ = ['encode', 'iterencode', 'wsgi_response', 'get_serializer',
+           'DocType', 'XMLSerializer', 'XHTMLSerializer', 'HTMLSerializer',
+           'TextSerializer']
 __docformat__ = 'restructuredtext en'
 
 
-def encode(iterator, method='xml', encoding=None, out=None):
+BUFFER_SIZE = 16384
+"""The default number of characters of serializer output that is collected
+before it is encoded and written out as one string."""
+
+
+def encode(iterator, method='xml', encoding=None, out=None,
+           buffer_size=BUFFER_SIZE):
     """Encode serializer output into a string.
     
     :param iterator: the iterator returned from serializing a stream (basically
@@ -40,23 +50,167 @@ def encode(iterator, method='xml', encoding=None, out=None):
                 instead of being returned as one big string; note that if
                 this is a file or socket (or similar), the `encoding` must
                 not be `None` (that is, the output must be encoded)
+    :param buffer_size: the number of characters of output to collect before
+                        writing them to `out`, see `iterencode()`
     :return: a `str` or `unicode` object (depending on the `encoding`
              parameter), or `None` if the `out` parameter is provided
     
     :since: version 0.4.1
     :note: Changed in 0.5: added the `out` parameter
+    :note: Changed in 0.8: added the `buffer_size` parameter; the output is
+           now written to `out` in batches instead of one string per event
+    """
+    if out is None:
+        return _encoder(method, encoding)(''.join(list(iterator)), True)
+    write = out.write
+    for chunk in iterencode(iterator, method, encoding, buffer_size):
+        write(chunk)
+
+
+def iterencode(iterator, method='xml', encoding=None,
+               buffer_size=BUFFER_SIZE, flush_after=None):
+    """Encode serializer output in batches of about the given size.
+    
+    The strings produced by a serializer are often as short as a single tag,
+    so writing them one by one to a file or socket is slow. This function
+    collects them until at least `buffer_size` characters are available,
+    and then encodes and yields them as one string, which makes it suitable
+    as the ``app_iter`` of a WSGI application:
+    
+    >>> from genshi.input import XML
+    >>> stream = XML('<ul><li>1</li><li>2</li><li>3</li></ul>')
+    >>> for chunk in iterencode(stream.serialize(), buffer_size=20):
+    ...     print(chunk)
+    <ul><li>1</li><li>2</li>
+    <li>3</li></ul>
+    
+    The output of the serializer is never split, so every string ends on the
+    boundary of a token, and may be somewhat longer than `buffer_size`. An
+    incremental encoder is used, so that encodings that start with a byte
+    order mark, such as UTF-16, only produce it once.
+    
+    To get the beginning of a document to the client as early as possible,
+    for example so that a browser can start loading the style sheets and
+    scripts referenced in the ``<head>`` of a long HTML page, the output can
+    also be yielded as soon as a given token has been produced:
+    
+    >>> stream = XML('<html><head><title>Hi</title></head><body>...</body>'
+    ...              '</html>')
+    >>> for chunk in iterencode(stream.serialize(), flush_after='</head>'):
+    ...     print(chunk)
+    <html><head><title>Hi</title></head>
+    <body>...</body></html>
+    
+    :param iterator: the iterator returned from serializing a stream
+    :param method: the serialization method; determines how characters not
+                   representable in the specified encoding are treated
+    :param encoding: how the output strings should be encoded; if set to
+                     `None`, `unicode` objects are produced
+    :param buffer_size: the number of characters to collect before yielding
+                        them; if `0` or `None`, the output of the serializer
+                        is passed on string by string
+    :param flush_after: a string, such as ``'</head>'``; the output collected
+                        so far is yielded right after the first token that
+                        ends with this string
+    :return: an iterator over the encoded strings
+    :since: version 0.8
+    """
+    _encode = _encoder(method, encoding)
+    if not buffer_size:
+        for chunk in iterator:
+            yield _encode(chunk)
+    else:
+        buf = []
+        append = buf.append
+        size = 0
+        for chunk in iterator:
+            append(chunk)
+            size += len(chunk)
+            if size >= buffer_size or \
+                    flush_after is not None and chunk.endswith(flush_after):
+                yield _encode(''.join(buf))
+                del buf[:]
+                size = 0
+                flush_after = None
+        if buf:
+            yield _encode(''.join(buf))
+    tail = _encode('', True)
+    if tail:
+        yield tail
+
+
+def wsgi_response(stream, start_response, status='200 OK', headers=None,
+                  method=None, encoding='utf-8', buffer_size=BUFFER_SIZE,
+                  flush_after=None, **kwargs):
+    """Start a WSGI response, and return an iterator over the serialized and
+    encoded stream to be returned by the WSGI application as the body of the
+    response.
+    
+    >>> from genshi.input import XML
+    >>> def application(environ, start_response):
+    ...     stream = XML('<html><head></head><body>Hello</body></html>')
+    ...     return wsgi_response(stream, start_response, method='html',
+    ...                          flush_after='</head>')
+    >>> def start_response(status, headers):
+    ...     print('%s %s' % (status, headers))
+    >>> body = application({}, start_response)
+    200 OK [('Content-Type', 'text/html; charset=utf-8')]
+    >>> for chunk in body:
+    ...     print(chunk.decode('utf-8'))
+    <html><head></head>
+    <body>Hello</body></html>
+    
+    A ``Content-Type`` header is added unless the given headers include one.
+    
+    :param stream: the markup `Stream` to serialize
+    :param start_response: the ``start_response`` callable passed to the
+                           WSGI application
+    :param status: the HTTP status line
+    :param headers: a list of ``(name, value)`` tuples of HTTP headers
+    :param method: the serialization method, as for `Stream.render()`
+    :param encoding: how the output should be encoded
+    :param buffer_size: the approximate size of the strings to produce, see
+                        `iterencode()`
+    :param flush_after: the token after which the output collected so far is
+                        passed on immediately, see `iterencode()`
+    :return: an iterator over the encoded strings of the response body
+    :since: version 0.8
+    """
+    if method is None:
+        method = stream.serializer or 'xml'
+    headers = list(headers or [])
+    if not [name for name, value in headers
+            if name.lower() == 'content-type']:
+        content_type = 'text/html'
+        if isinstance(method, basestring):
+            content_type = _CONTENT_TYPES.get(method.lower(), content_type)
+        if encoding:
+            content_type += '; charset=%s' % encoding
+        headers.append(('Content-Type', content_type))
+    start_response(status, headers)
+    return stream.iter_encoded(method, encoding, buffer_size, flush_after,
+                               **kwargs)
+
+
+# XHTML is sent as HTML by default, as that is what older browsers understand
+_CONTENT_TYPES = {'xml': 'application/xml', 'xhtml': 'text/html',
+                  'html': 'text/html', 'text': 'text/plain'}
+
+
+def _encoder(method, encoding):
+    """Return a function that encodes the output of the given serialization
+    method using the given encoding.
+    
+    The function has the signature of the `encode()` method of an incremental
+    encoder, that is, it takes the string to encode, and whether it is the
+    last one.
     """
     if encoding is not None:
         errors = 'replace'
         if method != 'text' and not isinstance(method, TextSerializer):
             errors = 'xmlcharrefreplace'
-        _encode = lambda string: string.encode(encoding, errors)
-    else:
-        _encode = lambda string: string
-    if out is None:
-        return _encode(''.join(list(iterator)))
-    for chunk in iterator:
-        out.write(_encode(chunk))
+        return codecs.getincrementalencoder(encoding)(errors).encode
+    return lambda string, final=False: string
 
 
 def get_serializer(method='xml', **kwargs):
@@ -68,7 +222,8 @@ def get_serializer(method='xml', **kwargs):
     Any additional keyword arguments are passed to the serializer, and thus
     depend on the `method` parameter value.
     
-    :see: `XMLSerializer`, `XHTMLSerializer`, `HTMLSerializer`, `TextSerializer`
+    :see: `XMLSerializer`, `XHTMLSerializer`, `HTMLSerializer`,
+          `TextSerializer`
     :since: version 0.4.1
     """
     if isinstance(method, basestring):
@@ -79,19 +234,50 @@ def get_serializer(method='xml', **kwargs):
     return method(**kwargs)
 
 
-def _prepare_cache(use_cache=True):
+CACHE_SIZE = 1000
+"""The default maximum number of entries in the token cache of a serializer."""
+
+CACHE_TEXT_LENGTH = 64
+"""The length of text above which text events are not stored in the token
+cache of a serializer, as longer text is unlikely to be repeated."""
+
+
+def _prepare_cache(use_cache=True, name=None):
     """Prepare a private token serialization cache.
 
+    The cache holds at most the given number of entries, dropping an
+    arbitrary entry when it is full, so that the memory it uses does not
+    grow with the size of the document. Text longer than `CACHE_TEXT_LENGTH`
+    is not cached at all.
+
     :param use_cache: boolean indicating whether a real cache should
                       be used or not. If not, the returned functions
-                      are no-ops.
+                      are no-ops. If it is an integer, it is the maximum
+                      number of entries in the cache, otherwise that is
+                      `CACHE_SIZE`.
+    :param name: the name under which the cache is reported by `genshi.stats`
+                 while the cache statistics are enabled
 
     :return: emit and get functions, for storing and retrieving
              serialized values from the cache.
     """
+    size = use_cache
+    if use_cache is True:
+        size = CACHE_SIZE
+    if use_cache and name is not None and stats.enabled():
+        _store, _get, cache = stats.get(name).instrument(size)
+        def _emit(kind, input, output):
+            if kind is TEXT and len(input) > CACHE_TEXT_LENGTH:
+                return output
+            return _store(kind, input, output)
+        return _emit, _get, cache
     cache = {}
     if use_cache:
         def _emit(kind, input, output):
+            if kind is TEXT and len(input) > CACHE_TEXT_LENGTH:
+                return output
+            if len(cache) >= size:
+                cache.popitem()
             cache[kind, input] = output
             return output
         _get = cache.get
@@ -103,6 +289,37 @@ def _prepare_cache(use_cache=True):
     return _emit, _get, cache
 
 
+_trim_trailing_space = re.compile('[ \t]+(?=\n)').sub
+_collapse_lines = re.compile('\n{2,}').sub
+
+
+def _xml_decl(data):
+    """Return the markup of an `XML_DECL` event."""
+    version, encoding, standalone = data
+    buf = ['<?xml version="%s"' % version]
+    if encoding:
+        buf.append(' encoding="%s"' % encoding)
+    if standalone != -1:
+        standalone = standalone and 'yes' or 'no'
+        buf.append(' standalone="%s"' % standalone)
+    buf.append('?>\n')
+    return Markup(''.join(buf))
+
+
+def _doctype(data):
+    """Return the markup of a `DOCTYPE` event."""
+    name, pubid, sysid = data
+    buf = ['<!DOCTYPE %s']
+    if pubid:
+        buf.append(' PUBLIC "%s"')
+    elif sysid:
+        buf.append(' SYSTEM')
+    if sysid:
+        buf.append(' "%s"')
+    buf.append('>\n')
+    return Markup(''.join(buf)) % tuple([p for p in data if p])
+
+
 class DocType(object):
     """Defines a number of commonly used DOCTYPE declarations as constants."""
 
@@ -215,9 +432,12 @@ class XMLSerializer(object):
         :param strip_whitespace: whether extraneous whitespace should be
                                  stripped from the output
         :param cache: whether to cache the text output per event, which
-                      improves performance for repetitive markup
+                      improves performance for repetitive markup; can also
+                      be the maximum number of events to cache, which
+                      defaults to `CACHE_SIZE`
         :note: Changed in 0.4.2: The  `doctype` parameter can now be a string.
         :note: Changed in 0.6: The `cache` parameter was added
+        :note: Changed in 0.8: The `cache` parameter can be an integer
         """
         self.filters = [EmptyTagFilter()]
         if strip_whitespace:
@@ -229,15 +449,416 @@ class XMLSerializer(object):
         self.cache = cache
 
     def _prepare_cache(self):
-        return _prepare_cache(self.cache)[:2]
+        return _prepare_cache(self.cache, type(self).__name__)[:2]
+
+    def _filter(self, stream):
+        # Chunks of static markup are only passed through the filters if all
+        # of them know how to handle them; the white space filter also needs
+        # to be present, as it expands chunks inside CDATA sections and
+        # elements with unescaped content, which the serializers rely on
+        types = [type(filter_) for filter_ in self.filters]
+        if WhitespaceFilter not in types or \
+                [t for t in types if t not in _CHUNK_FILTERS]:
+            stream = _expand_chunks(stream)
+        for filter_ in self.filters:
+            stream = filter_(stream)
+        return stream
+
+    def _serialize_chunk(self, events):
+        serializer = copy(self)
+        serializer.filters = []
+        return Markup(''.join(serializer(events)))
 
     def __call__(self, stream):
+        fused = self._fused_filters()
+        if fused is not None:
+            return self._fused(stream, *fused)
+        return self._serialize(self._filter(stream))
+
+    def _fused_filters(self):
+        # The default filters are applied in the same loop that produces the
+        # output, unless the list of filters has been changed; returns the
+        # white space filter (if any), the namespace flattener, and the
+        # DOCTYPE (if any) of the default filters
+        filters = self.filters
+        types = [type(filter_) for filter_ in filters] + [None, None]
+        if types[0] is not EmptyTagFilter:
+            return None
+        idx = 1
+        whitespace = doctype = None
+        if types[idx] is WhitespaceFilter:
+            whitespace = filters[idx]
+            idx += 1
+        if types[idx] is not NamespaceFlattener:
+            return None
+        flattener = filters[idx]
+        idx += 1
+        if types[idx] is DocTypeInserter:
+            doctype = filters[idx].doctype_event[1]
+            idx += 1
+        if types[idx] is not None:
+            return None
+        return whitespace, flattener, doctype
+
+    def _start_tag(self, kind, tag, attrib):
+        buf = ['<', tag]
+        for attr, value in attrib:
+            buf += [' ', attr, '="', escape(value), '"']
+        buf.append(kind is EMPTY and '/>' or '>')
+        return Markup(''.join(buf))
+
+    def _output_options(self):
+        # Whether XML declarations and CDATA sections are included in the
+        # output, and the elements whose text content is not escaped
+        return True, True, frozenset()
+
+    def _fused(self, stream, whitespace, flattener, doctype,
+               space=XML_NAMESPACE['space']):
+        """Apply the default filters to the stream and serialize the result
+        in a single loop.
+
+        This produces the same output as serializing the stream after passing
+        it through the `EmptyTagFilter`, `WhitespaceFilter`,
+        `NamespaceFlattener` and `DocTypeInserter` filters, but avoids the
+        overhead of passing every event through a chain of generators. The
+        parts of the loop below correspond to the filters, in order.
+        """
+        keep_decl, keep_cdata, noescape_elems = self._output_options()
+        start_tag = self._start_tag
+        have_decl = have_doctype = False
+        in_cdata = noescape = False
+        _emit, _get = self._prepare_cache()
+
+        # Empty tag state
+        empty_filter = self.filters[0]
+        held = None
+
+        # White space state
+        if whitespace is None:
+            stream = _expand_chunks(stream)
+        else:
+            preserve_elems = whitespace.preserve
+            ws_noescape_elems = whitespace.noescape
+            chunk_key = (WhitespaceFilter, preserve_elems, ws_noescape_elems)
+        preserve = 0
+        ws_noescape = False
+        textbuf = []
+        push_text = textbuf.append
+        pop_text = textbuf.pop
+        mjoin = Markup('').join
+        def _flush_text(preserve):
+            if len(textbuf) > 1:
+                text = mjoin(textbuf, escape_quotes=False)
+                del textbuf[:]
+            else:
+                text = escape(pop_text(), quotes=False)
+            if not preserve:
+                text = _collapse_lines('\n', _trim_trailing_space('', text))
+            return Markup(text)
+
+        # Namespace state
+        prefixes = dict([(v, [k]) for k, v in flattener.prefixes.items()])
+        namespaces = {XML_NAMESPACE.uri: ['xml']}
+        _nemit, _nget, ncache = _prepare_cache(flattener.cache,
+                                               'NamespaceFlattener')
+        def _push_ns(prefix, uri):
+            namespaces.setdefault(uri, []).append(prefix)
+            prefixes.setdefault(prefix, []).append(uri)
+            ncache.clear()
+        def _pop_ns(prefix):
+            uris = prefixes.get(prefix)
+            uri = uris.pop()
+            if not uris:
+                del prefixes[prefix]
+            if uri not in uris or uri != uris[-1]:
+                uri_prefixes = namespaces[uri]
+                uri_prefixes.pop()
+                if not uri_prefixes:
+                    del namespaces[uri]
+            ncache.clear()
+            return uri
+
+        ns_attrs = []
+        _push_ns_attr = ns_attrs.append
+        def _make_ns_attr(prefix, uri):
+            return 'xmlns%s' % (prefix and ':%s' % prefix or ''), uri
+
+        def _gen_prefix():
+            val = 0
+            while 1:
+                val += 1
+                yield 'ns%d' % val
+        _gen_prefix = _gen_prefix().next
+
+        def _flatten_chunk(chunk):
+            uris = chunk.namespaces
+            scope = tuple([namespaces[uri][-1] for uri in uris])
+            def _flatten(events):
+                scope_namespaces = {XML_NAMESPACE.uri: ['xml']}
+                for uri, prefix in zip(uris, scope):
+                    scope_namespaces[uri] = [prefix]
+                return flattener(events, scope_namespaces)
+            return chunk.apply((NamespaceFlattener, scope), _flatten)
+
+        # DOCTYPE state
+        insert_doctype = doctype is not None
+
+        # The events of chunks that cannot be filtered as a whole are fed
+        # into the loop at the stage of the filter that would expand them
+        stage = 1
+        merge_empty = True
+        collapse = whitespace is not None
+        stack = []
+        while 1:
+            for event in stream:
+
+                # EmptyTagFilter
+                if merge_empty:
+                    kind = event[0]
+                    if kind is CHUNK:
+                        event = CHUNK, event[1].apply(EmptyTagFilter,
+                                                      empty_filter), event[2]
+                    if held is None:
+                        if kind is START:
+                            held = event
+                            continue
+                        events = (event,)
+                    elif kind is END:
+                        events = ((EMPTY, held[1], held[2]),)
+                        held = None
+                    elif kind is START:
+                        events = (held,)
+                        held = event
+                    else:
+                        events = (held, event)
+                        held = None
+                else:
+                    events = (event,)
+
+                for kind, data, pos in events:
+
+                    # WhitespaceFilter
+                    if collapse:
+                        if kind is TEXT:
+                            if ws_noescape:
+                                data = Markup(data)
+                            push_text(data)
+                            continue
+                        if textbuf:
+                            text = _flush_text(preserve)
+                            if insert_doctype:
+                                insert_doctype = False
+                                if not have_doctype:
+                                    yield _doctype(doctype)
+                                    have_doctype = True
+                            yield text
+
+                        if kind is START:
+                            tag, attrs = data
+                            if preserve or (tag in preserve_elems or
+                                            attrs.get(space) == 'preserve'):
+                                preserve += 1
+                            if not ws_noescape and tag in ws_noescape_elems:
+                                ws_noescape = True
+                        elif kind is END:
+                            ws_noescape = False
+                            if preserve:
+                                preserve -= 1
+                        elif kind is START_CDATA:
+                            ws_noescape = True
+                        elif kind is END_CDATA:
+                            ws_noescape = False
+                        elif kind is CHUNK:
+                            if preserve or ws_noescape:
+                                expand = 2
+                                break
+                            data = data.apply(chunk_key, whitespace)
+
+                    # NamespaceFlattener
+                    if kind is START or kind is EMPTY:
+                        output = _nget((kind, data))
+                        if output is not None:
+                            data = output
+                        else:
+                            tag, attrs = data
+
+                            tagname = tag.localname
+                            tagns = tag.namespace
+                            if tagns:
+                                if tagns in namespaces:
+                                    prefix = namespaces[tagns][-1]
+                                    if prefix:
+                                        tagname = '%s:%s' % (prefix, tagname)
+                                else:
+                                    _push_ns_attr(('xmlns', tagns))
+                                    _push_ns('', tagns)
+
+                            new_attrs = []
+                            for attr, value in attrs:
+                                attrname = attr.localname
+                                attrns = attr.namespace
+                                if attrns:
+                                    if attrns not in namespaces:
+                                        prefix = _gen_prefix()
+                                        _push_ns(prefix, attrns)
+                                        _push_ns_attr(('xmlns:%s' % prefix,
+                                                       attrns))
+                                    else:
+                                        prefix = namespaces[attrns][-1]
+                                    if prefix:
+                                        attrname = '%s:%s' % (prefix,
+                                                              attrname)
+                                new_attrs.append((attrname, value))
+
+                            data = _nemit(kind, data, (tagname,
+                                          Attrs(ns_attrs + new_attrs)))
+                            del ns_attrs[:]
+
+                    elif kind is END:
+                        output = _nget((kind, data))
+                        if output is not None:
+                            data = output
+                        else:
+                            tagname = data.localname
+                            tagns = data.namespace
+                            if tagns:
+                                prefix = namespaces[tagns][-1]
+                                if prefix:
+                                    tagname = '%s:%s' % (prefix, tagname)
+                            data = _nemit(kind, data, tagname)
+
+                    elif kind is START_NS:
+                        prefix, uri = data
+                        if uri not in namespaces:
+                            prefix = prefixes.get(uri, [prefix])[-1]
+                            _push_ns_attr(_make_ns_attr(prefix, uri))
+                        _push_ns(prefix, uri)
+                        continue
+
+                    elif kind is END_NS:
+                        if data in prefixes:
+                            uri = _pop_ns(data)
+                            if ns_attrs:
+                                attr = _make_ns_attr(data, uri)
+                                if attr in ns_attrs:
+                                    ns_attrs.remove(attr)
+                        continue
+
+                    elif kind is CHUNK:
+                        if ns_attrs or [uri for uri in data.namespaces
+                                        if uri not in namespaces]:
+                            expand = 3
+                            break
+                        data = _flatten_chunk(data)
+
+                    # DocTypeInserter
+                    if insert_doctype:
+                        insert_doctype = False
+                        if kind is XML_DECL:
+                            if keep_decl and not have_decl:
+                                yield _xml_decl(data)
+                                have_decl = True
+                            if not have_doctype:
+                                yield _doctype(doctype)
+                                have_doctype = True
+                            continue
+                        if not have_doctype:
+                            yield _doctype(doctype)
+                            have_doctype = True
+
+                    # Serialization
+                    if kind is TEXT and isinstance(data, Markup):
+                        yield data
+                        continue
+                    output = _get((kind, data))
+                    if output is not None:
+                        yield output
+                        if noescape_elems:
+                            if (kind is START or kind is EMPTY) \
+                                    and data[0] in noescape_elems:
+                                noescape = True
+                            elif kind is END:
+                                noescape = False
+
+                    elif kind is CHUNK:
+                        yield data.render(type(self), self._serialize_chunk)
+
+                    elif kind is START or kind is EMPTY:
+                        yield _emit(kind, data, start_tag(kind, *data))
+                        if data[0] in noescape_elems:
+                            noescape = True
+
+                    elif kind is END:
+                        yield _emit(kind, data, Markup('</%s>' % data))
+                        noescape = False
+
+                    elif kind is TEXT:
+                        if in_cdata or noescape:
+                            yield _emit(kind, data, data)
+                        else:
+                            yield _emit(kind, data, escape(data, quotes=False))
+
+                    elif kind is COMMENT:
+                        yield _emit(kind, data, Markup('<!--%s-->' % data))
+
+                    elif kind is XML_DECL:
+                        if keep_decl and not have_decl:
+                            yield _xml_decl(data)
+                            have_decl = True
+
+                    elif kind is DOCTYPE:
+                        if not have_doctype:
+                            yield _doctype(data)
+                            have_doctype = True
+
+                    elif kind is START_CDATA:
+                        if keep_cdata:
+                            yield Markup('<![CDATA[')
+                            in_cdata = True
+
+                    elif kind is END_CDATA:
+                        if keep_cdata:
+                            yield Markup(']]>')
+                            in_cdata = False
+
+                    elif kind is PI:
+                        yield _emit(kind, data, Markup('<?%s %s?>' % data))
+
+                else:
+                    continue
+
+                # A chunk needs to be processed event by event
+                stack.append((stream, stage))
+                stream = iter(data.events)
+                stage = expand
+                merge_empty = False
+                collapse = whitespace is not None and stage < 3
+                break
+
+            else:
+                if not stack:
+                    break
+                stream, stage = stack.pop()
+                merge_empty = stage < 2
+                collapse = whitespace is not None and stage < 3
+
+        # A trailing START event is dropped, just like by the EmptyTagFilter
+        if textbuf:
+            text = _flush_text(preserve)
+            if insert_doctype:
+                insert_doctype = False
+                if not have_doctype:
+                    yield _doctype(doctype)
+                    have_doctype = True
+            yield text
+        if insert_doctype and not have_doctype:
+            yield _doctype(doctype)
+
+    def _serialize(self, stream):
         have_decl = have_doctype = False
         in_cdata = False
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, pos in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -245,13 +866,12 @@ class XMLSerializer(object):
             cached = _get((kind, data))
             if cached is not None:
                 yield cached
+
+            elif kind is CHUNK:
+                yield data.render(type(self), self._serialize_chunk)
+
             elif kind is START or kind is EMPTY:
-                tag, attrib = data
-                buf = ['<', tag]
-                for attr, value in attrib:
-                    buf += [' ', attr, '="', escape(value), '"']
-                buf.append(kind is EMPTY and '/>' or '>')
-                yield _emit(kind, data, Markup(''.join(buf)))
+                yield _emit(kind, data, self._start_tag(kind, *data))
 
             elif kind is END:
                 yield _emit(kind, data, Markup('</%s>' % data))
@@ -266,28 +886,11 @@ class XMLSerializer(object):
                 yield _emit(kind, data, Markup('<!--%s-->' % data))
 
             elif kind is XML_DECL and not have_decl:
-                version, encoding, standalone = data
-                buf = ['<?xml version="%s"' % version]
-                if encoding:
-                    buf.append(' encoding="%s"' % encoding)
-                if standalone != -1:
-                    standalone = standalone and 'yes' or 'no'
-                    buf.append(' standalone="%s"' % standalone)
-                buf.append('?>\n')
-                yield Markup(''.join(buf))
+                yield _xml_decl(data)
                 have_decl = True
 
             elif kind is DOCTYPE and not have_doctype:
-                name, pubid, sysid = data
-                buf = ['<!DOCTYPE %s']
-                if pubid:
-                    buf.append(' PUBLIC "%s"')
-                elif sysid:
-                    buf.append(' SYSTEM')
-                if sysid:
-                    buf.append(' "%s"')
-                buf.append('>\n')
-                yield Markup(''.join(buf)) % tuple([p for p in data if p])
+                yield _doctype(data)
                 have_doctype = True
 
             elif kind is START_CDATA:
@@ -339,16 +942,35 @@ class XHTMLSerializer(XMLSerializer):
         self.drop_xml_decl = drop_xml_decl
         self.cache = cache
 
-    def __call__(self, stream):
+    def _start_tag(self, kind, tag, attrib):
         boolean_attrs = self._BOOLEAN_ATTRS
-        empty_elems = self._EMPTY_ELEMS
+        buf = ['<', tag]
+        for attr, value in attrib:
+            if attr in boolean_attrs:
+                value = attr
+            elif attr == 'xml:lang' and 'lang' not in attrib:
+                buf += [' lang="', escape(value), '"']
+            elif attr == 'xml:space':
+                continue
+            buf += [' ', attr, '="', escape(value), '"']
+        if kind is EMPTY:
+            if tag in self._EMPTY_ELEMS:
+                buf.append(' />')
+            else:
+                buf.append('></%s>' % tag)
+        else:
+            buf.append('>')
+        return Markup(''.join(buf))
+
+    def _output_options(self):
+        return not self.drop_xml_decl, True, frozenset()
+
+    def _serialize(self, stream):
         drop_xml_decl = self.drop_xml_decl
         have_decl = have_doctype = False
         in_cdata = False
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, pos in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -357,25 +979,11 @@ class XHTMLSerializer(XMLSerializer):
             if cached is not None:
                 yield cached
 
+            elif kind is CHUNK:
+                yield data.render(type(self), self._serialize_chunk)
+
             elif kind is START or kind is EMPTY:
-                tag, attrib = data
-                buf = ['<', tag]
-                for attr, value in attrib:
-                    if attr in boolean_attrs:
-                        value = attr
-                    elif attr == 'xml:lang' and 'lang' not in attrib:
-                        buf += [' lang="', escape(value), '"']
-                    elif attr == 'xml:space':
-                        continue
-                    buf += [' ', attr, '="', escape(value), '"']
-                if kind is EMPTY:
-                    if tag in empty_elems:
-                        buf.append(' />')
-                    else:
-                        buf.append('></%s>' % tag)
-                else:
-                    buf.append('>')
-                yield _emit(kind, data, Markup(''.join(buf)))
+                yield _emit(kind, data, self._start_tag(kind, *data))
 
             elif kind is END:
                 yield _emit(kind, data, Markup('</%s>' % data))
@@ -390,28 +998,11 @@ class XHTMLSerializer(XMLSerializer):
                 yield _emit(kind, data, Markup('<!--%s-->' % data))
 
             elif kind is DOCTYPE and not have_doctype:
-                name, pubid, sysid = data
-                buf = ['<!DOCTYPE %s']
-                if pubid:
-                    buf.append(' PUBLIC "%s"')
-                elif sysid:
-                    buf.append(' SYSTEM')
-                if sysid:
-                    buf.append(' "%s"')
-                buf.append('>\n')
-                yield Markup(''.join(buf)) % tuple([p for p in data if p])
+                yield _doctype(data)
                 have_doctype = True
 
             elif kind is XML_DECL and not have_decl and not drop_xml_decl:
-                version, encoding, standalone = data
-                buf = ['<?xml version="%s"' % version]
-                if encoding:
-                    buf.append(' encoding="%s"' % encoding)
-                if standalone != -1:
-                    standalone = standalone and 'yes' or 'no'
-                    buf.append(' standalone="%s"' % standalone)
-                buf.append('?>\n')
-                yield Markup(''.join(buf))
+                yield _xml_decl(data)
                 have_decl = True
 
             elif kind is START_CDATA:
@@ -449,8 +1040,11 @@ class HTMLSerializer(XHTMLSerializer):
         :param strip_whitespace: whether extraneous whitespace should be
                                  stripped from the output
         :param cache: whether to cache the text output per event, which
-                      improves performance for repetitive markup
+                      improves performance for repetitive markup; can also
+                      be the maximum number of events to cache, which
+                      defaults to `CACHE_SIZE`
         :note: Changed in 0.6: The `cache` parameter was added
+        :note: Changed in 0.8: The `cache` parameter can be an integer
         """
         super(HTMLSerializer, self).__init__(doctype, False)
         self.filters = [EmptyTagFilter()]
@@ -462,18 +1056,35 @@ class HTMLSerializer(XHTMLSerializer):
         }, cache=cache))
         if doctype:
             self.filters.append(DocTypeInserter(doctype))
-        self.cache = True
+        self.cache = cache
 
-    def __call__(self, stream):
+    def _start_tag(self, kind, tag, attrib):
         boolean_attrs = self._BOOLEAN_ATTRS
-        empty_elems = self._EMPTY_ELEMS
+        buf = ['<', tag]
+        for attr, value in attrib:
+            if attr in boolean_attrs:
+                if value:
+                    buf += [' ', attr]
+            elif ':' in attr:
+                if attr == 'xml:lang' and 'lang' not in attrib:
+                    buf += [' lang="', escape(value), '"']
+            elif attr != 'xmlns':
+                buf += [' ', attr, '="', escape(value), '"']
+        buf.append('>')
+        if kind is EMPTY:
+            if tag not in self._EMPTY_ELEMS:
+                buf.append('</%s>' % tag)
+        return Markup(''.join(buf))
+
+    def _output_options(self):
+        return False, False, self._NOESCAPE_ELEMS
+
+    def _serialize(self, stream):
         noescape_elems = self._NOESCAPE_ELEMS
         have_doctype = False
         noescape = False
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, _ in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -487,24 +1098,12 @@ class HTMLSerializer(XHTMLSerializer):
                 elif kind is END:
                     noescape = False
 
+            elif kind is CHUNK:
+                yield data.render(type(self), self._serialize_chunk)
+
             elif kind is START or kind is EMPTY:
-                tag, attrib = data
-                buf = ['<', tag]
-                for attr, value in attrib:
-                    if attr in boolean_attrs:
-                        if value:
-                            buf += [' ', attr]
-                    elif ':' in attr:
-                        if attr == 'xml:lang' and 'lang' not in attrib:
-                            buf += [' lang="', escape(value), '"']
-                    elif attr != 'xmlns':
-                        buf += [' ', attr, '="', escape(value), '"']
-                buf.append('>')
-                if kind is EMPTY:
-                    if tag not in empty_elems:
-                        buf.append('</%s>' % tag)
-                yield _emit(kind, data, Markup(''.join(buf)))
-                if tag in noescape_elems:
+                yield _emit(kind, data, self._start_tag(kind, *data))
+                if data[0] in noescape_elems:
                     noescape = True
 
             elif kind is END:
@@ -521,16 +1120,7 @@ class HTMLSerializer(XHTMLSerializer):
                 yield _emit(kind, data, Markup('<!--%s-->' % data))
 
             elif kind is DOCTYPE and not have_doctype:
-                name, pubid, sysid = data
-                buf = ['<!DOCTYPE %s']
-                if pubid:
-                    buf.append(' PUBLIC "%s"')
-                elif sysid:
-                    buf.append(' SYSTEM')
-                if sysid:
-                    buf.append(' "%s"')
-                buf.append('>\n')
-                yield Markup(''.join(buf)) % tuple([p for p in data if p])
+                yield _doctype(data)
                 have_doctype = True
 
             elif kind is PI:
@@ -582,6 +1172,12 @@ class TextSerializer(object):
                 if strip_markup and type(data) is Markup:
                     data = data.striptags().stripentities()
                 yield unicode(data)
+            elif event[0] is CHUNK:
+                yield event[1].render((TextSerializer, strip_markup),
+                                      self._serialize_chunk)
+
+    def _serialize_chunk(self, events):
+        return ''.join(self(events))
 
 
 class EmptyTagFilter(object):
@@ -602,6 +1198,8 @@ class EmptyTagFilter(object):
                 else:
                     yield prev
             if ev[0] is not START:
+                if ev[0] is CHUNK:
+                    ev = CHUNK, ev[1].apply(EmptyTagFilter, self), ev[2]
                 yield ev
             prev = ev
 
@@ -610,10 +1208,12 @@ EMPTY = EmptyTagFilter.EMPTY
 
 
 class NamespaceFlattener(object):
-    r"""Output stream filter that removes namespace information from the stream,
-    instead adding namespace attributes and prefixes as needed.
+    r"""Output stream filter that removes namespace information from the
+    stream, instead adding namespace attributes and prefixes as needed.
     
     :param prefixes: optional mapping of namespace URIs to prefixes
+    :param cache: whether to cache the flattened events, or the maximum number
+                  of events to cache
     
     >>> from genshi.input import XML
     >>> xml = XML('''<doc xmlns="NS1" xmlns:two="NS2">
@@ -635,10 +1235,11 @@ class NamespaceFlattener(object):
             self.prefixes.update(prefixes)
         self.cache = cache
 
-    def __call__(self, stream):
+    def __call__(self, stream, namespaces=None):
         prefixes = dict([(v, [k]) for k, v in self.prefixes.items()])
-        namespaces = {XML_NAMESPACE.uri: ['xml']}
-        _emit, _get, cache = _prepare_cache(self.cache)
+        if namespaces is None:
+            namespaces = {XML_NAMESPACE.uri: ['xml']}
+        _emit, _get, cache = _prepare_cache(self.cache, 'NamespaceFlattener')
         def _push_ns(prefix, uri):
             namespaces.setdefault(uri, []).append(prefix)
             prefixes.setdefault(prefix, []).append(uri)
@@ -668,73 +1269,101 @@ class NamespaceFlattener(object):
                 yield 'ns%d' % val
         _gen_prefix = _gen_prefix().next
 
-        for kind, data, pos in stream:
-            if kind is TEXT and isinstance(data, Markup):
-                yield kind, data, pos
-                continue
-            output = _get((kind, data))
-            if output is not None:
-                yield kind, output, pos
+        def _flatten_chunk(chunk):
+            uris = chunk.namespaces
+            scope = tuple([namespaces[uri][-1] for uri in uris])
+            def _flatten(events):
+                scope_namespaces = {XML_NAMESPACE.uri: ['xml']}
+                for uri, prefix in zip(uris, scope):
+                    scope_namespaces[uri] = [prefix]
+                return self(events, scope_namespaces)
+            return chunk.apply((NamespaceFlattener, scope), _flatten)
+
+        stack = []
+        while 1:
+            for kind, data, pos in stream:
+                if kind is TEXT and isinstance(data, Markup):
+                    yield kind, data, pos
+                    continue
+                output = _get((kind, data))
+                if output is not None:
+                    yield kind, output, pos
 
-            elif kind is START or kind is EMPTY:
-                tag, attrs = data
+                elif kind is START or kind is EMPTY:
+                    tag, attrs = data
 
-                tagname = tag.localname
-                tagns = tag.namespace
-                if tagns:
-                    if tagns in namespaces:
+                    tagname = tag.localname
+                    tagns = tag.namespace
+                    if tagns:
+                        if tagns in namespaces:
+                            prefix = namespaces[tagns][-1]
+                            if prefix:
+                                tagname = '%s:%s' % (prefix, tagname)
+                        else:
+                            _push_ns_attr(('xmlns', tagns))
+                            _push_ns('', tagns)
+
+                    new_attrs = []
+                    for attr, value in attrs:
+                        attrname = attr.localname
+                        attrns = attr.namespace
+                        if attrns:
+                            if attrns not in namespaces:
+                                prefix = _gen_prefix()
+                                _push_ns(prefix, attrns)
+                                _push_ns_attr(('xmlns:%s' % prefix, attrns))
+                            else:
+                                prefix = namespaces[attrns][-1]
+                            if prefix:
+                                attrname = '%s:%s' % (prefix, attrname)
+                        new_attrs.append((attrname, value))
+
+                    data = _emit(kind, data,
+                                 (tagname, Attrs(ns_attrs + new_attrs)))
+                    yield kind, data, pos
+                    del ns_attrs[:]
+
+                elif kind is END:
+                    tagname = data.localname
+                    tagns = data.namespace
+                    if tagns:
                         prefix = namespaces[tagns][-1]
                         if prefix:
                             tagname = '%s:%s' % (prefix, tagname)
-                    else:
-                        _push_ns_attr(('xmlns', tagns))
-                        _push_ns('', tagns)
-
-                new_attrs = []
-                for attr, value in attrs:
-                    attrname = attr.localname
-                    attrns = attr.namespace
-                    if attrns:
-                        if attrns not in namespaces:
-                            prefix = _gen_prefix()
-                            _push_ns(prefix, attrns)
-                            _push_ns_attr(('xmlns:%s' % prefix, attrns))
-                        else:
-                            prefix = namespaces[attrns][-1]
-                        if prefix:
-                            attrname = '%s:%s' % (prefix, attrname)
-                    new_attrs.append((attrname, value))
+                    yield kind, _emit(kind, data, tagname), pos
+
+                elif kind is START_NS:
+                    prefix, uri = data
+                    if uri not in namespaces:
+                        prefix = prefixes.get(uri, [prefix])[-1]
+                        _push_ns_attr(_make_ns_attr(prefix, uri))
+                    _push_ns(prefix, uri)
+
+                elif kind is END_NS:
+                    if data in prefixes:
+                        uri = _pop_ns(data)
+                        if ns_attrs:
+                            attr = _make_ns_attr(data, uri)
+                            if attr in ns_attrs:
+                                ns_attrs.remove(attr)
+
+                elif kind is CHUNK:
+                    if ns_attrs or [uri for uri in data.namespaces
+                                    if uri not in namespaces]:
+                        # Namespace declarations need to be added to the
+                        # static markup, so process it event by event
+                        stack.append(stream)
+                        stream = iter(data.events)
+                        break
+                    yield kind, _flatten_chunk(data), pos
 
-                data = _emit(kind, data, (tagname, Attrs(ns_attrs + new_attrs)))
-                yield kind, data, pos
-                del ns_attrs[:]
-
-            elif kind is END:
-                tagname = data.localname
-                tagns = data.namespace
-                if tagns:
-                    prefix = namespaces[tagns][-1]
-                    if prefix:
-                        tagname = '%s:%s' % (prefix, tagname)
-                yield kind, _emit(kind, data, tagname), pos
-
-            elif kind is START_NS:
-                prefix, uri = data
-                if uri not in namespaces:
-                    prefix = prefixes.get(uri, [prefix])[-1]
-                    _push_ns_attr(_make_ns_attr(prefix, uri))
-                _push_ns(prefix, uri)
-
-            elif kind is END_NS:
-                if data in prefixes:
-                    uri = _pop_ns(data)
-                    if ns_attrs:
-                        attr = _make_ns_attr(data, uri)
-                        if attr in ns_attrs:
-                            ns_attrs.remove(attr)
+                else:
+                    yield kind, data, pos
 
             else:
-                yield kind, data, pos
+                if not stack:
+                    break
+                stream = stack.pop()
 
 
 class WhitespaceFilter(object):
@@ -762,55 +1391,76 @@ class WhitespaceFilter(object):
         self.noescape = frozenset(noescape)
 
     def __call__(self, stream, ctxt=None, space=XML_NAMESPACE['space'],
-                 trim_trailing_space=re.compile('[ \t]+(?=\n)').sub,
-                 collapse_lines=re.compile('\n{2,}').sub):
+                 trim_trailing_space=_trim_trailing_space,
+                 collapse_lines=_collapse_lines):
         mjoin = Markup('').join
         preserve_elems = self.preserve
         preserve = 0
         noescape_elems = self.noescape
         noescape = False
 
+        chunk_key = (WhitespaceFilter, preserve_elems, noescape_elems)
+
         textbuf = []
         push_text = textbuf.append
         pop_text = textbuf.pop
-        for kind, data, pos in chain(stream, [(None, None, None)]):
-
-            if kind is TEXT:
-                if noescape:
-                    data = Markup(data)
-                push_text(data)
-            else:
-                if textbuf:
-                    if len(textbuf) > 1:
-                        text = mjoin(textbuf, escape_quotes=False)
-                        del textbuf[:]
-                    else:
-                        text = escape(pop_text(), quotes=False)
-                    if not preserve:
-                        text = collapse_lines('\n', trim_trailing_space('', text))
-                    yield TEXT, Markup(text), pos
-
-                if kind is START:
-                    tag, attrs = data
-                    if preserve or (tag in preserve_elems or
-                                    attrs.get(space) == 'preserve'):
-                        preserve += 1
-                    if not noescape and tag in noescape_elems:
+        stack = []
+        stream = chain(stream, [(None, None, None)])
+        while 1:
+            for kind, data, pos in stream:
+
+                if kind is TEXT:
+                    if noescape:
+                        data = Markup(data)
+                    push_text(data)
+                else:
+                    if textbuf:
+                        if len(textbuf) > 1:
+                            text = mjoin(textbuf, escape_quotes=False)
+                            del textbuf[:]
+                        else:
+                            text = escape(pop_text(), quotes=False)
+                        if not preserve:
+                            text = trim_trailing_space('', text)
+                            text = collapse_lines('\n', text)
+                        yield TEXT, Markup(text), pos
+
+                    if kind is START:
+                        tag, attrs = data
+                        if preserve or (tag in preserve_elems or
+                                        attrs.get(space) == 'preserve'):
+                            preserve += 1
+                        if not noescape and tag in noescape_elems:
+                            noescape = True
+
+                    elif kind is END:
+                        noescape = False
+                        if preserve:
+                            preserve -= 1
+
+                    elif kind is START_CDATA:
                         noescape = True
 
-                elif kind is END:
-                    noescape = False
-                    if preserve:
-                        preserve -= 1
+                    elif kind is END_CDATA:
+                        noescape = False
 
-                elif kind is START_CDATA:
-                    noescape = True
+                    elif kind is CHUNK:
+                        if preserve or noescape:
+                            # Static markup inside elements that preserve
+                            # white space or whose content is not escaped is
+                            # processed event by event
+                            stack.append(stream)
+                            stream = iter(data.events)
+                            break
+                        data = data.apply(chunk_key, self)
 
-                elif kind is END_CDATA:
-                    noescape = False
+                    if kind:
+                        yield kind, data, pos
 
-                if kind:
-                    yield kind, data, pos
+            else:
+                if not stack:
+                    break
+                stream = stack.pop()
 
 
 class DocTypeInserter(object):
@@ -841,3 +1491,105 @@ class DocTypeInserter(object):
 
         if not doctype_inserted:
             yield self.doctype_event
+
+
+class Chunk(object):
+    """A run of static markup events that is serialized as a whole.
+    
+    Templates replace runs of balanced static elements by `CHUNK` events
+    carrying instances of this class. The output filters and serializers
+    process the events of a chunk only once per configuration and cache the
+    results on the chunk, so that the static markup is emitted with a single
+    string on subsequent renderings.
+    
+    >>> from genshi.input import XML
+    >>> chunk = Chunk(list(XML('<p>Hello, <em>world</em>!</p>')))
+    >>> stream = [(CHUNK, chunk, (None, -1, -1))]
+    >>> print(''.join(XMLSerializer()(stream)))
+    <p>Hello, <em>world</em>!</p>
+    >>> print(''.join(TextSerializer()(stream)))
+    Hello, world!
+    """
+
+    CHUNK = StreamEventKind('CHUNK')
+
+    def __init__(self, events, namespaces=None):
+        """Create the chunk.
+        
+        :param events: a list of markup events, which must start with a
+                       `START` event and end with the corresponding `END`
+                       event
+        :param namespaces: the namespace URIs of the elements and attributes
+                           in the events; computed from the events if omitted
+        """
+        self.events = events
+        if namespaces is None:
+            uris = set()
+            for kind, data, pos in events:
+                if kind is START:
+                    tag, attrs = data
+                    uris.update([name.namespace for name in [tag] +
+                                 [attr for attr, _ in attrs]
+                                 if name.namespace])
+            namespaces = tuple(sorted(uris))
+        self.namespaces = namespaces
+        self._cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __repr__(self):
+        return '<%s (%d events)>' % (type(self).__name__, len(self.events))
+
+    def apply(self, key, filter_):
+        """Return a chunk containing the events produced by applying the given
+        filter to the events of this chunk.
+        
+        :param key: the key under which the resulting chunk is cached, which
+                    must identify the filter and its configuration
+        :param filter_: the filter, which is called with an iterator over the
+                        events of this chunk
+        :return: the filtered `Chunk`
+        """
+        chunk = self._cache.get(key)
+        if chunk is None:
+            chunk = Chunk(list(filter_(iter(self.events))), self.namespaces)
+            self._cache[key] = chunk
+        return chunk
+
+    def render(self, key, serializer):
+        """Return the serialized output of this chunk.
+        
+        :param key: the key under which the output is cached, which must
+                    identify the serializer and its configuration
+        :param serializer: a function that is called with an iterator over the
+                           events of this chunk, and returns the output string
+        :return: the output string
+        """
+        output = self._cache.get(key)
+        if output is None:
+            output = self._cache[key] = serializer(iter(self.events))
+        return output
+
+
+CHUNK = Chunk.CHUNK
+
+_CHUNK_FILTERS = (EmptyTagFilter, WhitespaceFilter, NamespaceFlattener,
+                  DocTypeInserter)
+
+
+def _expand_chunks(stream):
+    """Replace any `CHUNK` events in the given stream by the events they
+    contain.
+    """
+    for event in stream:
+        if event[0] is CHUNK:
+            for event in event[1].events:
+                yield event
+        else:
+            yield event
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Statistics about the internal caches of Genshi.
+
+Genshi uses several caches internally: the template cache of every
+`TemplateLoader`, and the caches that the serializers and the
+`NamespaceFlattener` use to avoid serializing the same tokens again. This
+module reports how well those caches work, for example to be sampled by a
+metrics exporter.
+
+The caches used during serialization are only instrumented while the
+statistics are enabled, so that they do not cost anything otherwise:
+
+>>> from genshi.input import XML
+>>> reset()
+>>> enable()
+>>> print(XML('<p><b>1</b><b>2</b></p>').render('xml', encoding=None))
+<p><b>1</b><b>2</b></p>
+>>> disable()
+>>> info = snapshot()['XMLSerializer']
+>>> info['hits'], info['misses'], info['size']
+(2, 4, 4)
+
+The template caches of loaders count their hits and misses all the time, so
+their statistics are available whether enabled or not.
+"""
+
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+import weakref
+
+__all__ = ['CacheStats', 'disable', 'enable', 'enabled', 'get', 'reset',
+           'snapshot', 'track']
+__docformat__ = 'restructuredtext en'
+
+_enabled = False
+_lock = threading.Lock()
+_stats = {}
+_tracked = {}
+_baselines = {} # counters of tracked caches at the last reset, by id
+
+
+class CacheStats(object):
+    """Counters for a kind of cache.
+
+    The counters are not protected by a lock, so they may miss a few updates
+    when caches are used by several threads at the same time.
+    """
+
+    def __init__(self, name):
+        """Create the counters.
+
+        :param name: the name under which the statistics are reported
+        """
+        self.name = name
+        self.reset()
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.name)
+
+    def as_dict(self):
+        """Return the counters as a dictionary with the keys ``hits``,
+        ``misses``, ``size``, ``clears`` and ``evictions``.
+
+        :rtype: `dict`
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size,
+                'clears': self.clears, 'evictions': self.evictions}
+
+    def instrument(self, capacity=None):
+        """Return a new cache dictionary that updates these counters, along
+        with functions for storing entries in and retrieving entries from it.
+
+        The `size` counter records the largest number of entries held by any
+        of the instrumented dictionaries, as they usually only exist while a
+        stream is being serialized.
+
+        :param capacity: the maximum number of entries in the dictionary, or
+                         `None` for no limit; when the dictionary is full, an
+                         arbitrary entry is evicted to make room for a new one
+        :return: a ``(emit, get, cache)`` tuple as returned by
+                 ``genshi.output._prepare_cache()``
+        """
+        stats = self
+        cache = _CountingDict()
+        cache.stats = self
+        _lookup = cache.get
+        def _emit(kind, input, output):
+            if capacity is not None and len(cache) >= capacity:
+                cache.popitem()
+                stats.evictions += 1
+            cache[kind, input] = output
+            if len(cache) > stats.size:
+                stats.size = len(cache)
+            return output
+        def _get(key):
+            output = _lookup(key)
+            if output is None:
+                stats.misses += 1
+            else:
+                stats.hits += 1
+            return output
+        return _emit, _get, cache
+
+    def reset(self):
+        """Reset all counters to zero."""
+        self.hits = self.misses = self.size = self.clears = self.evictions = 0
+
+
+class _CountingDict(dict):
+    __slots__ = ['stats']
+
+    def clear(self):
+        self.stats.clears += 1
+        dict.clear(self)
+
+
+def enable():
+    """Start instrumenting the caches used during serialization."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop instrumenting the caches used during serialization.
+
+    The statistics gathered so far are kept until `reset()` is called.
+    """
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    """Return whether the caches used during serialization are currently
+    instrumented.
+
+    :rtype: `bool`
+    """
+    return _enabled
+
+
+def get(name):
+    """Return the `CacheStats` object with the given name, creating it if
+    necessary.
+
+    :param name: the name of the kind of cache, such as ``XMLSerializer``
+    :rtype: `CacheStats`
+    """
+    stats = _stats.get(name)
+    if stats is None:
+        _lock.acquire()
+        try:
+            stats = _stats.setdefault(name, CacheStats(name))
+        finally:
+            _lock.release()
+    return stats
+
+
+def track(name, cache):
+    """Include the counters of the given cache in the statistics reported
+    under the given name, for as long as the cache exists.
+
+    :param name: the name of the kind of cache, such as ``TemplateLoader``
+    :param cache: an object with `hits`, `misses` and `evictions` attributes
+                  that supports `len()`, such as an `LRUCache`
+    """
+    _lock.acquire()
+    try:
+        _tracked.setdefault(name, weakref.WeakValueDictionary())[id(cache)] = \
+                cache
+        _baselines.pop(id(cache), None)
+    finally:
+        _lock.release()
+
+
+def reset():
+    """Reset the counters of all caches to zero.
+
+    The counters of tracked caches are left alone, as their owners may report
+    them too; the statistics only include what they counted since the reset.
+    """
+    _lock.acquire()
+    try:
+        for stats in _stats.values():
+            stats.reset()
+        _baselines.clear()
+        for caches in _tracked.values():
+            for cache in caches.values():
+                _baselines[id(cache)] = (cache.hits, cache.misses,
+                                         cache.evictions)
+    finally:
+        _lock.release()
+
+
+def snapshot():
+    """Return the current statistics of all kinds of caches.
+
+    The result is a dictionary mapping the names of the kinds of caches to
+    dictionaries with the following keys:
+
+     * ``hits``: the number of entries found in the cache
+     * ``misses``: the number of entries that were not found
+     * ``size``: the number of entries in the caches; for the caches used
+       during serialization, the largest number of entries one of them held
+     * ``clears``: the number of times a cache was emptied
+     * ``evictions``: the number of entries dropped to make room for others
+
+    :rtype: `dict`
+    """
+    _lock.acquire()
+    try:
+        retval = dict([(name, stats.as_dict())
+                       for name, stats in _stats.items()])
+        for name, caches in _tracked.items():
+            info = retval.setdefault(name, CacheStats(name).as_dict())
+            for cache in caches.values():
+                hits, misses, evictions = _baselines.get(id(cache), (0, 0, 0))
+                info['hits'] += cache.hits - hits
+                info['misses'] += cache.misses - misses
+                info['evictions'] += cache.evictions - evictions
+                info['size'] += len(cache)
+        return retval
+    finally:
+        _lock.release()
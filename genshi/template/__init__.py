@@ -18,6 +18,7 @@ from genshi.template.base import Context, Template, TemplateError, \
                                  BadDirectiveError
 from genshi.template.loader import TemplateLoader, TemplateNotFound
 from genshi.template.markup import MarkupTemplate
+from genshi.template.codegen import CompiledMarkupTemplate
 from genshi.template.text import TextTemplate, OldTextTemplate, NewTextTemplate
 
 __docformat__ = 'restructuredtext en'
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Rendering of templates from `asyncio` coroutines.
+
+Templates are applied to their data by synchronous generators, so a template
+that has to wait for some data blocks the thread it runs in, and with it the
+event loop of an `asyncio` application. Using `Template.generate_async()`,
+expressions in a template may instead evaluate to awaitables, such as the
+coroutine objects returned by ``async def`` functions, which are then awaited
+without blocking the event loop:
+
+>>> import asyncio
+>>> from genshi.template import MarkupTemplate
+>>> tmpl = MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+...   <li py:for="name in names()">${greeting(name)}</li>
+... </ul>''')
+>>> async def names():
+...     await asyncio.sleep(0.01)
+...     return ['Alice', 'Bob']
+>>> async def greeting(name):
+...     await asyncio.sleep(0.01)
+...     return 'Hello, %s' % name
+>>> stream = tmpl.generate_async(names=names, greeting=greeting)
+>>> loop = asyncio.new_event_loop()
+>>> print(loop.run_until_complete(stream.render(encoding=None)))
+<ul>
+  <li>Hello, Alice</li><li>Hello, Bob</li>
+</ul>
+>>> loop.close()
+
+In a coroutine, that is simply ``html = await stream.render('html')``, and
+the encoded output can also be consumed in chunks using
+``async for chunk in stream.iter_encoded('html')``.
+
+Only the value of an expression as a whole is awaited, so ``${fetch()}`` or
+``py:for="item in fetch()"`` work, but ``${len(fetch())}`` does not; results
+can be bound to names using ``py:with="items = fetch()"`` instead.
+
+The template is processed in a thread of its own, while the coroutine
+rendering it waits without blocking the event loop. When an expression
+evaluates to an awaitable, that thread is suspended right there: the
+awaitable is awaited by a task of the event loop, and the thread resumes with
+its result in place of the awaitable, or with the error it raised. Every
+expression, and any other code in the template, is thus evaluated exactly
+once, and the chunks of `AsyncStream.iter_encoded()` are passed on as soon as
+they are produced.
+
+The awaitables produced by a template are awaited one after the other, as
+the thread cannot go on before it has the result of each of them. Awaitables
+passed as context data are awaited concurrently before the template is
+processed, and so are the awaitables produced by the expressions of a
+``py:prefetch`` directive, which are evaluated in threads of their own. As
+expressions are not evaluated in the thread running the event loop, they
+should not use the loop themselves, for example to create tasks, but leave
+the awaiting to the template.
+
+:note: This module requires Python 3.5 or later.
+:since: version 0.8
+"""
+
+import asyncio
+import inspect
+import threading
+
+from genshi.template.base import Context
+
+__all__ = ['AsyncStream']
+__docformat__ = 'restructuredtext en'
+
+
+class AsyncStream(object):
+    """The result of applying a template to data using
+    `Template.generate_async()`, which can be rendered asynchronously.
+    """
+
+    def __init__(self, template, data=None):
+        """Create the stream.
+
+        :param template: the `Template` to apply
+        :param data: a dictionary with the context data, where the values
+                     that are awaitables are replaced by their results
+        """
+        self.template = template
+        self.data = data or {}
+
+    def resolve(self):
+        """Return an awaitable that processes the template, and results in
+        the generated `Stream`, which does not contain any awaitables.
+        """
+        return _Awaitable(self._run, _resolved)
+
+    def render(self, method=None, encoding=None, **kwargs):
+        """Return an awaitable that results in a string representation of the
+        stream, as returned by `Stream.render()`.
+
+        :param method: determines how the stream is serialized
+        :param encoding: how the output string should be encoded; if set to
+                         `None`, the result is a `unicode` object
+        """
+        def render(stream):
+            return [stream.render(method, encoding, **kwargs)]
+        return _Awaitable(self._run, render)
+
+    def iter_encoded(self, method=None, encoding='utf-8', chunk_size=None,
+                     flush_after=None, **kwargs):
+        """Return an asynchronous iterator over the serialized and encoded
+        stream, in strings of roughly the given size, as produced by
+        `Stream.iter_encoded()`.
+
+        :param method: determines how the stream is serialized
+        :param encoding: how the output strings should be encoded
+        :param chunk_size: the number of characters to collect before
+                           encoding and yielding them
+        :param flush_after: a string, such as ``'</head>'``, after which the
+                            output produced so far is yielded right away
+        """
+        def iter_encoded(stream):
+            return stream.iter_encoded(method, encoding, chunk_size,
+                                       flush_after, **kwargs)
+        return _AsyncIterator(self, iter_encoded)
+
+    def _data(self, result):
+        """Await the awaitables in the context data concurrently, and append
+        the data with their results to the given list."""
+        data = self.data.copy()
+        names = [name for name, value in data.items() if _isawaitable(value)]
+        if names:
+            values = []
+            for step in _wait(asyncio.gather(*[data[name] for name in names]),
+                              values):
+                yield step
+            data.update(zip(names, values[0]))
+        result.append(data)
+
+    def _renderer(self, data, func):
+        """Return a `_Renderer` calling the given function with the generated
+        `Stream` in its thread."""
+        def generate(awaiter):
+            ctxt = Context(**data)
+            ctxt._awaiter = awaiter
+            return func(self.template.generate(ctxt))
+        return _Renderer(generate)
+
+    def _run(self, result, func):
+        data = []
+        for step in self._data(data):
+            yield step
+        renderer = self._renderer(data[0], func)
+        for step in renderer.next(result):
+            yield step
+
+
+def _resolved(stream):
+    return [type(stream)(list(stream.events), stream.serializer)]
+
+
+class _Renderer(object):
+    """Calls a function with itself as the awaiter of the `Context` in a
+    thread of its own, and passes the items of the iterable returned by the
+    function on to a coroutine, one at a time.
+
+    The thread waits while the coroutine handles an item, and whenever
+    `_eval_expr()` calls the renderer with an expression that evaluated to an
+    awaitable, which is then awaited by a task of the event loop.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.loop = None
+        self.thread = None
+        self.future = None # the future the thread sets to report an item
+        self.resumed = threading.Event() # set to let the thread go on
+        self.finished = False
+        self.tasks = set() # the tasks awaiting awaitables for the thread
+        self.awaited = {} # (awaitable, result) tuples by id of awaitable
+
+    def __call__(self, expr, value, ctxt):
+        if not _isawaitable(value):
+            return value
+        awaited = self.awaited.get(id(value))
+        if awaited is not None and awaited[0] is value:
+            return awaited[1]
+        waiter = _Waiter()
+        self.loop.call_soon_threadsafe(self._await, value, waiter)
+        result = waiter.wait()
+        self.awaited[id(value)] = value, result
+        return result
+
+    def next(self, result):
+        """Let the thread produce its next item, and append it to the given
+        list, unless the iterable is exhausted."""
+        if self.finished:
+            return
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.future = future = self.loop.create_future()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.resumed.set()
+        reported = []
+        try:
+            for step in _wait(future, reported):
+                yield step
+        except BaseException:
+            self.close()
+            raise
+        kind, value = reported[0]
+        if kind == 'item':
+            result.append(value)
+            return
+        self.finished = True
+        if kind == 'error':
+            raise value
+
+    def close(self):
+        """Stop the thread and the tasks it is waiting for."""
+        if self.thread is None or self.finished:
+            return
+        self.finished = True
+        self.resumed.set()
+        if not self.loop.is_closed():
+            for task in list(self.tasks):
+                task.cancel()
+
+    def _await(self, awaitable, waiter):
+        if self.finished:
+            _close(awaitable)
+            waiter.set(error=GeneratorExit())
+            return
+        task = asyncio.ensure_future(awaitable, loop=self.loop)
+        self.tasks.add(task)
+        def done(task):
+            self.tasks.discard(task)
+            if self.finished:
+                waiter.set(error=GeneratorExit())
+            elif task.cancelled():
+                waiter.set(error=asyncio.CancelledError())
+            elif task.exception() is not None:
+                waiter.set(error=task.exception())
+            else:
+                waiter.set(task.result())
+        task.add_done_callback(done)
+
+    def _report(self, kind, value):
+        self.loop.call_soon_threadsafe(_set_result, self.future, (kind, value))
+
+    def _run(self):
+        try:
+            for item in self.func(self):
+                self._report('item', item)
+                self.resumed.wait()
+                self.resumed.clear()
+                if self.finished:
+                    return
+            self._report('done', None)
+        except GeneratorExit:
+            pass
+        except BaseException, e:
+            if not self.finished:
+                self._report('error', e)
+
+
+class _Waiter(object):
+    """Lets a thread wait for the result of an awaitable."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = self.error = None
+
+    def set(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def _close(awaitable):
+    """Close a coroutine that will not be awaited."""
+    close = getattr(awaitable, 'close', None)
+    if close is not None:
+        close()
+
+
+def _isawaitable(value):
+    return inspect.isawaitable(value)
+
+
+def _set_result(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def _wait(awaitable, result):
+    """Wait for the given awaitable like ``await`` does, by passing on what it
+    yields to the event loop, and append its result to the given list.
+    """
+    if hasattr(awaitable, '__await__'):
+        iterator = awaitable.__await__()
+    else: # generator-based coroutine
+        iterator = iter(awaitable)
+    value = error = None
+    while 1:
+        try:
+            if error is None:
+                yielded = iterator.send(value)
+            else:
+                yielded = iterator.throw(error)
+        except StopIteration, e:
+            result.append(getattr(e, 'value', None))
+            return
+        value = error = None
+        try:
+            value = yield yielded
+        except GeneratorExit:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            raise
+        except BaseException, e:
+            error = e
+
+
+class _Awaitable(object):
+    """An awaitable that runs a generator function, which is called with a
+    list to append its result to, followed by the given arguments.
+
+    The generator yields `None` to return control to the event loop, and
+    whatever the awaitables it waits for yield.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __await__(self):
+        result = []
+        return _Coroutine(self.func(result, *self.args), result)
+
+    __iter__ = __await__ # for use with ``yield from``
+
+
+class _Coroutine(object):
+    """The iterator returned by `_Awaitable.__await__()`."""
+
+    def __init__(self, generator, result):
+        self.generator = generator
+        self.result = result
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.send(None)
+
+    def send(self, value):
+        try:
+            return self.generator.send(value)
+        except StopIteration:
+            self._stop()
+
+    def throw(self, *exc_info):
+        try:
+            return self.generator.throw(*exc_info)
+        except StopIteration:
+            self._stop()
+
+    def close(self):
+        self.generator.close()
+
+    def _stop(self):
+        value = None
+        if self.result:
+            value = self.result[0]
+        raise StopIteration(value)
+
+
+class _AsyncIterator(object):
+    """The asynchronous iterator returned by `AsyncStream.iter_encoded()`."""
+
+    def __init__(self, stream, func):
+        self.stream = stream
+        self.func = func
+        self.renderer = None
+
+    def __del__(self):
+        if self.renderer is not None:
+            self.renderer.close()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return _Awaitable(self._next)
+
+    def _next(self, result):
+        if self.renderer is None:
+            data = []
+            for step in self.stream._data(data):
+                yield step
+            self.renderer = self.stream._renderer(data[0], self.func)
+        for step in self.renderer.next(result):
+            yield step
+        if not result:
+            raise StopAsyncIteration
@@ -18,7 +18,8 @@ import os
 import sys
 
 from genshi.compat import StringIO, BytesIO
-from genshi.core import Attrs, Stream, StreamEventKind, START, TEXT, _ensure
+from genshi.core import Attrs, Stream, StreamEventKind, END, START, TEXT, \
+                        _ensure
 from genshi.input import ParseError
 
 __all__ = ['Context', 'DirectiveFactory', 'Template', 'TemplateError',
@@ -127,7 +128,10 @@ class Context(object):
         self.pop = self.frames.popleft
         self.push = self.frames.appendleft
         self._match_templates = []
+        self._match_index = None # see `MarkupTemplate._match()`
         self._choice_stack = []
+        self._globals = {} # globals dictionaries for code, by lookup class
+        self._awaiter = None # see `genshi.template.asynchronous`
 
         # Helper functions for use in expressions
         def defined(name):
@@ -287,6 +291,8 @@ def _eval_expr(expr, ctxt, vars=None):
     if vars:
         ctxt.push(vars)
     retval = expr.evaluate(ctxt)
+    if ctxt._awaiter is not None:
+        retval = ctxt._awaiter(expr, retval, ctxt)
     if vars:
         ctxt.pop()
     return retval
@@ -452,7 +458,7 @@ class Template(DirectiveFactory):
     @property
     def stream(self):
         if not self._prepared:
-            self._prepare_self()
+            self._prepare_loaded()
         return self._stream
 
     def _parse(self, source, encoding):
@@ -469,11 +475,151 @@ class Template(DirectiveFactory):
         """
         raise NotImplementedError
 
+    def _prepare_loaded(self):
+        """Prepare the template when it is first used, letting the loader
+        that loaded it record the templates inlined into it.
+        """
+        prepare = getattr(self.loader, '_prepare_loaded', None)
+        if prepare is not None:
+            prepare(self)
+        if not self._prepared:
+            self._prepare_self()
+
     def _prepare_self(self, inlined=None):
         if not self._prepared:
-            self._stream = list(self._prepare(self._stream, inlined))
+            stream = self._prepare(self._stream, inlined)
+            if self.filters and self.filters[0] == self._flatten:
+                # Constants can only be folded if no filter needs to see the
+                # expressions and directives before they are evaluated
+                stream = self._fold_constants(stream)
+            self._stream = list(stream)
             self._prepared = True
 
+    def _fold_constants(self, stream, choose=None):
+        """Evaluate the expressions in the prepared stream that do not depend
+        on the context data, and resolve the directives whose effect such
+        expressions determine.
+        
+        Constant expressions are replaced by the text they produce, ``py:if``
+        and ``py:when`` directives with a constant condition are either removed
+        or dropped along with their content, and constant ``py:strip``
+        directives are applied to the content.
+        
+        :param stream: the prepared event stream
+        :param choose: the ``py:choose`` directive that ``py:when`` directives
+                       in the stream belong to, if known
+        :return: the list of events with the constants folded
+        """
+        from genshi.template.directives import AttrsDirective, \
+                                               ChooseDirective, DefDirective, \
+                                               IfDirective, MatchDirective, \
+                                               StripDirective, WhenDirective
+        events = []
+        for kind, data, pos in stream:
+            if kind is START and data[1]:
+                tag, attrs = data
+                new_attrs = []
+                for name, value in attrs:
+                    if type(value) is list: # this is an interpolated string
+                        value = self._fold_constants(value)
+                        if [1 for event in value if event[0] is not TEXT]:
+                            pass
+                        elif value:
+                            value = ''.join([event[1] for event in value])
+                        else:
+                            continue
+                    new_attrs.append((name, value))
+                events.append((kind, (tag, Attrs(new_attrs)), pos))
+
+            elif kind is EXPR:
+                value = self._constant_value(data)
+                if value is _NOT_CONSTANT:
+                    events.append((kind, data, pos))
+                elif isinstance(value, basestring):
+                    events.append((TEXT, value, pos))
+                elif isinstance(value, (int, float, long)):
+                    events.append((TEXT, self._number_conv(value), pos))
+                elif value is not None:
+                    events.append((kind, data, pos))
+
+            elif kind is SUB:
+                directives, substream = data
+                directives = list(directives)
+                idx = 0
+                while idx < len(directives):
+                    directive = directives[idx]
+                    if isinstance(directive, IfDirective):
+                        value = self._constant_value(directive.expr)
+                        if value is not _NOT_CONSTANT:
+                            if not value:
+                                del directives[idx:]
+                                substream = []
+                                break
+                            del directives[idx]
+                            continue
+                    elif isinstance(directive, WhenDirective) and idx == 0:
+                        # A ``py:when`` that can never match produces nothing,
+                        # but only if it is known to be inside a ``py:choose``
+                        value = self._constant_value(directive.expr)
+                        if choose is not None and value is not _NOT_CONSTANT:
+                            if choose.expr is None:
+                                matched = value
+                            else:
+                                test = self._constant_value(choose.expr)
+                                matched = test is _NOT_CONSTANT or \
+                                          test == value
+                            if not matched:
+                                directives, substream = None, []
+                                break
+                    elif isinstance(directive, StripDirective):
+                        if directive.expr is None:
+                            value = True
+                        else:
+                            value = self._constant_value(directive.expr)
+                        if value is not _NOT_CONSTANT and \
+                                substream and substream[0][0] is START and \
+                                substream[-1][0] is END and not \
+                                [1 for d in directives[:idx]
+                                 if isinstance(d, AttrsDirective)]:
+                            if value:
+                                substream = substream[1:-1]
+                            del directives[idx]
+                            continue
+                    idx += 1
+                if directives is None:
+                    continue
+
+                # Determine the ``py:choose`` directive that applies to the
+                # content; functions and match templates are called elsewhere
+                inner = choose
+                for directive in directives:
+                    if isinstance(directive, (DefDirective, MatchDirective)):
+                        inner = None
+                    elif isinstance(directive, ChooseDirective):
+                        inner = directive
+                substream = self._fold_constants(substream, inner)
+                if directives:
+                    events.append((kind, (directives, substream), pos))
+                else:
+                    events.extend(substream)
+
+            else:
+                events.append((kind, data, pos))
+        return events
+
+    def _constant_value(self, expr):
+        """Return the value of the given expression if it is constant, or
+        `_NOT_CONSTANT` otherwise.
+        """
+        if expr is None or not getattr(expr, 'is_constant', None) or \
+                not expr.is_constant():
+            return _NOT_CONSTANT
+        try:
+            return expr.evaluate({})
+        except Exception:
+            # Leave the error to be raised when the template is rendered
+            return _NOT_CONSTANT
+
     def _prepare(self, stream, inlined):
         """Call the `attach` method of every directive found in the template.
         
@@ -503,10 +649,12 @@ class Template(DirectiveFactory):
                     href, cls, fallback = data
                     tmpl_inlined = False
                     if (isinstance(href, basestring) and
-                            not getattr(self.loader, 'auto_reload', True)):
+                            (not getattr(self.loader, 'auto_reload', True) or
+                             getattr(self.loader, 'tracks_includes', False))):
                         # If the path to the included template is static, and
-                        # auto-reloading is disabled on the template loader,
-                        # the template is inlined into the stream provided it
+                        # the template loader either doesn't reload templates
+                        # or reloads them when their includes change, the
+                        # template is inlined into the stream provided it
                         # is not already in the stack of templates being
                         # processed.
                         tmpl = None
@@ -514,7 +662,12 @@ class Template(DirectiveFactory):
                             tmpl = self.loader.load(href, relative_to=pos[0],
                                                     cls=cls or self.__class__)
                         except TemplateNotFound:
-                            if fallback is None:
+                            # A template that is reloaded when it changes
+                            # reports missing includes when it is rendered, as
+                            # they may have been added by then
+                            if fallback is None and \
+                                    not getattr(self.loader, 'auto_reload',
+                                                True):
                                 raise
                         if tmpl is not None:
                             if tmpl.filepath not in inlined:
@@ -524,7 +677,7 @@ class Template(DirectiveFactory):
                                     yield event
                                 inlined.discard(tmpl.filepath)
                                 tmpl_inlined = True
-                        else:
+                        elif fallback is not None:
                             for event in self._prepare(fallback, inlined):
                                 yield event
                             tmpl_inlined = True
@@ -563,6 +716,31 @@ class Template(DirectiveFactory):
         else:
             ctxt = Context(**kwargs)
 
+        return self._execute(ctxt, vars)
+
+    def generate_async(self, **kwargs):
+        """Apply the template to the given context data, for rendering from
+        `asyncio` coroutines.
+        
+        The context data, as well as the results of the expressions in the
+        template, may be awaitables, which are awaited without blocking the
+        event loop.
+        
+        :return: an `AsyncStream` with awaitable ``render()`` and
+                 asynchronously iterable ``iter_encoded()`` methods
+        :see: `genshi.template.asynchronous`
+        :since: version 0.8
+        """
+        from genshi.template.asynchronous import AsyncStream
+        return AsyncStream(self, kwargs)
+
+    def _execute(self, ctxt, vars):
+        """Apply the filters of the template to its prepared stream.
+        
+        :param ctxt: the `Context` to process the template in
+        :param vars: dictionary of additional variables
+        :return: the resulting `Stream`
+        """
         stream = self.stream
         for filter_ in self.filters:
             stream = filter_(iter(stream), ctxt, **vars)
@@ -666,3 +844,5 @@ EXEC = Template.EXEC
 EXPR = Template.EXPR
 INCLUDE = Template.INCLUDE
 SUB = Template.SUB
+
+_NOT_CONSTANT = object() # marks expressions that cannot be folded
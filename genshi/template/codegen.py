@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Compilation of prepared markup templates into Python render functions.
+
+The regular template engine interprets the prepared event stream of a template
+on every render: each event is inspected by the `Template._flatten` filter,
+and every directive wraps the nested stream in another generator. The
+`CompiledMarkupTemplate` class instead translates the prepared stream into the
+source code of a single Python generator function the first time it is
+rendered. Static markup becomes a constant, expressions are evaluated inline,
+and the common control-flow directives (``py:for``, ``py:if``,
+``py:choose``/``py:when``/``py:otherwise``, ``py:with``, ``py:def``,
+``py:attrs`` and ``py:strip``) are turned into plain Python statements.
+
+>>> tmpl = CompiledMarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+...   <li py:for="item in items" py:if="item % 2">${item}</li>
+... </ul>''')
+>>> print(tmpl.generate(items=range(5)))
+<ul>
+  <li>1</li><li>3</li>
+</ul>
+
+The generated function yields the same markup events as the interpreted
+engine, so match templates, includes and serialization work exactly as they
+do for a `MarkupTemplate`. Directives the compiler does not know about (such as
+``py:match`` or the i18n directives) are applied through the regular directive
+machinery at render time.
+"""
+
+from genshi.core import Attrs, START, TEXT, _ensure
+from genshi.template.base import EXEC, EXPR, SUB, _apply_directives, \
+                                 _eval_expr, _exec_suite
+from genshi.template.directives import AttrsDirective, ChooseDirective, \
+                                       DefDirective, ForDirective, \
+                                       IfDirective, OtherwiseDirective, \
+                                       StripDirective, WhenDirective, \
+                                       WithDirective
+from genshi.template.markup import MarkupTemplate, _ChunkedStream
+
+__all__ = ['CompiledMarkupTemplate', 'StreamCompiler']
+__docformat__ = 'restructuredtext en'
+
+
+class StreamCompiler(object):
+    """Generates a Python generator function from the prepared event stream
+    of a template.
+
+    The generated function takes a `Context` and a dictionary of additional
+    variables, and produces the same events that the `Template._flatten`
+    filter would produce for the stream.
+    """
+
+    def __init__(self, template):
+        """Create the compiler.
+
+        :param template: the template whose prepared stream should be compiled
+        """
+        self.template = template
+        self.lines = []
+        self.names = {}
+        self.serial = 0
+        self.yields = 0
+        self.handlers = {
+            AttrsDirective: self._attrs,
+            ChooseDirective: self._choose,
+            DefDirective: self._def,
+            ForDirective: self._for,
+            IfDirective: self._if,
+            OtherwiseDirective: self._choice,
+            StripDirective: self._strip,
+            WhenDirective: self._choice,
+            WithDirective: self._with
+        }
+
+    def compile(self):
+        """Compile the template and return the render function.
+
+        :return: a generator function accepting a `Context` and a dictionary
+                 of variables
+        :raise SyntaxError: if the generated code can not be compiled by
+                            Python, for example because the template nests
+                            too many loops
+        """
+        namespace = self._namespace()
+        stream = self.template._chunked_stream()
+        if stream is None:
+            stream = self.template.stream
+        self._function('_render', stream, (), 0)
+        source = '\n'.join(self.lines) + '\n'
+        filename = '<compiled %s>' % (self.template.filepath or 'template')
+        code = compile(source, filename, 'exec')
+        for value, name in self.names.values():
+            namespace[name] = value
+        exec code in namespace
+        return namespace['_render']
+
+    def _namespace(self):
+        template = self.template
+        number_conv = template._number_conv
+        flatten = template._flatten
+
+        def _text_values(result, ctxt, vars):
+            # Handles the expression results in interpolated attribute values
+            # that are not strings
+            if isinstance(result, (int, float, long)):
+                return [number_conv(result)]
+            elif hasattr(result, '__iter__'):
+                return [event[1] for event
+                        in flatten(_ensure(result), ctxt, **vars)
+                        if event[0] is TEXT and event[1] is not None]
+            return [unicode(result)]
+
+        return {
+            '_Attrs': Attrs, '_START': START, '_TEXT': TEXT,
+            '_apply': _apply_directives, '_conv': number_conv,
+            '_ensure': _ensure, '_eval': _eval_expr, '_exec': _exec_suite,
+            '_flatten': flatten, '_iter': iter, '_numbers': (int, float, long),
+            '_strings': basestring, '_text_values': _text_values,
+            '_unicode': unicode
+        }
+
+    def _const(self, value):
+        """Return the name under which the given object will be available to
+        the generated code.
+        """
+        key = id(value)
+        if key not in self.names:
+            self.names[key] = (value, '_c%d' % len(self.names))
+        return self.names[key][1]
+
+    def _unique(self, prefix):
+        self.serial += 1
+        return '%s%d' % (prefix, self.serial)
+
+    def _emit(self, level, line):
+        if line.startswith('yield '):
+            self.yields += 1
+        self.lines.append('    ' * level + line)
+
+    def _function(self, name, stream, directives, level):
+        outer_yields, self.yields = self.yields, 0
+        self._emit(level, 'def %s(_ctxt, _vars):' % name)
+        self._apply(list(directives), list(stream), level + 1)
+        if not self.yields:
+            # Make sure the function is a generator even if the stream
+            # produces no output
+            self._emit(level + 1, 'if 0:')
+            self._emit(level + 2, 'yield None')
+        self.yields = outer_yields
+
+    def _stream(self, stream, level):
+        static = []
+        for event in stream:
+            kind, data, pos = event
+            if kind is EXPR:
+                self._static(static, level)
+                self._expr(data, pos, level)
+            elif kind is SUB:
+                self._static(static, level)
+                self._sub(data[0], data[1], level)
+            elif kind is EXEC:
+                self._static(static, level)
+                self._emit(level, '_exec(%s, _ctxt, _vars)' %
+                           self._const(data))
+            elif kind is START and [1 for _, value in data[1]
+                                    if type(value) is list]:
+                self._static(static, level)
+                self._start(data, pos, level)
+            else:
+                static.append(event)
+        self._static(static, level)
+
+    def _static(self, events, level):
+        if len(events) == 1:
+            self._emit(level, 'yield %s' % self._const(events[0]))
+        elif events:
+            self._emit(level, 'for _e in %s:' % self._const(tuple(events)))
+            self._emit(level + 1, 'yield _e')
+        del events[:]
+
+    def _expr(self, expr, pos, level):
+        pos = self._const(pos)
+        self._emit(level, '_r = _eval(%s, _ctxt, _vars)' % self._const(expr))
+        self._emit(level, 'if _r is not None:')
+        self._emit(level + 1, 'if isinstance(_r, _strings):')
+        self._emit(level + 2, 'yield _TEXT, _r, %s' % pos)
+        self._emit(level + 1, 'elif isinstance(_r, _numbers):')
+        self._emit(level + 2, 'yield _TEXT, _conv(_r), %s' % pos)
+        self._emit(level + 1, "elif hasattr(_r, '__iter__'):")
+        self._emit(level + 2, 'for _e in _flatten(_ensure(_r), _ctxt, '
+                              '**_vars):')
+        self._emit(level + 3, 'yield _e')
+        self._emit(level + 1, 'else:')
+        self._emit(level + 2, 'yield _TEXT, _unicode(_r), %s' % pos)
+
+    def _start(self, data, pos, level):
+        tag, attrs = data
+        self._emit(level, '_a = []')
+        for name, value in attrs:
+            if type(value) is not list:
+                self._emit(level, '_a.append((%s, %s))' % (self._const(name),
+                                                          self._const(value)))
+                continue
+            # This is an interpolated attribute value; the attribute is
+            # dropped if none of the parts produces any text
+            self._emit(level, '_l = []')
+            for kind, part, _ in value:
+                if kind is TEXT:
+                    self._emit(level, '_l.append(%s)' % self._const(part))
+                elif kind is EXPR:
+                    self._emit(level, '_r = _eval(%s, _ctxt, _vars)' %
+                               self._const(part))
+                    self._emit(level, 'if _r is not None:')
+                    self._emit(level + 1, 'if isinstance(_r, _strings):')
+                    self._emit(level + 2, '_l.append(_r)')
+                    self._emit(level + 1, 'else:')
+                    self._emit(level + 2, '_l.extend(_text_values(_r, _ctxt, '
+                                          '_vars))')
+            self._emit(level, 'if _l:')
+            self._emit(level + 1, "_a.append((%s, ''.join(_l)))" %
+                       self._const(name))
+        self._emit(level, 'yield _START, (%s, _Attrs(_a)), %s' % (
+                   self._const(tag), self._const(pos)))
+
+    def _sub(self, directives, substream, level):
+        if self._compilable(directives, substream):
+            self._apply(list(directives), list(substream), level)
+        else:
+            self._emit(level, 'for _e in _flatten(_apply(%s, %s, _ctxt, '
+                              '_vars), _ctxt, **_vars):' % (
+                              self._const(substream), self._const(directives)))
+            self._emit(level + 1, 'yield _e')
+
+    def _compilable(self, directives, substream):
+        types = [type(directive) for directive in directives]
+        for cls in types:
+            if cls not in self.handlers:
+                return False
+        if AttrsDirective in types:
+            # The directive modifies the start tag of the element, so it must
+            # be the last directive, and it can't be combined with stripping
+            if types[-1] is not AttrsDirective or StripDirective in types:
+                return False
+            if not substream or substream[0][0] is not START:
+                return False
+        if StripDirective in types:
+            if types[-1] is not StripDirective or len(substream) < 2:
+                return False
+        return True
+
+    def _apply(self, directives, stream, level):
+        if directives:
+            directive = directives[0]
+            self.handlers[type(directive)](directive, directives[1:], stream,
+                                           level)
+        else:
+            self._stream(stream, level)
+
+    def _attrs(self, directive, directives, stream, level):
+        self._emit(level, 'for _e in _flatten(%s(_iter(%s), (), _ctxt, '
+                          '**_vars), _ctxt, **_vars):' % (
+                          self._const(directive), self._const(stream[:1])))
+        self._emit(level + 1, 'yield _e')
+        self._stream(stream[1:], level)
+
+    def _choice(self, directive, directives, stream, level):
+        # The "when" and "otherwise" directives are called with an empty list
+        # of nested directives, in which case they return the stream passed in
+        # if their branch is selected, and an empty list otherwise
+        self._emit(level, 'if %s(_iter(%s), (), _ctxt, **_vars):' % (
+                   self._const(directive), self._const(stream)))
+        self._apply(directives, stream, level + 1)
+
+    def _choose(self, directive, directives, stream, level):
+        if directive.expr:
+            self._emit(level, '_ctxt._choice_stack.append([False, True, '
+                              '_eval(%s, _ctxt, _vars)])' %
+                       self._const(directive.expr))
+        else:
+            self._emit(level, '_ctxt._choice_stack.append([False, False, '
+                              'None])')
+        self._apply(directives, stream, level)
+        self._emit(level, '_ctxt._choice_stack.pop()')
+
+    def _def(self, directive, directives, stream, level):
+        name = self._unique('_f')
+        self._function(name, stream, directives, level)
+        self._emit(level, '%s._define(_ctxt, _vars, %s)' % (
+                   self._const(directive), name))
+
+    def _for(self, directive, directives, stream, level):
+        iterable, scope, item = [self._unique(prefix) for prefix
+                                 in ('_i', '_s', '_v')]
+        self._emit(level, '%s = %s._iterate(_ctxt, _vars)' % (iterable,
+                   self._const(directive)))
+        self._emit(level, 'if %s is not None:' % iterable)
+        self._emit(level + 1, '%s = {}' % scope)
+        self._emit(level + 1, 'for %s in %s:' % (item, iterable))
+        self._emit(level + 2, '%s(%s, %s)' % (self._const(directive.assign),
+                                              scope, item))
+        self._emit(level + 2, '_ctxt.push(%s)' % scope)
+        self._apply(directives, stream, level + 2)
+        self._emit(level + 2, '_ctxt.pop()')
+
+    def _if(self, directive, directives, stream, level):
+        self._emit(level, 'if _eval(%s, _ctxt, _vars):' %
+                   self._const(directive.expr))
+        self._apply(directives, stream, level + 1)
+
+    def _strip(self, directive, directives, stream, level):
+        if not directive.expr:
+            self._apply(directives, stream[1:-1], level)
+            return
+        strip = self._unique('_t')
+        self._emit(level, '%s = _eval(%s, _ctxt, _vars)' % (strip,
+                   self._const(directive.expr)))
+        self._emit(level, 'if not %s:' % strip)
+        self._stream(stream[:1], level + 1)
+        self._apply(directives, stream[1:-1], level)
+        self._emit(level, 'if not %s:' % strip)
+        self._stream(stream[-1:], level + 1)
+
+    def _with(self, directive, directives, stream, level):
+        frame = self._unique('_w')
+        self._emit(level, '%s = {}' % frame)
+        self._emit(level, '_ctxt.push(%s)' % frame)
+        for targets, expr in directive.vars:
+            self._emit(level, '_r = _eval(%s, _ctxt, _vars)' %
+                       self._const(expr))
+            for assign in targets:
+                self._emit(level, '%s(%s, _r)' % (self._const(assign), frame))
+        self._apply(directives, stream, level)
+        self._emit(level, '_ctxt.pop()')
+
+
+class CompiledMarkupTemplate(MarkupTemplate):
+    """Implementation of the markup template language that compiles the
+    template into a Python function instead of interpreting the event stream.
+
+    The template language and the generated output are the same as for the
+    `MarkupTemplate` class, so this class can simply be used instead of it,
+    for example by passing it as the `default_class` of a `TemplateLoader`:
+
+    >>> from genshi.template import TemplateLoader
+    >>> loader = TemplateLoader(default_class=CompiledMarkupTemplate)
+
+    The template is compiled the first time it is rendered. If the filters of
+    the template have been changed (for example by the i18n `Translator`), the
+    template is processed by the regular interpreter.
+    """
+
+    _render = None
+
+    def __getstate__(self):
+        state = MarkupTemplate.__getstate__(self)
+        state.pop('_render', None)
+        return state
+
+    def _compile(self):
+        try:
+            self._render = StreamCompiler(self).compile()
+        except SyntaxError:
+            # Python refuses the generated code, for example because of too
+            # many nested loops, so fall back to the interpreter
+            self._render = False
+        return self._render
+
+    def _execute(self, ctxt, vars):
+        render = self._render
+        if render is None:
+            render = self._compile()
+        if not render or self._chunked_stream() is None:
+            return MarkupTemplate._execute(self, ctxt, vars)
+
+        stream = render(ctxt, vars)
+        for filter_ in self.filters[1:]:
+            stream = filter_(iter(stream), ctxt, **vars)
+        return _ChunkedStream(stream, self.serializer)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Command-line tool for precompiling templates into the disk cache of a
+`TemplateLoader`.
+
+The tool loads every template found on a search path through a loader with a
+``cache_dir``, so that the prepared templates are written to that directory.
+Applications using a loader with the same search path, options and cache
+directory can then load the templates without parsing or compiling them::
+
+  python -m genshi.template.compile -d /var/cache/myapp templates/
+
+The search path can contain directories, package resources (specified as
+``package:NAME:PATH``), and prefixed delegations (``PREFIX=SPEC``, where
+``SPEC`` is one of the former); all prefixed entries are combined into a
+single `prefixed` load function. Alternatively, the ``--loader`` option names
+a function that returns the `TemplateLoader` instance configured by the
+application, for example ``myapp.templating:create_loader``.
+
+The ``-j`` option compiles the templates in the given number of parallel
+processes. The compile time of every template is printed. Templates that fail to load
+(for example because of syntax errors) are reported, and make the tool exit
+with a non-zero status, so it can also be used as a pre-deployment check.
+
+Note that cache entries are tied to the absolute paths of the template files
+and to the Python version, so the cache should be built with the templates
+installed at the same location and with the same Python interpreter as used
+by the application.
+"""
+
+from fnmatch import fnmatch
+from optparse import OptionParser
+import sys
+
+from genshi.template.loader import TemplateLoader, directory, package, \
+                                   prefixed
+
+__all__ = ['compile_templates', 'main']
+__docformat__ = 'restructuredtext en'
+
+
+def compile_templates(loader, names=None, patterns=None, cls=None,
+                      encoding=None):
+    """Load templates through the given loader, so that they are stored in
+    its disk cache.
+
+    :param loader: the `TemplateLoader` to use; it should have a ``cache_dir``
+    :param names: the names of the templates to compile; by default, all the
+                  templates on the search path of the loader
+    :param patterns: a list of shell-style wildcard patterns; if specified,
+                     only templates with names matching any of the patterns are
+                     compiled
+    :param cls: the template class to use
+    :param encoding: the encoding of the template files
+    :return: an iterator over ``(name, seconds, error)`` tuples, where
+             ``error`` is ``None`` if the template was compiled successfully,
+             and the exception otherwise
+    """
+    if names is None:
+        names = loader.list_templates()
+    for name in names:
+        if patterns and not [1 for pattern in patterns if fnmatch(name,
+                                                                  pattern)]:
+            continue
+        seconds, error = loader._preload(name, cls=cls, encoding=encoding)
+        yield name, seconds, error
+
+
+def _import(name):
+    """Import the object with the given name, which can be specified as
+    ``module:attribute`` or ``module.attribute``.
+    """
+    if ':' in name:
+        modname, attrname = name.split(':', 1)
+    else:
+        modname, attrname = name.rsplit('.', 1)
+    module = __import__(modname, {}, {}, [attrname])
+    obj = module
+    for part in attrname.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+def _search_path(args):
+    search_path = []
+    delegates = {}
+    for arg in args:
+        prefix = None
+        if '=' in arg:
+            prefix, arg = arg.split('=', 1)
+        if arg.startswith('package:'):
+            name, path = arg[8:].split(':', 1)
+            loadfunc = package(name, path)
+        else:
+            loadfunc = directory(arg)
+        if prefix is None:
+            search_path.append(loadfunc)
+        else:
+            if not delegates:
+                search_path.append(None)
+            delegates[prefix] = loadfunc
+    if delegates:
+        search_path[search_path.index(None)] = prefixed(**delegates)
+    return search_path
+
+
+def main(args=None):
+    """Entry point of the command-line tool.
+
+    :param args: the command-line arguments, excluding the program name;
+                 defaults to ``sys.argv[1:]``
+    :return: the exit status: 0 if all templates were compiled successfully,
+             1 if some of them failed, and 2 for usage errors
+    """
+    parser = OptionParser(usage='python -m genshi.template.compile '
+                                '[options] [search_path...]',
+                          description='Precompile templates into the disk '
+                                      'cache of the template loader.')
+    parser.add_option('-d', '--cache-dir', dest='cache_dir',
+                      help='the directory to store the compiled templates in')
+    parser.add_option('-l', '--loader', dest='loader', metavar='FUNCTION',
+                      help='a function returning the template loader to use, '
+                           'given as "module:function"')
+    parser.add_option('-p', '--pattern', dest='patterns', action='append',
+                      metavar='PATTERN',
+                      help='only compile templates matching the given '
+                           'wildcard pattern (may be repeated)')
+    parser.add_option('-c', '--class', dest='cls', metavar='CLASS',
+                      help='the template class to use, given as '
+                           '"module:class" (default: MarkupTemplate)')
+    parser.add_option('-e', '--encoding', dest='encoding',
+                      help='the encoding of the template files')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='the number of processes to compile the templates '
+                           'in (default: 1)')
+    parser.add_option('--auto-reload', dest='auto_reload',
+                      action='store_true', default=False,
+                      help='compile for a loader with auto_reload enabled')
+    parser.add_option('--lookup', dest='lookup', default='strict',
+                      help='the variable lookup mode: "strict", "lenient", '
+                           'or the name of a lookup class')
+    parser.add_option('--no-exec', dest='allow_exec', action='store_false',
+                      default=True,
+                      help='compile for a loader that disallows Python code '
+                           'blocks')
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true',
+                      default=False,
+                      help='only report templates that failed to compile')
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+
+    try:
+        cls = options.cls and _import(options.cls) or None
+        if options.loader:
+            loader = _import(options.loader)
+            if not isinstance(loader, TemplateLoader):
+                loader = loader()
+            if options.cache_dir:
+                loader.cache_dir = options.cache_dir
+        else:
+            lookup = options.lookup
+            if lookup not in ('strict', 'lenient'):
+                lookup = _import(lookup)
+            loader = TemplateLoader(_search_path(args),
+                                    auto_reload=options.auto_reload,
+                                    variable_lookup=lookup,
+                                    allow_exec=options.allow_exec,
+                                    default_class=cls,
+                                    cache_dir=options.cache_dir)
+    except (ImportError, AttributeError, ValueError), e:
+        parser.error(str(e))
+    if not loader.search_path:
+        parser.error('no search path specified')
+    if not loader.cache_dir:
+        parser.error('no cache directory specified')
+
+    if options.jobs > 1:
+        results = loader.preload(options.patterns, workers=options.jobs,
+                                 processes=True, cls=cls,
+                                 encoding=options.encoding)
+    else:
+        results = compile_templates(loader, patterns=options.patterns,
+                                    cls=cls, encoding=options.encoding)
+
+    count = failed = 0
+    total = 0.0
+    for name, seconds, error in results:
+        count += 1
+        total += seconds
+        if error is not None:
+            failed += 1
+            sys.stderr.write('error: %s: %s\n' % (name, error))
+        elif not options.quiet:
+            sys.stdout.write('%10.2f ms  %s\n' % (seconds * 1000, name))
+
+    if not options.quiet:
+        sys.stdout.write('%d templates compiled in %.2f ms, %d failed\n' % (
+                         count - failed, total * 1000, failed))
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
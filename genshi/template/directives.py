@@ -13,6 +13,16 @@
 
 """Implementation of the various template directives."""
 
+import sys
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 from genshi.core import QName, Stream
 from genshi.path import Path
 from genshi.template.base import TemplateRuntimeError, TemplateSyntaxError, \
@@ -22,8 +32,8 @@ from genshi.template.eval import Expression, ExpressionASTTransformer, \
 
 __all__ = ['AttrsDirective', 'ChooseDirective', 'ContentDirective',
            'DefDirective', 'ForDirective', 'IfDirective', 'MatchDirective',
-           'OtherwiseDirective', 'ReplaceDirective', 'StripDirective',
-           'WhenDirective', 'WithDirective']
+           'OtherwiseDirective', 'PrefetchDirective', 'ReplaceDirective',
+           'StripDirective', 'WhenDirective', 'WithDirective']
 __docformat__ = 'restructuredtext en'
 
 
@@ -124,13 +134,29 @@ def _assignment(ast):
             return tuple([_names(child) for child in node.elts])
         elif isinstance(node, _ast.Name):
             return node.id
-    def _assign(data, value, names=_names(ast)):
+    return _Assignment(_names(ast))
+
+
+class _Assignment(object):
+    """Callable that assigns a value to a name, or unpacks it to a (possibly
+    nested) tuple of names, in a dictionary.
+    
+    This is used instead of a closure so that directives using assignments
+    can be pickled along with the template.
+    """
+    __slots__ = ['names']
+
+    def __init__(self, names):
+        self.names = names
+
+    def __call__(self, data, value, names=None):
+        if names is None:
+            names = self.names
         if type(names) is tuple:
             for idx in range(len(names)):
-                _assign(data, value[idx], names[idx])
+                self(data, value[idx], names[idx])
         else:
             data[names] = value
-    return _assign
 
 
 class AttrsDirective(Directive):
@@ -290,6 +316,19 @@ class DefDirective(Directive):
     def __call__(self, stream, directives, ctxt, **vars):
         stream = list(stream)
 
+        def body(ctxt, vars):
+            return _apply_directives(stream, directives, ctxt, vars)
+        self._define(ctxt, vars, body)
+        return []
+
+    def _define(self, ctxt, vars, body):
+        """Make the function available in the context.
+        
+        :param ctxt: the `Context` in which the function is defined
+        :param vars: additional variables available to the function body
+        :param body: a callable that is called with the context and the
+                     variables and returns the events of the function body
+        """
         def function(*args, **kwargs):
             scope = {}
             args = list(args) # make mutable
@@ -307,7 +346,7 @@ class DefDirective(Directive):
             if not self.dstar_args is None:
                 scope[self.dstar_args] = kwargs
             ctxt.push(scope)
-            for event in _apply_directives(stream, directives, ctxt, vars):
+            for event in body(ctxt, vars):
                 yield event
             ctxt.pop()
         function.__name__ = self.name
@@ -317,8 +356,6 @@ class DefDirective(Directive):
         # FIXME: this makes context data mutable as a side-effect
         ctxt.frames[-1][self.name] = function
 
-        return []
-
     def __repr__(self):
         return '<%s "%s">' % (type(self).__name__, self.name)
 
@@ -336,7 +373,7 @@ class ForDirective(Directive):
       <li>1</li><li>2</li><li>3</li>
     </ul>
     """
-    __slots__ = ['assign', 'filename']
+    __slots__ = ['assign', 'filename', 'iterable']
 
     def __init__(self, value, template, namespaces=None, lineno=-1, offset=-1):
         if ' in ' not in value:
@@ -344,10 +381,14 @@ class ForDirective(Directive):
                                       template.filepath, lineno, offset)
         assign, value = value.split(' in ', 1)
         ast = _parse(assign, 'exec')
-        value = 'iter(%s)' % value.strip()
         self.assign = _assignment(ast.body[0].value)
         self.filename = template.filepath
-        Directive.__init__(self, value, template, namespaces, lineno, offset)
+        # The expression without the call to iter(), for rendering with
+        # asyncio, where the value may be an awaitable (which is not iterable)
+        self.iterable = self._parse_expr(value.strip(), template, lineno,
+                                         offset)
+        Directive.__init__(self, 'iter(%s)' % value.strip(), template,
+                           namespaces, lineno, offset)
 
     @classmethod
     def attach(cls, template, stream, value, namespaces, pos):
@@ -357,7 +398,7 @@ class ForDirective(Directive):
                                                namespaces, pos)
 
     def __call__(self, stream, directives, ctxt, **vars):
-        iterable = _eval_expr(self.expr, ctxt, vars)
+        iterable = self._iterate(ctxt, vars)
         if iterable is None:
             return
 
@@ -374,6 +415,12 @@ class ForDirective(Directive):
     def __repr__(self):
         return '<%s>' % type(self).__name__
 
+    def _iterate(self, ctxt, vars):
+        """Return an iterator over the iterable the directive refers to."""
+        if ctxt._awaiter is not None:
+            return iter(_eval_expr(self.iterable, ctxt, vars))
+        return _eval_expr(self.expr, ctxt, vars)
+
 
 class IfDirective(Directive):
     """Implementation of the ``py:if`` template directive for conditionally
@@ -448,6 +495,7 @@ class MatchDirective(Directive):
         ctxt._match_templates.append((self.path.test(ignore_context=True),
                                       self.path, list(stream), self.hints,
                                       self.namespaces, directives))
+        ctxt._match_index = None
         return []
 
     def __repr__(self):
@@ -724,3 +772,174 @@ class WithDirective(Directive):
 
     def __repr__(self):
         return '<%s>' % (type(self).__name__)
+
+
+class PrefetchDirective(WithDirective):
+    """Implementation of the ``py:prefetch`` template directive, which works
+    like ``py:with``, except that the expressions are evaluated concurrently
+    in a pool of threads.
+    
+    >>> from genshi.template import MarkupTemplate
+    >>> tmpl = MarkupTemplate('''<div xmlns:py="http://genshi.edgewall.org/">
+    ...   <span py:prefetch="y=x*2; z=x+10">$x $y $z</span>
+    ... </div>''')
+    >>> print(tmpl.generate(x=42))
+    <div>
+      <span>42 84 52</span>
+    </div>
+    
+    This is meant for expressions that spend most of their time waiting, such
+    as calls to slow backend services: the content of the element is rendered
+    once all expressions have been evaluated, which takes as long as the
+    slowest of them rather than the sum of their durations. The first
+    expression is evaluated in the rendering thread, the others are submitted
+    to the `executor`.
+    
+    As the expressions are evaluated at the same time, they cannot refer to
+    the variables defined by each other, which is reported as a syntax error,
+    and they must not depend on state local to the rendering thread. When
+    an expression renders another template using ``py:prefetch`` while it is
+    evaluated by the executor, the expressions of that directive are
+    evaluated one after the other, as waiting for the threads of the same
+    executor could deadlock.
+    
+    :since: version 0.8
+    """
+    __slots__ = []
+
+    executor = None
+    """The executor evaluating the expressions, which must have a ``submit()``
+    method like the executors of the ``concurrent.futures`` module. If not
+    set, a ``ThreadPoolExecutor`` with `max_workers` threads is created when
+    first needed, or a thread is started for every expression if the
+    ``concurrent.futures`` module is not available."""
+
+    max_workers = 10
+    """The number of threads of the default executor."""
+
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    def __init__(self, value, template, namespaces=None, lineno=-1, offset=-1):
+        WithDirective.__init__(self, value, template, namespaces, lineno,
+                               offset)
+        assigned = set()
+        for targets, expr in self.vars:
+            for name in _used_names(expr.ast):
+                if name in assigned:
+                    raise TemplateSyntaxError('variable "%s" of "%s" '
+                                              'directive used in the same '
+                                              'directive' % (name,
+                                                             self.tagname),
+                                              template.filepath, lineno,
+                                              offset)
+            for assign in targets:
+                assigned.update(_flatten_names(assign.names))
+
+    def __call__(self, stream, directives, ctxt, **vars):
+        exprs = [expr for targets, expr in self.vars]
+        if vars:
+            ctxt.push(vars)
+        try:
+            if len(exprs) > 1 and not getattr(self._local, 'nested', False):
+                executor = self.executor or self._default_executor()
+                futures = [executor.submit(_eval_nested, expr, ctxt)
+                           for expr in exprs[1:]]
+                values = [_eval_expr(exprs[0], ctxt)]
+                values.extend([future.result() for future in futures])
+            else:
+                values = [_eval_expr(expr, ctxt) for expr in exprs]
+        finally:
+            if vars:
+                ctxt.pop()
+
+        frame = {}
+        for (targets, expr), value in zip(self.vars, values):
+            for assign in targets:
+                assign(frame, value)
+        ctxt.push(frame)
+        for event in _apply_directives(stream, directives, ctxt, vars):
+            yield event
+        ctxt.pop()
+
+    @classmethod
+    def _default_executor(cls):
+        cls._lock.acquire()
+        try:
+            if PrefetchDirective.executor is None:
+                if ThreadPoolExecutor is not None:
+                    executor = ThreadPoolExecutor(cls.max_workers)
+                else:
+                    executor = _ThreadExecutor()
+                PrefetchDirective.executor = executor
+            return PrefetchDirective.executor
+        finally:
+            cls._lock.release()
+
+
+def _eval_nested(expr, ctxt):
+    """Evaluate an expression of a `PrefetchDirective` in a thread of the
+    executor, where other such directives evaluate their expressions in the
+    same thread.
+    """
+    local = PrefetchDirective._local
+    nested = getattr(local, 'nested', False)
+    local.nested = True
+    try:
+        return _eval_expr(expr, ctxt)
+    finally:
+        local.nested = nested
+
+
+def _flatten_names(names):
+    """Return the names assigned by an `_Assignment` as a list."""
+    if type(names) is tuple:
+        return sum([_flatten_names(child) for child in names], [])
+    return [names]
+
+
+def _used_names(node):
+    """Return the names of the variables used in the given AST node."""
+    if isinstance(node, _ast.Name):
+        return [node.id]
+    names = []
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if not isinstance(value, list):
+            value = [value]
+        for child in value:
+            if isinstance(child, _ast.AST):
+                names += _used_names(child)
+    return names
+
+
+class _ThreadExecutor(object):
+    """Stand-in for ``concurrent.futures.ThreadPoolExecutor`` that starts a
+    thread for every call."""
+
+    def submit(self, func, *args):
+        future = _ThreadFuture(func, args)
+        future.start()
+        return future
+
+
+class _ThreadFuture(threading.Thread):
+
+    def __init__(self, func, args):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.func = func
+        self.args = args
+        self.value = self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
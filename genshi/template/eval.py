@@ -14,18 +14,17 @@
 """Support for "safe" evaluation of Python expressions."""
 
 import __builtin__
+import marshal
 
 from textwrap import dedent
-from types import CodeType
 
 from genshi.core import Markup
 from genshi.template.astutil import ASTTransformer, ASTCodeGenerator, \
                                     _ast, parse
-from genshi.template.base import TemplateRuntimeError
+from genshi.template.base import Context, TemplateRuntimeError
 from genshi.util import flatten
 
-from genshi.compat import get_code_params, build_code_chunk, isstring, \
-                          IS_PYTHON2
+from genshi.compat import build_code_chunk, isstring, IS_PYTHON2
 
 __all__ = ['Code', 'Expression', 'Suite', 'LenientLookup', 'StrictLookup',
            'Undefined', 'UndefinedError']
@@ -101,13 +100,13 @@ class Code(object):
     def __getstate__(self):
         state = {'source': self.source, 'ast': self.ast,
                  'lookup': self._globals.im_self}
-        state['code'] = get_code_params(self.code)
+        state['code'] = marshal.dumps(self.code)
         return state
 
     def __setstate__(self, state):
         self.source = state['source']
         self.ast = state['ast']
-        self.code = CodeType(0, *state['code'])
+        self.code = marshal.loads(state['code'])
         self._globals = state['lookup'].globals
 
     def __eq__(self, other):
@@ -164,9 +163,28 @@ class Expression(Code):
     >>> Expression('len(items)').evaluate(data)
     3
     """
-    __slots__ = []
+    __slots__ = ['_chain']
     mode = 'eval'
 
+    def __init__(self, source, filename=None, lineno=-1, lookup='strict',
+                 xform=None):
+        Code.__init__(self, source, filename=filename, lineno=lineno,
+                      lookup=lookup, xform=xform)
+        self._chain = None
+        if xform is None:
+            # Expressions that just look up a variable, optionally followed by
+            # attribute accesses, are evaluated without the compiled code
+            self._chain = _name_chain(self.ast.body)
+
+    def __getstate__(self):
+        state = Code.__getstate__(self)
+        state['chain'] = self._chain
+        return state
+
+    def __setstate__(self, state):
+        Code.__setstate__(self, state)
+        self._chain = state.get('chain')
+
     def evaluate(self, data):
         """Evaluate the expression against the given data dictionary.
         
@@ -174,8 +192,40 @@ class Expression(Code):
         :return: the result of the evaluation
         """
         __traceback_hide__ = 'before_and_this'
-        _globals = self._globals(data)
-        return eval(self.code, _globals, {'__data__': data})
+        try:
+            if self._chain is not None:
+                lookup = self._globals.im_self
+                name, attrs = self._chain
+                value = lookup.lookup_name(data, name)
+                for attr in attrs:
+                    value = lookup.lookup_attr(value, attr)
+                return value
+            _globals = self._globals(data)
+            return eval(self.code, _globals, {'__data__': data})
+        except UndefinedError, e:
+            # As the compiled code is not run for variable lookups, the
+            # traceback may not point to the expression in the template
+            if e.lineno < 0:
+                e._locate(self.code.co_filename, self.code.co_firstlineno)
+            raise
+
+    def is_constant(self):
+        """Return whether the expression only consists of literals and
+        operators, so that its value does not depend on the data it is
+        evaluated against.
+        
+        >>> Expression('(1 + 2) * 3').is_constant()
+        True
+        >>> Expression('not True and "foo" or None').is_constant()
+        True
+        >>> Expression('x + 1').is_constant()
+        False
+        >>> Expression('len("foo")').is_constant()
+        False
+        
+        :return: `True` if the expression is constant, `False` otherwise
+        """
+        return _is_constant(self.ast)
 
 
 class Suite(Code):
@@ -215,6 +265,13 @@ class UndefinedError(TemplateRuntimeError):
             message = '"%s" not defined' % name
         TemplateRuntimeError.__init__(self, message)
 
+    def _locate(self, filename, lineno):
+        """Set the location of the expression that raised the error."""
+        self.filename = filename
+        self.lineno = lineno
+        if filename != '<string>':
+            self.args = ('%s (%s, line %d)' % (self.msg, filename, lineno),)
+
 
 class Undefined(object):
     """Represents a reference to an undefined variable.
@@ -291,8 +348,18 @@ class LookupBase(object):
     def globals(cls, data):
         """Construct the globals dictionary to use as the execution context for
         the expression or suite.
+        
+        If the data is a `Context`, the dictionary is only constructed once and
+        stored in the context, so that all the code evaluated while processing
+        a template shares it.
         """
-        return {
+        cache = None
+        if isinstance(data, Context):
+            cache = data._globals
+            _globals = cache.get(cls)
+            if _globals is not None:
+                return _globals
+        _globals = {
             '__data__': data,
             '_lookup_name': cls.lookup_name,
             '_lookup_attr': cls.lookup_attr,
@@ -300,6 +367,9 @@ class LookupBase(object):
             '_star_import_patch': _star_import_patch,
             'UndefinedError': UndefinedError,
         }
+        if cache is not None:
+            cache[cls] = _globals
+        return _globals
 
     @classmethod
     def lookup_name(cls, data, name):
@@ -487,6 +557,35 @@ BUILTINS = __builtin__.__dict__.copy()
 BUILTINS.update({'Markup': Markup, 'Undefined': Undefined})
 CONSTANTS = frozenset(['False', 'True', 'None', 'NotImplemented', 'Ellipsis'])
 
+# AST node types that may appear in constant expressions
+_CONSTANT_NODES = tuple([getattr(_ast, name) for name in (
+    'Expression', 'Num', 'Str', 'Bytes', 'NameConstant', 'Constant', 'Tuple',
+    'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp', 'operator', 'unaryop',
+    'boolop', 'cmpop', 'expr_context'
+) if hasattr(_ast, name)])
+
+def _name_chain(node):
+    attrs = []
+    while isinstance(node, _ast.Attribute):
+        attrs.insert(0, node.attr)
+        node = node.value
+    if isinstance(node, _ast.Name) and node.id not in CONSTANTS:
+        return node.id, tuple(attrs)
+
+def _is_constant(node):
+    if isinstance(node, _ast.Name):
+        return node.id in ('False', 'True', 'None')
+    if not isinstance(node, _CONSTANT_NODES):
+        return False
+    for name in node._fields:
+        value = getattr(node, name, None)
+        if not isinstance(value, list):
+            value = [value]
+        for child in value:
+            if isinstance(child, _ast.AST) and not _is_constant(child):
+                return False
+    return True
+
 
 class TemplateASTTransformer(ASTTransformer):
     """Concrete AST transformer that implements the AST transformations needed
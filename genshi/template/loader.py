@@ -13,17 +13,33 @@
 
 """Template loading and caching."""
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from fnmatch import fnmatch
 import os
+import sys
+import tempfile
+import time
+from weakref import WeakKeyDictionary
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
 
-from genshi.template.base import TemplateError
+from genshi import __version__, stats
+from genshi.compat import BytesIO, StringIO
+from genshi.template.base import TemplateError, INCLUDE, SUB
 from genshi.util import LRUCache
 
-__all__ = ['TemplateLoader', 'TemplateNotFound', 'directory', 'package',
-           'prefixed']
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+__all__ = ['TemplateLoader', 'TemplateNotFound', 'directory', 'event_count',
+           'package', 'prefixed']
 __docformat__ = 'restructuredtext en'
 
 
@@ -72,13 +88,35 @@ class TemplateLoader(object):
     
     The `auto_reload` option can be used to control whether a template should
     be automatically reloaded when the file it was loaded from has been
-    changed. Disable this automatic reloading to improve performance.
+    changed. Disable this automatic reloading to improve performance, or
+    limit its cost using the `reload_interval` and `reload_watcher` options.
     
     >>> os.remove(path)
+    
+    If a `cache_dir` is specified, templates are also cached on disk, in a
+    prepared form that can be loaded without parsing the template source or
+    compiling the expressions it contains. This cache is shared between loader
+    instances and processes using the same directory, and entries are
+    invalidated automatically when the template source (or the source of a
+    template it includes) changes.
+    
+    A loader can be shared by multiple threads. Returning a cached template
+    does not require any locking, and templates that are not cached yet are
+    loaded concurrently, except that threads requesting the same template
+    wait for the one thread that is loading it, so that each template is
+    parsed only once.
     """
+
+    tracks_includes = True
+    """Whether the loader reloads a template when a template that has been
+    inlined into it changes, so that static includes can be inlined even if
+    `auto_reload` is enabled."""
+
     def __init__(self, search_path=None, auto_reload=False,
                  default_encoding=None, max_cache_size=25, default_class=None,
-                 variable_lookup='strict', allow_exec=True, callback=None):
+                 variable_lookup='strict', allow_exec=True, callback=None,
+                 cache_dir=None, reload_interval=0, reload_watcher=None,
+                 cache_weight=None):
         """Create the template laoder.
         
         :param search_path: a list of absolute path names that should be
@@ -92,7 +130,8 @@ class TemplateLoader(object):
         :param default_encoding: the default encoding to assume when loading
                                  templates; defaults to UTF-8
         :param max_cache_size: the maximum number of templates to keep in the
-                               cache
+                               cache, or their maximum total weight if
+                               `cache_weight` is specified
         :param default_class: the default `Template` subclass to use when
                               instantiating templates
         :param variable_lookup: the variable lookup mechanism; either "strict"
@@ -104,9 +143,27 @@ class TemplateLoader(object):
                          is passed the template object as only argument. This
                          callback can be used for example to add any desired
                          filters to the template
+        :param cache_dir: (optional) the path of a directory in which prepared
+                          templates should be cached; the callback is also
+                          invoked for templates restored from that cache
+        :param reload_interval: the minimum number of seconds between two
+                                checks whether a template file has changed,
+                                if `auto_reload` is enabled
+        :param reload_watcher: (optional) a watcher object, such as the ones
+                               returned by `watch.default_watcher()`, that
+                               notifies the loader of changed template files
+                               if `auto_reload` is enabled; the files of
+                               cached templates are then not checked until
+                               the watcher reports a change
+        :param cache_weight: (optional) a function that is passed a template
+                             and returns its weight, such as `event_count`,
+                             so that large templates take up a larger share
+                             of the cache
         :see: `LenientLookup`, `StrictLookup`
         
         :note: Changed in 0.5: Added the `allow_exec` argument
+        :note: Changed in 0.8: Added the `cache_dir`, `reload_interval`,
+               `reload_watcher` and `cache_weight` arguments
         """
         from genshi.template.markup import MarkupTemplate
 
@@ -119,6 +176,11 @@ class TemplateLoader(object):
         self.auto_reload = auto_reload
         """Whether templates should be reloaded when the underlying file is
         changed"""
+        self.reload_interval = reload_interval
+        """The minimum number of seconds between two checks whether the file
+        of a template has changed"""
+        self.reload_watcher = reload_watcher
+        """The watcher notifying the loader of changed template files"""
 
         self.default_encoding = default_encoding
         self.default_class = default_class or MarkupTemplate
@@ -127,18 +189,37 @@ class TemplateLoader(object):
         if callback is not None and not hasattr(callback, '__call__'):
             raise TypeError('The "callback" parameter needs to be callable')
         self.callback = callback
-        self._cache = LRUCache(max_cache_size)
+        self.cache_dir = cache_dir
+        self._cache = LRUCache(max_cache_size, weigh=cache_weight)
+        stats.track('TemplateLoader', self._cache)
         self._uptodate = {}
-        self._lock = threading.RLock()
+        self._checked = {}
+        self._checks = {}
+        self._watched = set()
+        self._digests = {}
+        self._dependencies = {}
+        self._unprepared = WeakKeyDictionary() # cache keys by template
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._local = threading.local()
 
     def __getstate__(self):
         state = self.__dict__.copy()
+        state['_unprepared'] = None
         state['_lock'] = None
+        state['_loading'] = None
+        state['_local'] = None
+        state['reload_watcher'] = None
+        state['_watched'] = set()
         return state
 
     def __setstate__(self, state):
         self.__dict__ = state
-        self._lock = threading.RLock()
+        stats.track('TemplateLoader', self._cache)
+        self._unprepared = WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._local = threading.local()
 
     def load(self, filename, relative_to=None, cls=None, encoding=None):
         """Load the template with the given name.
@@ -184,70 +265,670 @@ class TemplateLoader(object):
         filename = os.path.normpath(filename)
         cachekey = filename
 
+        record = None
+        dependencies = getattr(self._local, 'dependencies', None)
+        if dependencies is not None:
+            # A template is being prepared on this thread, and this template
+            # is loaded to be inlined into it
+            record = [cachekey, relative_to, None]
+            dependencies.append(record)
+
+        # First check the cache to avoid reparsing the same file
+        tmpl = self._cached(cachekey)
+        if tmpl is not None:
+            if record is not None:
+                record[2] = (tmpl.filepath, self._uptodate.get(cachekey))
+                self._prepare_loaded(tmpl)
+            return tmpl
+
+        lock = self._acquire_key(cachekey)
+        try:
+            # Another thread may have loaded the template while this one was
+            # waiting for the lock
+            tmpl = self._cached(cachekey)
+            if tmpl is not None:
+                if record is not None:
+                    record[2] = (tmpl.filepath, self._uptodate.get(cachekey))
+                    self._prepare_loaded(tmpl)
+                return tmpl
+
+            filepath, filename, fileobj, uptodate = self._locate(filename,
+                                                                 relative_to)
+            if record is not None:
+                record[2] = (filepath, uptodate)
+            try:
+                if self.cache_dir:
+                    tmpl = self._load_cached(cachekey, cls, fileobj, filepath,
+                                             filename, encoding=encoding)
+                else:
+                    tmpl = self._instantiate(cls, fileobj, filepath, filename,
+                                             encoding=encoding)
+                    if self.callback:
+                        self.callback(tmpl)
+                    # The template is prepared when it is first rendered, so
+                    # that filters and directives can still be added to it,
+                    # unless it is loaded to be inlined into another template
+                    if record is not None:
+                        self._prepare_template(cachekey, tmpl)
+                    else:
+                        self._unprepared[tmpl] = cachekey
+                self._lock.acquire()
+                try:
+                    self._uptodate[cachekey] = uptodate
+                    self._checked[cachekey] = time.time()
+                    self._cache[cachekey] = tmpl
+                    self._cache.misses += 1
+                finally:
+                    self._lock.release()
+                if self.auto_reload:
+                    self._watch(cachekey, tmpl.filepath, uptodate)
+            finally:
+                if hasattr(fileobj, 'close'):
+                    fileobj.close()
+            return tmpl
+
+        finally:
+            self._release_key(cachekey, lock)
+
+    def cache_info(self):
+        """Return statistics about the template cache, to help with tuning
+        the ``max_cache_size`` and ``cache_weight`` options.
+        
+        The returned dictionary contains the following keys:
+        
+         * ``hits``: the number of templates that were returned from the cache
+           (as hits are counted without locking, a few of them may be missing
+           when threads load templates concurrently)
+         * ``misses``: the number of templates that had to be (re)loaded
+         * ``evictions``: the number of templates dropped from the cache to
+           make room for other templates
+         * ``size``: the number of templates in the cache
+         * ``weight``: the total weight of the templates in the cache
+         * ``capacity``: the maximum number or total weight of the templates
+         * ``entries``: a list of ``(name, weight)`` tuples for the templates
+           in the cache, starting with the most recently used
+        
+        :return: a dictionary with the cache statistics
+        :rtype: `dict`
+        :since: version 0.8
+        """
         self._lock.acquire()
         try:
-            # First check the cache to avoid reparsing the same file
+            cache = self._cache
+            return {
+                'hits': cache.hits, 'misses': cache.misses,
+                'evictions': cache.evictions, 'size': len(cache),
+                'weight': cache.weight, 'capacity': cache.capacity,
+                'entries': cache.weights()
+            }
+        finally:
+            self._lock.release()
+
+    def dependencies(self, filename):
+        """Return the names of the templates that the template with the given
+        name depends on, because they have been inlined into it, either
+        directly or through other included templates.
+        
+        When `auto_reload` is enabled, a template is reloaded whenever one of
+        these templates changes. The template is loaded if it is not in the
+        cache. Templates that are only included when the template is rendered,
+        because the path to them is dynamic, are not listed.
+        
+        :param filename: the name of the template, as passed to `load()`
+        :return: the list of template names, in the order they were first
+                 included, including templates that were not found and
+                 replaced by their ``xi:fallback`` content
+        :rtype: ``list``
+        :since: version 0.8
+        """
+        self._prepare_loaded(self.load(filename))
+        return [key for key, relative_to, digest
+                in self._dependencies.get(os.path.normpath(filename), [])]
+
+    def dependents(self, filename):
+        """Return the names of the cached templates that depend on the
+        template with the given name, as reported by `dependencies()`.
+        
+        :param filename: the name of the template, as passed to `load()`
+        :return: a sorted list of template names
+        :rtype: ``list``
+        :since: version 0.8
+        """
+        filename = os.path.normpath(filename)
+        self._lock.acquire()
+        try:
+            cached = list(self._cache)
+        finally:
+            self._lock.release()
+        return sorted([cachekey for cachekey in cached if filename in
+                       [key for key, relative_to, digest
+                        in self._dependencies.get(cachekey, [])]])
+
+    def preload(self, patterns=None, workers=1, processes=False, cls=None,
+                encoding=None):
+        """Load and prepare all the templates on the search path, or those
+        matching the given patterns, so that they are cached.
+        
+        The templates are loaded by the given number of worker threads. As
+        parsing templates mostly runs Python code, which threads can not run
+        in parallel, the `processes` option can instead be used to prepare the
+        templates in a pool of worker processes. These fill the disk cache,
+        which therefore needs to be configured using the ``cache_dir`` option,
+        and the templates are then loaded from the disk cache into the memory
+        cache of this loader. Note that the ``max_cache_size`` of the loader
+        should be large enough to hold all the templates.
+        
+        :param patterns: a list of shell-style wildcard patterns; if specified,
+                         only templates with names matching any of the patterns
+                         are loaded
+        :param workers: the number of worker threads or processes
+        :param processes: whether to use worker processes instead of threads
+        :param cls: the template class to use
+        :param encoding: the encoding of the template files
+        :return: a list of ``(name, seconds, error)`` tuples in the order of
+                 `list_templates()`, where ``seconds`` is the time it took
+                 to load and prepare the template, and ``error`` is ``None``
+                 if that succeeded, and the exception otherwise
+        :rtype: ``list``
+        :raise ValueError: if `processes` is enabled, but the loader has no
+                           ``cache_dir``
+        :since: version 0.8
+        """
+        names = [name for name in self.list_templates()
+                 if not patterns or [1 for pattern in patterns
+                                     if fnmatch(name, pattern)]]
+        if processes:
+            if not self.cache_dir:
+                raise ValueError('Preloading templates in processes requires '
+                                 'a cache directory')
+            import multiprocessing
+            pool = multiprocessing.Pool(workers, _init_preload, [self])
             try:
-                tmpl = self._cache[cachekey]
-                if not self.auto_reload:
-                    return tmpl
-                uptodate = self._uptodate[cachekey]
-                if uptodate is not None and uptodate():
-                    return tmpl
-            except (KeyError, OSError):
-                pass
-
-            isabs = False
-
-            if os.path.isabs(filename):
-                # Bypass the search path if the requested filename is absolute
-                search_path = [os.path.dirname(filename)]
-                isabs = True
-
-            elif relative_to and os.path.isabs(relative_to):
-                # Make sure that the directory containing the including
-                # template is on the search path
-                dirname = os.path.dirname(relative_to)
-                if dirname not in search_path:
-                    search_path = list(search_path) + [dirname]
-                isabs = True
-
-            elif not search_path:
-                # Uh oh, don't know where to look for the template
-                raise TemplateError('Search path for templates not configured')
-
-            for loadfunc in search_path:
-                if isinstance(loadfunc, basestring):
-                    loadfunc = directory(loadfunc)
+                timings = pool.map(_preload_in_process,
+                                   [(name, cls, encoding) for name in names])
+            finally:
+                pool.close()
+                pool.join()
+            # Now load the prepared templates from the disk cache; templates
+            # that failed to load will fail again, reporting the error here
+            results = []
+            for name, seconds in zip(names, timings):
+                results.append((name, seconds,
+                                self._preload(name, cls, encoding)[1]))
+            return results
+
+        results = {}
+        queue = list(reversed(names))
+        lock = threading.Lock()
+        def _work():
+            while True:
+                lock.acquire()
                 try:
-                    filepath, filename, fileobj, uptodate = loadfunc(filename)
-                except IOError:
-                    continue
-                else:
+                    if not queue:
+                        return
+                    name = queue.pop()
+                finally:
+                    lock.release()
+                results[name] = self._preload(name, cls, encoding)
+        threads = [threading.Thread(target=_work)
+                   for idx in range(min(workers, len(names)) - 1)]
+        for thread in threads:
+            thread.start()
+        try:
+            _work()
+        finally:
+            for thread in threads:
+                thread.join()
+        return [(name,) + results[name] for name in names]
+
+    def _preload(self, name, cls=None, encoding=None):
+        """Load and prepare a template for `preload()`.
+        
+        :return: a ``(seconds, error)`` tuple
+        """
+        start = time.time()
+        try:
+            # Preparation errors are only reported when the template is
+            # rendered, so trigger them here
+            self.load(name, cls=cls, encoding=encoding).stream
+        except Exception, e:
+            # Including errors raised by the callback of the loader
+            return time.time() - start, e
+        return time.time() - start, None
+
+    def list_templates(self):
+        """Return the names of all template files on the search path.
+        
+        Only load functions providing a ``list_templates`` function attribute
+        can be enumerated; this includes the builtin `directory`, `package`
+        and `prefixed` load functions.
+        
+        :return: a sorted list of file names, relative to the search path,
+                 that can be passed to the `load()` method
+        :rtype: ``list``
+        :since: version 0.8
+        """
+        names = set()
+        for loadfunc in self.search_path:
+            if isinstance(loadfunc, basestring):
+                loadfunc = directory(loadfunc)
+            list_templates = getattr(loadfunc, 'list_templates', None)
+            if list_templates is not None:
+                names.update(list_templates())
+        return sorted(names)
+
+    def _cached(self, cachekey):
+        """Return the cached template with the given key, or ``None`` if the
+        template is not in the cache or needs to be reloaded.
+        """
+        tmpl = self._cache.peek(cachekey)
+        if tmpl is None:
+            return None
+        if self.auto_reload and cachekey not in self._watched:
+            now = time.time()
+            if now - self._checked.get(cachekey, 0) >= self.reload_interval:
+                # Check the file of the template, and the files of all the
+                # templates inlined into it
+                uptodate = self._uptodate.get(cachekey)
+                for key, filepath, check in [(cachekey, None, uptodate)] + \
+                                            self._checks.get(cachekey, []):
                     try:
-                        if isabs:
-                            # If the filename of either the included or the 
-                            # including template is absolute, make sure the
-                            # included template gets an absolute path, too,
-                            # so that nested includes work properly without a
-                            # search path
-                            filename = filepath
-                        tmpl = self._instantiate(cls, fileobj, filepath,
-                                                 filename, encoding=encoding)
-                        if self.callback:
-                            self.callback(tmpl)
-                        self._cache[cachekey] = tmpl
-                        self._uptodate[cachekey] = uptodate
-                    finally:
-                        if hasattr(fileobj, 'close'):
-                            fileobj.close()
+                        if check is None or not check():
+                            return None
+                    except OSError:
+                        return None
+                self._checked[cachekey] = now
+                self._watch(cachekey, tmpl.filepath, uptodate)
+
+        # Mark the template as recently used, unless another thread is
+        # updating the cache right now, in which case the eviction order is
+        # left slightly less accurate and the hit is counted without the lock
+        if self._lock.acquire(False):
+            try:
+                if cachekey in self._cache:
+                    self._cache[cachekey] # also counts the hit
                     return tmpl
+            finally:
+                self._lock.release()
+        self._cache.hits += 1
+        return tmpl
+
+    def _watch(self, cachekey, filepath, uptodate):
+        """Let the reload watcher, if any, watch the file of a template that
+        is known to be up to date.
+        """
+        watcher = self.reload_watcher
+        if watcher is None:
+            return
+        files = [(cachekey, filepath, uptodate)] + \
+                self._checks.get(cachekey, [])
+        for key, filepath, uptodate in files:
+            if uptodate is None or not filepath:
+                return
+        self._watched.add(cachekey)
+        for key, filepath, uptodate in files:
+            watcher.watch((self, cachekey, key), filepath, uptodate,
+                          self._changed)
+        # The files may have changed before the watcher started watching them
+        try:
+            for key, filepath, uptodate in files:
+                if not uptodate():
+                    break
+            else:
+                return
+        except OSError:
+            pass
+        self._watched.discard(cachekey)
 
-            raise TemplateNotFound(filename, search_path)
+    def _changed(self, key):
+        """Called by the reload watcher when the file of a template may have
+        changed, so that it is checked again on the next load.
+        """
+        self._watched.discard(key[1])
 
+    def _acquire_key(self, cachekey):
+        """Acquire the lock for loading the template with the given key.
+        
+        If the current thread is already loading another template (for example
+        because the template is being inlined into that one), the lock is only
+        acquired if it is not held by another thread, as waiting for it could
+        deadlock when templates include each other. The template is then
+        simply loaded a second time.
+        
+        :return: the lock that was acquired, or ``None``
+        """
+        self._lock.acquire()
+        try:
+            entry = self._loading.get(cachekey)
+            if entry is None:
+                entry = self._loading[cachekey] = [threading.RLock(), 0]
+            entry[1] += 1
         finally:
             self._lock.release()
 
+        lock = entry[0]
+        depth = getattr(self._local, 'depth', 0)
+        if not depth:
+            lock.acquire()
+        elif not lock.acquire(False):
+            lock = None
+        self._local.depth = depth + 1
+        return lock
+
+    def _release_key(self, cachekey, lock):
+        """Release the lock returned by `_acquire_key()`."""
+        self._local.depth -= 1
+        if lock is not None:
+            lock.release()
+        self._lock.acquire()
+        try:
+            entry = self._loading[cachekey]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._loading[cachekey]
+        finally:
+            self._lock.release()
+
+    def _locate(self, filename, relative_to=None):
+        """Locate a template file on the search path.
+        
+        :param filename: the normalized path of the template file, made
+                         relative to the including template where applicable
+        :param relative_to: the filename of the template from which the new
+                            template is being loaded, or ``None``
+        :return: a ``(filepath, filename, fileobj, uptodate)`` tuple, as
+                 returned by the load functions
+        :raises TemplateNotFound: if a template with the given name could not
+                                  be found
+        """
+        search_path = self.search_path
+        isabs = False
+
+        if os.path.isabs(filename):
+            # Bypass the search path if the requested filename is absolute
+            search_path = [os.path.dirname(filename)]
+            isabs = True
+
+        elif relative_to and os.path.isabs(relative_to):
+            # Make sure that the directory containing the including
+            # template is on the search path
+            dirname = os.path.dirname(relative_to)
+            if dirname not in search_path:
+                search_path = list(search_path) + [dirname]
+            isabs = True
+
+        elif not search_path:
+            # Uh oh, don't know where to look for the template
+            raise TemplateError('Search path for templates not configured')
+
+        for loadfunc in search_path:
+            if isinstance(loadfunc, basestring):
+                loadfunc = directory(loadfunc)
+            try:
+                filepath, filename, fileobj, uptodate = loadfunc(filename)
+            except IOError:
+                continue
+            if isabs:
+                # If the filename of either the included or the including
+                # template is absolute, make sure the included template gets
+                # an absolute path, too, so that nested includes work properly
+                # without a search path
+                filename = filepath
+            return filepath, filename, fileobj, uptodate
+
+        raise TemplateNotFound(filename, search_path)
+
+    def _load_cached(self, cachekey, cls, fileobj, filepath, filename,
+                     encoding=None):
+        """Return the prepared template from the disk cache, or instantiate
+        and prepare the template and add it to the cache.
+        """
+        source = fileobj.read()
+        digest = _digest(source)
+        path = self._cache_path(cls, filepath, filename, encoding)
+
+        cached = self._read_cache(path, digest)
+        if cached is not None:
+            dependencies, self._checks[cachekey], tmpl = cached
+            self._dependencies[cachekey] = dependencies
+            self._digests[cachekey] = digest
+            if self.callback:
+                self.callback(tmpl)
+            return tmpl
+
+        if isinstance(source, unicode):
+            fileobj = StringIO(source)
+        else:
+            fileobj = BytesIO(source)
+        tmpl = self._instantiate(cls, fileobj, filepath, filename,
+                                 encoding=encoding)
+        if self.callback:
+            self.callback(tmpl)
+
+        dependencies = self._prepare_template(cachekey, tmpl)
+        self._digests[cachekey] = digest
+        if dependencies is not None:
+            self._write_cache(path, digest, dependencies, tmpl)
+        return tmpl
+
+    def _prepare_loaded(self, tmpl):
+        """Prepare a template returned by `load()` if it has not been prepared
+        yet, recording the templates that get inlined into it.
+        
+        This is called by the template when it is first rendered. Errors are
+        left to be reported by the template, which then prepares itself.
+        """
+        self._lock.acquire()
+        try:
+            cachekey = self._unprepared.get(tmpl)
+        finally:
+            self._lock.release()
+        if cachekey is None:
+            return
+
+        lock = self._acquire_key(cachekey)
+        try:
+            if not tmpl._prepared:
+                self._prepare_template(cachekey, tmpl)
+                if cachekey in self._watched and self._checks.get(cachekey):
+                    # Let the reload watcher also watch the inlined templates
+                    self._watched.discard(cachekey)
+                    self._watch(cachekey, tmpl.filepath,
+                                self._uptodate.get(cachekey))
+            self._lock.acquire()
+            try:
+                self._unprepared.pop(tmpl, None)
+            finally:
+                self._lock.release()
+        finally:
+            self._release_key(cachekey, lock)
+
+    def _prepare_template(self, cachekey, tmpl):
+        """Prepare a template, recording the templates that get inlined into
+        it, and any templates those depend on.
+        
+        If the template is already being prepared on the current thread,
+        because it (indirectly) includes itself, or if preparing it fails, it
+        is left to prepare itself, which reports any errors at that time.
+        
+        :return: the list of ``(filename, relative_to, digest)`` tuples
+                 describing the dependencies, as stored in the disk cache, or
+                 ``None`` if the template has not been prepared
+        """
+        preparing = getattr(self._local, 'preparing', None) or []
+        if tmpl.filepath in preparing:
+            return None
+        outer = getattr(self._local, 'dependencies', None)
+        self._local.dependencies = inlined = []
+        self._local.preparing = preparing + [tmpl.filepath]
+        try:
+            try:
+                # Templates loaded while preparing another template are
+                # prepared in the same way that template would prepare them
+                # for inlining
+                tmpl._prepare_self(set(self._local.preparing))
+            except Exception:
+                # Make sure the template is loaded again next time if it is
+                # checked for changes
+                self._checks[cachekey] = [(None, None, None)]
+                return None
+        finally:
+            self._local.dependencies = outer
+            self._local.preparing = preparing
+
+        dependencies = []
+        checks = []
+        for key, relative_to, check in inlined:
+            if check is None:
+                check = (None, self._missing(key, relative_to))
+            for dependency in [(key, relative_to, self._digests.get(key))] + \
+                              self._dependencies.get(key, []):
+                if dependency not in dependencies:
+                    dependencies.append(dependency)
+            for dependency in [(key,) + check] + self._checks.get(key, []):
+                if dependency not in checks:
+                    checks.append(dependency)
+        self._dependencies[cachekey] = dependencies
+        self._checks[cachekey] = checks
+        return dependencies
+
+    def _missing(self, filename, relative_to=None):
+        """Return a function that tells whether a template that could not be
+        found is still missing.
+        """
+        def _uptodate():
+            try:
+                fileobj = self._locate(filename, relative_to)[2]
+            except TemplateNotFound:
+                return True
+            if hasattr(fileobj, 'close'):
+                fileobj.close()
+            return False
+        return _uptodate
+
+    def _cache_path(self, cls, filepath, filename, encoding):
+        """Return the path of the file in the cache directory for the given
+        template and the current loader options.
+        """
+        lookup = self.variable_lookup
+        if not isinstance(lookup, basestring):
+            lookup = '%s.%s' % (lookup.__module__, lookup.__name__)
+        callback = self.callback
+        if callback is not None:
+            callback = '%s.%s' % (getattr(callback, '__module__', None),
+                                  getattr(callback, '__name__',
+                                          type(callback).__name__))
+        parts = []
+        for part in (__version__, sys.version, cls.__module__, cls.__name__,
+                     filepath, filename, encoding or self.default_encoding,
+                     lookup, self.allow_exec, self.auto_reload, callback):
+            # Names of included templates are unicode, so make sure they get
+            # the same key as the byte string names passed to load()
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            parts.append(repr(part))
+        key = '\0'.join(parts)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.cache_dir, sha1(key).hexdigest() + '.pickle')
+
+    def _read_cache(self, path, digest):
+        """Read a prepared template from the given cache file.
+        
+        :return: a ``(dependencies, checks, template)`` tuple, or ``None`` if
+                 the file does not exist or is out of date
+        """
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                unpickler = pickle.Unpickler(fileobj)
+                unpickler.persistent_load = self._persistent_load
+                if unpickler.load() != digest:
+                    return None
+                dependencies = unpickler.load()
+                checks = []
+                for key, relative_to, dep_digest in dependencies:
+                    source_digest, check = self._source_digest(key,
+                                                               relative_to)
+                    if source_digest != dep_digest:
+                        return None
+                    if check is None:
+                        check = (None, self._missing(key, relative_to))
+                    checks.append((key,) + check)
+                tmpl = unpickler.load()
+            except Exception:
+                # The cache file is corrupt or was written by an incompatible
+                # version, so just recreate it
+                return None
+        finally:
+            fileobj.close()
+
+        for key, relative_to, dep_digest in dependencies:
+            self._digests[key] = dep_digest
+        return dependencies, checks, tmpl
+
+    def _write_cache(self, path, digest, dependencies, tmpl):
+        """Write a prepared template to the given cache file.
+        
+        Errors are ignored, so that an unwritable cache directory only costs
+        performance.
+        """
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        except (IOError, OSError):
+            return
+        fileobj = os.fdopen(fd, 'wb')
+        try:
+            try:
+                pickler = pickle.Pickler(fileobj, 2)
+                pickler.persistent_id = self._persistent_id
+                pickler.dump(digest)
+                pickler.dump(dependencies)
+                pickler.dump(tmpl)
+            finally:
+                fileobj.close()
+            # Write to a temporary file first and then rename it, so that
+            # other processes never see a partially written cache file
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmppath, path)
+        except Exception:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def _persistent_id(self, obj):
+        # Templates in the disk cache reference this loader, which must not be
+        # pickled along with them
+        if obj is self:
+            return 'loader'
+        return None
+
+    def _persistent_load(self, pid):
+        if pid == 'loader':
+            return self
+        raise pickle.UnpicklingError('unknown persistent id %r' % pid)
+
+    def _source_digest(self, filename, relative_to=None):
+        """Return the digest of the current source of a template, and a
+        ``(filepath, uptodate)`` tuple for checking whether the source has
+        changed since, or ``(None, None)`` if the template can not be found.
+        """
+        try:
+            filepath, filename, fileobj, uptodate = self._locate(filename,
+                                                                 relative_to)
+        except TemplateNotFound:
+            return None, None
+        try:
+            return _digest(fileobj.read()), (filepath, uptodate)
+        finally:
+            if hasattr(fileobj, 'close'):
+                fileobj.close()
+
     def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
         """Instantiate and return the `Template` object based on the given
         class and parameters.
@@ -288,6 +969,14 @@ class TemplateLoader(object):
             def _uptodate():
                 return mtime == os.path.getmtime(filepath)
             return filepath, filename, fileobj, _uptodate
+        def _list_directory():
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                reldir = dirpath[len(path):].strip(os.sep)
+                reldir = reldir.replace(os.sep, '/')
+                for filename in sorted(filenames):
+                    yield reldir and '%s/%s' % (reldir, filename) or filename
+        _load_from_directory.list_templates = _list_directory
         return _load_from_directory
 
     @staticmethod
@@ -299,10 +988,19 @@ class TemplateLoader(object):
         :return: the loader function to load templates from the given package
         :rtype: ``function``
         """
-        from pkg_resources import resource_stream
+        from pkg_resources import resource_isdir, resource_listdir, \
+                                  resource_stream
         def _load_from_package(filename):
             filepath = os.path.join(path, filename)
             return filepath, filename, resource_stream(name, filepath), None
+        def _list_package(subdir=''):
+            for child in sorted(resource_listdir(name, path + subdir)):
+                if resource_isdir(name, '%s%s/%s' % (path, subdir, child)):
+                    for filename in _list_package('%s/%s' % (subdir, child)):
+                        yield filename
+                else:
+                    yield ('%s/%s' % (subdir, child)).lstrip('/')
+        _load_from_package.list_templates = _list_package
         return _load_from_package
 
     @staticmethod
@@ -336,9 +1034,71 @@ class TemplateLoader(object):
                     )
                     return filepath, filename, fileobj, uptodate
             raise TemplateNotFound(filename, list(delegates.keys()))
+        def _list_prefixes():
+            for prefix, delegate in sorted(delegates.items()):
+                if isinstance(delegate, basestring):
+                    delegate = directory(delegate)
+                list_templates = getattr(delegate, 'list_templates', None)
+                if list_templates is not None:
+                    for filename in list_templates():
+                        yield '%s/%s' % (prefix.rstrip('/\\'), filename)
+        _dispatch_by_prefix.list_templates = _list_prefixes
         return _dispatch_by_prefix
 
 
+_preload_loader = None
+
+def _init_preload(loader):
+    # Initializes a worker process of `TemplateLoader.preload()`; the loader
+    # is a copy owned by the process, but its locks may have been copied in
+    # a locked state
+    global _preload_loader
+    loader.__setstate__(loader.__getstate__())
+    _preload_loader = loader
+
+def _preload_in_process(args):
+    name, cls, encoding = args
+    return _preload_loader._preload(name, cls, encoding)[0]
+
+
+def _digest(source):
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    return sha1(source).hexdigest()
+
+
 directory = TemplateLoader.directory
 package = TemplateLoader.package
 prefixed = TemplateLoader.prefixed
+
+
+def event_count(template):
+    """Return the number of events in the stream of a template, including
+    the events in the bodies of its directives and in the fallback content of
+    its includes.
+    
+    This function can be passed as the ``cache_weight`` argument of a
+    `TemplateLoader`, as the number of events is a rough estimate of the
+    memory used by a template.
+    
+    >>> from genshi.template import MarkupTemplate
+    >>> event_count(MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+    ...   <li py:for="item in items">$item</li>
+    ... </ul>'''))
+    8
+    
+    :param template: the `Template` object
+    :return: the number of events
+    :rtype: `int`
+    :since: version 0.8
+    """
+    count = 0
+    streams = [template._stream]
+    while streams:
+        for kind, data, pos in streams.pop():
+            count += 1
+            if kind is SUB:
+                streams.append(data[1])
+            elif kind is INCLUDE and data[2]:
+                streams.append(data[2])
+    return count
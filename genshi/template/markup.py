@@ -15,12 +15,17 @@
 
 from itertools import chain
 
-from genshi.core import Attrs, Markup, Namespace, Stream, StreamEventKind
+from genshi.core import Attrs, Markup, Namespace, Stream, StreamEventKind, \
+                        _ensure
 from genshi.core import START, END, START_NS, END_NS, TEXT, PI, COMMENT
 from genshi.input import XMLParser
+from genshi.output import CHUNK, Chunk, TextSerializer, XMLSerializer, \
+                          _expand_chunks, get_serializer
+from genshi.path import ATTRIBUTE, LocalNameTest, QualifiedNameTest
+from genshi.template.astutil import _ast
 from genshi.template.base import BadDirectiveError, Template, \
                                  TemplateSyntaxError, _apply_directives, \
-                                 EXEC, INCLUDE, SUB
+                                 EXEC, EXPR, INCLUDE, SUB
 from genshi.template.eval import Suite
 from genshi.template.interpolation import interpolate
 from genshi.template.directives import *
@@ -53,18 +58,22 @@ class MarkupTemplate(Template):
                   ('if', IfDirective),
                   ('choose', ChooseDirective),
                   ('with', WithDirective),
+                  ('prefetch', PrefetchDirective),
                   ('replace', ReplaceDirective),
                   ('content', ContentDirective),
                   ('attrs', AttrsDirective),
                   ('strip', StripDirective)]
     serializer = 'xml'
+    weave_matches = False
     _number_conv = Markup
+    _chunked = None
 
     def __init__(self, source, filepath=None, filename=None, loader=None,
                  encoding=None, lookup='strict', allow_exec=True):
         Template.__init__(self, source, filepath=filepath, filename=filename,
                           loader=loader, encoding=encoding, lookup=lookup,
                           allow_exec=allow_exec)
+        self._namespaces = []
         self.add_directives(self.DIRECTIVE_NAMESPACE, self)
 
     def _init_filters(self):
@@ -289,6 +298,234 @@ class MarkupTemplate(Template):
             self, self._extract_includes(self._interpolate_attrs(stream)),
             inlined=inlined)
 
+    def _prepare_self(self, inlined=None):
+        if not self._prepared:
+            Template._prepare_self(self, inlined)
+            if self.weave_matches and \
+                    self.filters == [self._flatten, self._match, self._include]:
+                self._stream = self._weave_matches(self._stream)
+            self._chunked = self._fold(self._stream)
+
+    def _weave_matches(self, stream):
+        """Apply the match templates that are known to match specific elements
+        of the prepared stream, so that they no longer need to be applied when
+        the template is rendered.
+        
+        A match template is woven if it is defined outside of any directive
+        other than ``py:with``, ``py:attrs`` and ``py:strip`` (possibly in a
+        statically included template), if it has no other directives, if its
+        path is a single element name without predicates, and if it only
+        matches once. The element it is applied to must be the first element
+        with that name following the definition in the template itself, and
+        must also be outside of any directive other than the above.
+        
+        The match template may only use the ``select()`` function in
+        expressions of the form ``${select('path')}`` or
+        ``py:attrs="select('@*')"``. Paths other than ``*|text()`` are only
+        supported if the matched element does not contain any directives or
+        expressions. Content with directives or expressions may also not be
+        selected inside directives other than ``py:if``, ``py:choose``,
+        ``py:when``, ``py:otherwise``, ``py:attrs`` and ``py:strip``, where it
+        would be evaluated in the scope of the match template, or repeatedly.
+        
+        Weaving assumes that the elements matched do not get generated by
+        expressions, which is not checked. Match templates that cannot be
+        woven are applied when the template is rendered, as usual.
+        
+        :param stream: the prepared event stream
+        :return: the list of events with the match templates applied
+        """
+        woven = []
+        stream = self._weave(stream, [], woven, True, False)
+        if not woven:
+            return stream
+        return _remove_events(stream, woven)
+
+    def _weave(self, stream, rules, woven, transparent, fixed_root):
+        events = []
+        idx = 0
+        while idx < len(stream):
+            event = stream[idx]
+            kind, data, pos = event
+            idx += 1
+
+            if kind is SUB:
+                directives, substream = data
+                matches = [d for d in directives
+                           if isinstance(d, MatchDirective)]
+                if matches:
+                    # The body of the match template is not processed in place
+                    rule = _MatchRule(event, matches[0])
+                    rule.weavable = transparent and len(directives) == 1 and \
+                                    rule.weavable
+                    rules.append(rule)
+                    events.append(event)
+                    continue
+                inner = transparent and not [1 for d in directives
+                    if not isinstance(d, (WithDirective, AttrsDirective,
+                                          StripDirective))]
+                fixed_root = bool([1 for d in directives
+                    if isinstance(d, (AttrsDirective, StripDirective))])
+                substream = self._weave(substream, rules, woven, inner,
+                                        fixed_root)
+                events.append((kind, (directives, substream), pos))
+
+            elif kind is START:
+                name = data[0].localname
+                candidates = [rule for rule in rules
+                              if rule.names is None or name in rule.names]
+                if candidates:
+                    rule = candidates[0]
+                    end = _element_end(stream, idx - 1)
+                    if rule.weavable and transparent and \
+                            not (fixed_root and idx == 1):
+                        template = self._weave_rule(rule, rules,
+                                                    stream[idx - 1:end + 1])
+                        if template is not None:
+                            rules.remove(rule)
+                            woven.append(rule.event)
+                            _block_rules(template, rules)
+                            events.extend(template)
+                            idx = end + 1
+                            continue
+                    # The element may be matched when the template is rendered
+                    for rule in candidates:
+                        rule.weavable = False
+                events.append(event)
+
+            else:
+                if kind is INCLUDE:
+                    # The included template may contain any element
+                    for rule in rules:
+                        rule.weavable = False
+                events.append(event)
+
+        return events
+
+    def _weave_rule(self, rule, rules, element):
+        """Return the events of the template of the given match rule applied to
+        the given element, or `None` if that is not possible.
+        """
+        directive = rule.directive
+        template = rule.event[1][1]
+        content = element[1:-1]
+
+        # Match templates defined before would not be applied to the output
+        # of this one, and could consume parts of the content it drops
+        names = _element_names(template) | _element_names(content)
+        for other in rules[:rules.index(rule)]:
+            if other.names is None or other.names & names:
+                return None
+
+        # Content with side effects is processed before the match template
+        # when it is buffered
+        if _contains(content, lambda kind, data:
+                     kind is SUB and [1 for d in data[0]
+                                      if isinstance(d, MatchDirective)] or
+                     kind is INCLUDE):
+            return None
+        if 'not_buffered' not in directive.hints and \
+                _contains(content, lambda kind, data: kind is EXEC or
+                          kind is SUB and [1 for d in data[0]
+                                           if isinstance(d, DefDirective)]):
+            return None
+
+        try:
+            return _substitute_select(template, element, directive.namespaces)
+        except _NotWeavable:
+            return None
+
+    def _fold_constants(self, stream, choose=None):
+        if self._namespaces != [self.DIRECTIVE_NAMESPACE]:
+            # Directives from other namespaces, such as the i18n ones, may
+            # need to see the expressions and branches as written
+            return list(stream)
+        return Template._fold_constants(self, stream, choose)
+
+    def _fold(self, stream):
+        """Replace runs of static elements in the prepared stream by `CHUNK`
+        events, so that the serializers can emit them as a whole.
+        
+        A run consists of elements that contain no directives, expressions or
+        namespace declarations, along with any text, comments and processing
+        instructions between them.
+        
+        :param stream: the prepared event stream
+        :return: the list of events with the runs replaced
+        """
+        events = []
+        ends = {} # indices of the start and end events of static elements
+        open_elems = [] # stack of [start index, static] lists
+        for kind, data, pos in stream:
+            if kind is START:
+                static = not (events and events[-1][0] is START_NS) and \
+                         not [1 for _, value in data[1]
+                              if type(value) is list]
+                open_elems.append([len(events), static])
+            elif kind is END:
+                if open_elems:
+                    start, static = open_elems.pop()
+                    if static:
+                        ends[start] = len(events)
+                    elif open_elems:
+                        open_elems[-1][1] = False
+            elif kind is TEXT or kind is COMMENT or kind is PI:
+                pass
+            else:
+                if kind is SUB:
+                    # Static markup in the body of directives is folded too,
+                    # except for the outermost events, which some directives
+                    # need to process individually
+                    directives, substream = data
+                    if len(substream) > 2 and not [d for d in directives
+                            if not isinstance(d, _FOLDABLE_DIRECTIVES)]:
+                        substream = substream[:1] + \
+                                    self._fold(substream[1:-1]) + \
+                                    substream[-1:]
+                        data = directives, substream
+                if open_elems:
+                    open_elems[-1][1] = False
+            events.append((kind, data, pos))
+
+        folded = []
+        idx, count = 0, len(events)
+        while idx < count:
+            if idx in ends:
+                start = idx
+                idx = last = ends[idx] + 1
+                while idx < count:
+                    if idx in ends:
+                        idx = last = ends[idx] + 1
+                    elif events[idx][0] in (TEXT, COMMENT, PI):
+                        idx += 1
+                    else:
+                        break
+                folded.append((CHUNK, Chunk(events[start:last]),
+                               events[start][2]))
+                idx = last
+            else:
+                folded.append(events[idx])
+                idx += 1
+        return folded
+
+    def _chunked_stream(self):
+        """Return the prepared stream with static markup folded into `CHUNK`
+        events, or `None` if the filters of the template have been changed,
+        in which case the filters may not know how to process such events.
+        """
+        if not self._prepared:
+            self._prepare_loaded()
+        if self.filters == [self._flatten, self._match, self._include]:
+            return self._chunked
+
+    def _execute(self, ctxt, vars):
+        stream = self._chunked_stream()
+        if stream is None:
+            return Template._execute(self, ctxt, vars)
+        for filter_ in self.filters:
+            stream = filter_(iter(stream), ctxt, **vars)
+        return _ChunkedStream(stream, self.serializer)
+
     def add_directives(self, namespace, factory):
         """Register a custom `DirectiveFactory` for a given namespace.
         
@@ -298,10 +535,15 @@ class MarkupTemplate(Template):
         :type factory: `DirectiveFactory`
         :since: version 0.6
         """
+        if namespace in self._namespaces:
+            # The directives of that namespace have already been extracted,
+            # for example because the template was restored from a cache
+            return
         assert not self._prepared, 'Too late for adding directives, ' \
                                    'template already prepared'
         self._stream = self._extract_directives(self._stream, namespace,
                                                 factory)
+        self._namespaces.append(namespace)
 
     def _match(self, stream, ctxt, start=0, end=None, **vars):
         """Internal stream filter that applies any defined match templates
@@ -309,6 +551,13 @@ class MarkupTemplate(Template):
         """
         match_templates = ctxt._match_templates
 
+        def _index():
+            index = ctxt._match_index
+            if index is None:
+                index = ctxt._match_index = _index_match_templates(
+                    match_templates)
+            return index
+
         def _strip(stream, append):
             depth = 1
             next = stream.next
@@ -330,22 +579,39 @@ class MarkupTemplate(Template):
             # We might care about namespace events in the future, though
             if not match_templates or (event[0] is not START and
                                        event[0] is not END):
+                if event[0] is CHUNK and match_templates:
+                    # Match templates may apply to the static markup
+                    for event in self._match(iter(event[1].events), ctxt,
+                                             start=start, end=end, **vars):
+                        yield event
+                    continue
                 yield event
                 continue
 
-            for idx, (test, path, template, hints, namespaces, directives) \
-                    in enumerate(match_templates):
+            # Only test the match templates that can match the element
+            by_name, generic = _index()
+            if event[0] is START:
+                candidates = by_name.get(event[1][0].localname, generic)
+            else:
+                candidates = generic
+
+            for idx in candidates:
                 if idx < start or end is not None and idx >= end:
                     continue
+                test, path, template, hints, namespaces, directives = \
+                    match_templates[idx]
 
                 if test(event, namespaces, ctxt) is True:
+                    following = [match_templates[other][0]
+                                 for other in candidates if other > idx]
                     if 'match_once' in hints:
                         del match_templates[idx]
+                        ctxt._match_index = None
                         idx -= 1
 
                     # Let the remaining match templates know about the event so
                     # they get a chance to update their internal state
-                    for test in [mt[0] for mt in match_templates[idx + 1:]]:
+                    for test in following:
                         test(event, namespaces, ctxt, updateonly=True)
 
                     # Consume and store all events until an end event
@@ -361,7 +627,7 @@ class MarkupTemplate(Template):
                     content = self._include(chain([event], inner, tail), ctxt)
                     if 'not_buffered' not in hints:
                         content = list(content)
-                    content = Stream(content)
+                    content = _ChunkedStream(content)
 
                     # Make the select() function available in the body of the
                     # match template
@@ -390,10 +656,339 @@ class MarkupTemplate(Template):
                     # templates know about the last event in the
                     # matched content, so they can update their
                     # internal state accordingly
-                    for test in [mt[0] for mt in match_templates[idx:]]:
+                    for test in [match_templates[other][0]
+                                 for other in _index()[1] if other >= idx]:
                         test(tail[0], namespaces, ctxt, updateonly=True)
 
                     break
 
             else: # no matches
                 yield event
+
+
+class _NotWeavable(Exception):
+    """Raised when a match template cannot be woven into a template."""
+
+
+class _MatchRule(object):
+    """A match template defined in a prepared stream, as tracked by
+    `MarkupTemplate._weave_matches()`.
+    """
+    __slots__ = ['event', 'directive', 'names', 'weavable']
+
+    def __init__(self, event, directive):
+        self.event = event
+        self.directive = directive
+        self.names = _match_names(directive.path)
+        self.weavable = self.names is not None and \
+                        'match_once' in directive.hints and \
+                        not [1 for steps in directive.path.paths
+                             if steps[0][2]] and \
+                        not _contains(event[1][1], lambda kind, data:
+                            kind is SUB and [1 for d in data[0]
+                                             if isinstance(d, MatchDirective)]
+                            or kind is INCLUDE)
+
+
+def _element_end(stream, start):
+    """Return the index of the end event of the element starting at the given
+    index of the stream.
+    """
+    depth = 0
+    for idx in xrange(start, len(stream)):
+        kind = stream[idx][0]
+        if kind is START:
+            depth += 1
+        elif kind is END:
+            depth -= 1
+            if not depth:
+                return idx
+
+
+def _contains(stream, test):
+    """Return whether the given prepared stream, or any substream of it,
+    contains an event for which the test function returns true.
+    """
+    for kind, data, pos in stream:
+        if test(kind, data):
+            return True
+        if kind is SUB and _contains(data[1], test):
+            return True
+    return False
+
+
+def _element_names(stream):
+    """Return the set of local names of the elements in the given prepared
+    stream.
+    """
+    names = set()
+    for kind, data, pos in stream:
+        if kind is START:
+            names.add(data[0].localname)
+        elif kind is SUB:
+            names |= _element_names(data[1])
+    return names
+
+
+def _block_rules(stream, rules):
+    """Mark the match rules that may match any element in the given prepared
+    stream as not weavable.
+    """
+    names = _element_names(stream)
+    for rule in rules:
+        if rule.names is None or rule.names & names:
+            rule.weavable = False
+
+
+def _remove_events(stream, removed):
+    """Return the given prepared stream without the given events."""
+    events = []
+    for event in stream:
+        if [1 for other in removed if other is event]:
+            continue
+        if event[0] is SUB:
+            directives, substream = event[1]
+            event = event[0], (directives, _remove_events(substream,
+                                                          removed)), event[2]
+        events.append(event)
+    return events
+
+
+def _select_path(code):
+    """Return the path passed to ``select()`` if the given code consists of a
+    single call of that function with a literal path, and `None` otherwise.
+    """
+    node = getattr(code, 'ast', None)
+    node = getattr(node, 'body', None)
+    if isinstance(node, _ast.Call) and isinstance(node.func, _ast.Name) and \
+            node.func.id == 'select' and len(node.args) == 1 and \
+            not node.keywords and not getattr(node, 'starargs', None) and \
+            not getattr(node, 'kwargs', None):
+        path = getattr(node.args[0], 's', getattr(node.args[0], 'value', None))
+        if isinstance(path, basestring):
+            return path
+
+
+def _check_code(code):
+    """Raise `_NotWeavable` if the given code uses the ``select()`` function.
+    """
+    if code is not None and _uses_select(code.ast):
+        raise _NotWeavable()
+
+
+def _uses_select(node):
+    if isinstance(node, _ast.Name):
+        return node.id == 'select'
+    for name in node._fields:
+        value = getattr(node, name, None)
+        if not isinstance(value, list):
+            value = [value]
+        for child in value:
+            if isinstance(child, _ast.AST) and _uses_select(child):
+                return True
+    return False
+
+
+def _substitute_select(template, element, namespaces, scoped=False):
+    """Replace the calls of ``select()`` in the given match template by the
+    events they select from the given element.
+    
+    :param scoped: whether the template is processed inside a directive that
+                   adds variables to the context or repeats its content, in
+                   which the selected events must not be evaluated
+    :raises _NotWeavable: if the template uses ``select()`` in a way that
+                          cannot be resolved statically
+    """
+    events = []
+    for kind, data, pos in template:
+        if kind is EXPR:
+            path = _select_path(data)
+            if path is None:
+                _check_code(data)
+            else:
+                selected = _static_select(path, element, namespaces)
+                if scoped and _contains(selected, _is_dynamic):
+                    # The selected content would see the variables of the
+                    # match template, or be evaluated repeatedly
+                    raise _NotWeavable()
+                events.extend(selected)
+                continue
+
+        elif kind is EXEC:
+            _check_code(data)
+
+        elif kind is START:
+            for name, value in data[1]:
+                if type(value) is list:
+                    for event in value:
+                        if event[0] is EXPR:
+                            _check_code(event[1])
+
+        elif kind is SUB:
+            directives, substream = data
+            directives = list(directives)
+            substream = _substitute_select(substream, element, namespaces,
+                scoped or bool([1 for d in directives
+                                if not isinstance(d, _UNSCOPED_DIRECTIVES)]))
+            for directive in directives[:]:
+                if isinstance(directive, AttrsDirective) and \
+                        _select_path(directive.expr) == '@*' and \
+                        substream and substream[0][0] is START:
+                    attrs = element[0][1][1]
+                    if [1 for name, value in attrs if type(value) is list]:
+                        raise _NotWeavable()
+                    tag, attrib = substream[0][1]
+                    attrib |= [(name, value is not None and
+                                      unicode(value).strip() or None)
+                               for name, value in attrs]
+                    substream[0] = START, (tag, attrib), substream[0][2]
+                    directives.remove(directive)
+                    continue
+                for code in _directive_code(directive):
+                    _check_code(code)
+            if not directives:
+                events.extend(substream)
+                continue
+            data = directives, substream
+
+        events.append((kind, data, pos))
+    return events
+
+
+_UNSCOPED_DIRECTIVES = (AttrsDirective, ChooseDirective, IfDirective,
+                        OtherwiseDirective, StripDirective, WhenDirective)
+
+
+def _is_dynamic(kind, data):
+    """Return whether the event is evaluated when the template is rendered."""
+    return kind in (EXPR, EXEC, SUB) or \
+           kind is START and bool([1 for name, value in data[1]
+                                   if type(value) is list])
+
+
+def _directive_code(directive):
+    """Return the code objects used by a directive."""
+    code = [directive.expr]
+    if isinstance(directive, WithDirective):
+        code += [expr for targets, expr in directive.vars]
+    elif isinstance(directive, DefDirective):
+        code += directive.defaults.values()
+    elif not isinstance(directive, (AttrsDirective, ChooseDirective,
+                                    ForDirective, IfDirective,
+                                    OtherwiseDirective, StripDirective,
+                                    WhenDirective)):
+        # Unknown directives may use select() in any way
+        raise _NotWeavable()
+    return code
+
+
+def _static_select(path, element, namespaces):
+    """Return the events that ``select()`` with the given path returns for
+    the given element when the template is rendered.
+    """
+    content = element[1:-1]
+    if path in ('*|text()', 'text()|*'):
+        # Directives and expressions in the content are kept, as they produce
+        # elements and text; comments and processing instructions are dropped
+        events = []
+        depth = 0
+        for event in content:
+            kind = event[0]
+            if kind is START:
+                depth += 1
+            elif kind is END:
+                depth -= 1
+            elif not depth and kind in (COMMENT, PI, START_NS, END_NS):
+                continue
+            elif not depth and kind is SUB and _contains(event[1][1],
+                    lambda kind, data: kind in (COMMENT, PI)):
+                raise _NotWeavable()
+            events.append(event)
+        return events
+
+    if '$' in path or _contains(element, lambda kind, data:
+            kind not in (START, END, TEXT, COMMENT, PI, START_NS, END_NS) or
+            kind is START and [1 for name, value in data[1]
+                               if type(value) is list]):
+        raise _NotWeavable()
+    events = []
+    for event in Stream(element).select(path, namespaces):
+        if not isinstance(event, tuple) or len(event) != 3 or event[0] not in \
+                (START, END, TEXT, COMMENT, PI, START_NS, END_NS):
+            raise _NotWeavable()
+        events.append(event)
+    return events
+
+
+def _match_names(path):
+    """Return the set of local names of the elements that the given match
+    template path can match, or `None` if the path is not restricted to
+    elements with specific names.
+    
+    Such paths consist of a single step with a name test, so that testing them
+    against other elements, or against end events, has no effect.
+    """
+    names = set()
+    for steps in path.paths:
+        if len(steps) != 1:
+            return None
+        axis, nodetest, predicates = steps[0]
+        if axis == ATTRIBUTE or \
+                not isinstance(nodetest, (LocalNameTest, QualifiedNameTest)) or \
+                nodetest.principal_type == ATTRIBUTE:
+            return None
+        names.add(nodetest.name)
+    return names
+
+
+def _index_match_templates(match_templates):
+    """Index match templates by the local names of the elements they can
+    match.
+    
+    :param match_templates: the list of match templates of a context
+    :return: a ``(by_name, generic)`` tuple, where ``by_name`` maps local names
+             to the sorted indices of the match templates that need to be
+             tested against elements with that name, and ``generic`` is the
+             sorted list of indices of the match templates that need to be
+             tested against any event
+    """
+    by_name = {}
+    generic = []
+    for idx, match_template in enumerate(match_templates):
+        names = _match_names(match_template[1])
+        if names is None:
+            generic.append(idx)
+            for indices in by_name.values():
+                indices.append(idx)
+        else:
+            for name in names:
+                by_name.setdefault(name, list(generic)).append(idx)
+    return by_name, generic
+
+
+class _ChunkedStream(Stream):
+    """Stream generated by a markup template, which may contain `CHUNK`
+    events for static markup.
+    
+    The chunks are only passed on as such to the built-in serializers; when
+    the stream is iterated over, for example by stream filters, they are
+    replaced by the events they contain.
+    """
+    __slots__ = []
+
+    def __iter__(self):
+        return _expand_chunks(self.events)
+
+    def serialize(self, method='xml', **kwargs):
+        if method is None:
+            method = self.serializer or 'xml'
+        serializer = get_serializer(method, **kwargs)
+        if isinstance(serializer, (XMLSerializer, TextSerializer)):
+            return serializer(_ensure(self.events))
+        return serializer(_ensure(self))
+
+
+_FOLDABLE_DIRECTIVES = (AttrsDirective, ChooseDirective, ContentDirective,
+                        DefDirective, ForDirective, IfDirective,
+                        MatchDirective, OtherwiseDirective, ReplaceDirective,
+                        StripDirective, WhenDirective, WithDirective)
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Profiling of template rendering in terms of template source lines.
+
+The Python profiler shows where the time is spent in the template engine, but
+not which expressions or directives of a template are slow. The `Profiler`
+measures the time spent evaluating every expression, executing every code
+block, and applying every directive of a template, and reports it by file name
+and line number:
+
+>>> from genshi.template import MarkupTemplate
+>>> tmpl = MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+...   <li py:for="item in items">${item.upper()}</li>
+... </ul>''', filename='list.html')
+>>> profiler = Profiler()
+>>> print(profiler.generate(tmpl, items=['a', 'b']))
+<ul>
+  <li>A</li><li>B</li>
+</ul>
+>>> for entry in profiler.stats(sort='lineno'):
+...     print('%s:%d %s %d' % entry[:4])
+list.html:2 ${item.upper()} 2
+list.html:2 <ForDirective> 1
+
+Templates are profiled by rendering an instrumented copy of them, so that the
+template itself, and thus the rendering of templates while not profiling, is
+not affected in any way.
+"""
+
+import sys
+from timeit import default_timer
+
+from genshi.core import START
+from genshi.template.base import EXEC, EXPR, INCLUDE, SUB
+from genshi.template.eval import Expression, Suite
+
+__all__ = ['Profiler']
+__docformat__ = 'restructuredtext en'
+
+
+class Profiler(object):
+    """Collects the number of calls and the time spent in the expressions,
+    code blocks and directives of templates.
+
+    The statistics of every item are identified by the file name and line
+    number of the item, along with a description of the item, and accumulate
+    over all the renderings by the same profiler:
+
+     * ``calls``: the number of times the expression or code block was
+       evaluated, or the directive was applied
+     * ``tottime``: the time spent in the item itself, excluding the time
+       spent in other items; for a directive, this includes evaluating its
+       own expressions, such as the loop expression of a ``py:for``, but not
+       the evaluation of the expressions in the content of the element it is
+       attached to
+     * ``cumtime``: the time spent in the item, including the time spent in
+       other items, such as the directives nested in a directive
+
+    Templates included at render time are profiled too if they are loaded
+    through the loader of the profiled template.
+    """
+
+    SORT_KEYS = ('calls', 'tottime', 'cumtime', 'filename', 'lineno')
+    """The columns by which the statistics can be sorted."""
+
+    def __init__(self, timer=default_timer):
+        """Create the profiler.
+
+        :param timer: a function returning the current time in seconds
+        """
+        self.timer = timer
+        self._stats = {}
+        self._stack = []
+        self._templates = {}
+
+    def generate(self, template, *args, **kwargs):
+        """Apply the given template to the context data like
+        `Template.generate()`, profiling the resulting stream as it is
+        consumed.
+
+        :param template: the `Template` to render
+        :return: a markup event stream
+        """
+        return self.instrument(template).generate(*args, **kwargs)
+
+    def instrument(self, template):
+        """Return a copy of the given template that updates the statistics of
+        this profiler when it is rendered.
+
+        :param template: the `Template` to instrument
+        :return: the instrumented copy of the template
+        """
+        profiled = self._templates.get(id(template))
+        if profiled is not None and profiled[0] is template:
+            return profiled[1]
+
+        template.stream # make sure the template has been prepared
+        copy = object.__new__(type(template))
+        copy.__dict__.update(template.__getstate__())
+        copy.filters = [self._rebind(filter_, template, copy)
+                        for filter_ in template.filters]
+        if template.loader is not None:
+            copy.loader = _ProfiledLoader(self, template.loader)
+        memo = {}
+        copy._stream = self._instrument(template._stream, memo)
+        if getattr(template, '_chunked', None) is not None:
+            copy._chunked = self._instrument(template._chunked, memo)
+        self._templates[id(template)] = (template, copy)
+        return copy
+
+    def reset(self):
+        """Discard the statistics collected so far."""
+        self._stats.clear()
+
+    def stats(self, sort='cumtime'):
+        """Return the collected statistics.
+
+        :param sort: the name of the column to sort by, which must be one of
+                     `SORT_KEYS`; numeric columns are sorted in descending
+                     order
+        :return: a list of ``(filename, lineno, description, calls, tottime,
+                 cumtime)`` tuples
+        :rtype: `list`
+        """
+        if sort not in self.SORT_KEYS:
+            raise ValueError('Invalid sort key %r, must be one of %s' %
+                             (sort, ', '.join(self.SORT_KEYS)))
+        entries = [key + tuple(values) for key, values in self._stats.items()]
+        if sort == 'filename':
+            entries.sort(key=lambda entry: entry[:3])
+        elif sort == 'lineno':
+            entries.sort(key=lambda entry: (entry[1], entry[0], entry[2]))
+        else:
+            column = 3 + list(self.SORT_KEYS).index(sort)
+            entries.sort(key=lambda entry: entry[column], reverse=True)
+        return entries
+
+    def print_stats(self, sort='cumtime', limit=None, out=None):
+        """Print a report of the collected statistics.
+
+        :param sort: the name of the column to sort by
+        :param limit: the maximum number of lines to print
+        :param out: the file-like object to write to; defaults to
+                    `sys.stdout`
+        """
+        if out is None:
+            out = sys.stdout
+        entries = self.stats(sort)
+        if limit is not None:
+            entries = entries[:limit]
+        out.write('%8s %10s %10s  %s\n' % ('calls', 'tottime', 'cumtime',
+                                           'filename:lineno(description)'))
+        for filename, lineno, description, calls, tottime, cumtime in entries:
+            if len(description) > 60:
+                description = description[:57] + '...'
+            out.write('%8d %10.6f %10.6f  %s:%d(%s)\n' % (calls, tottime,
+                      cumtime, filename, lineno, description))
+
+    def _rebind(self, filter_, template, copy):
+        if getattr(filter_, '__self__', None) is template:
+            return getattr(copy, filter_.__name__)
+        return filter_
+
+    def _instrument(self, stream, memo):
+        if stream is None:
+            return None
+        retval = []
+        for kind, data, pos in stream:
+            if kind is EXPR or kind is EXEC:
+                data = self._wrap_code(data, pos, memo)
+            elif kind is SUB:
+                directives, substream = data
+                data = ([self._wrap_directive(directive, pos, memo)
+                         for directive in directives],
+                        self._instrument(substream, memo))
+            elif kind is START and data[1]:
+                tag, attrs = data
+                new_attrs = []
+                for name, value in attrs:
+                    if type(value) is list:
+                        value = self._instrument(value, memo)
+                    new_attrs.append((name, value))
+                data = tag, type(attrs)(new_attrs)
+            elif kind is INCLUDE:
+                href, cls, fallback = data
+                if type(href) is list:
+                    href = self._instrument(href, memo)
+                data = href, cls, self._instrument(fallback, memo)
+            retval.append((kind, data, pos))
+        return retval
+
+    def _key(self, obj, pos):
+        filename, lineno = pos[:2]
+        if isinstance(obj, Expression):
+            description = '${%s}' % obj.source
+        elif isinstance(obj, Suite):
+            lines = [line.strip() for line in obj.source.splitlines()
+                     if line.strip()] or ['']
+            description = '<?python %s ?>' % lines[0]
+        else:
+            description = repr(obj)
+        return filename or '<string>', lineno, description
+
+    def _wrap_code(self, code, pos, memo):
+        wrapped = memo.get(id(code))
+        if wrapped is None:
+            wrapped = memo[id(code)] = _ProfiledCode(code, self,
+                                                     self._key(code, pos))
+        return wrapped
+
+    def _wrap_directive(self, directive, pos, memo):
+        wrapped = memo.get(id(directive))
+        if wrapped is None:
+            cls = _profiled_class(type(directive))
+            wrapped = memo[id(directive)] = object.__new__(cls)
+            for base in type(directive).__mro__:
+                slots = base.__dict__.get('__slots__', ())
+                if isinstance(slots, basestring):
+                    slots = [slots]
+                for name in slots:
+                    if hasattr(directive, name):
+                        setattr(wrapped, name, getattr(directive, name))
+            if hasattr(directive, '__dict__'):
+                wrapped.__dict__.update(directive.__dict__)
+            wrapped._profiler = self
+            wrapped._profile_key = self._key(directive, pos)
+        return wrapped
+
+    def _start(self, key):
+        self._stack.append([key, self.timer(), 0])
+
+    def _stop(self, calls=0):
+        key, start, inner = self._stack.pop()
+        elapsed = self.timer() - start
+        entry = self._stats.get(key)
+        if entry is None:
+            entry = self._stats[key] = [0, 0, 0]
+        entry[0] += calls
+        entry[1] += elapsed - inner
+        entry[2] += elapsed
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def _iterate(self, key, iterable):
+        # The time spent in a directive is the time spent producing the
+        # events of the stream it returns, which happens lazily
+        while 1:
+            self._start(key)
+            try:
+                event = iterable.next()
+            except StopIteration:
+                self._stop()
+                return
+            except:
+                self._stop()
+                raise
+            self._stop()
+            yield event
+
+
+class _ProfiledCode(object):
+    """Wraps an `Expression` or `Suite` to measure its evaluation."""
+
+    __slots__ = ['_code', '_profiler', '_key']
+
+    def __init__(self, code, profiler, key):
+        self._code = code
+        self._profiler = profiler
+        self._key = key
+
+    def __getattr__(self, name):
+        return getattr(self._code, name)
+
+    def __repr__(self):
+        return repr(self._code)
+
+    def evaluate(self, data):
+        self._profiler._start(self._key)
+        try:
+            return self._code.evaluate(data)
+        finally:
+            self._profiler._stop(1)
+
+    def execute(self, data):
+        self._profiler._start(self._key)
+        try:
+            self._code.execute(data)
+        finally:
+            self._profiler._stop(1)
+
+
+_profiled_classes = {}
+
+def _profiled_class(cls):
+    """Return a subclass of the given directive class that measures the
+    application of the directive.
+    """
+    profiled = _profiled_classes.get(cls)
+    if profiled is None:
+        def __call__(self, stream, directives, ctxt, **vars):
+            profiler = self._profiler
+            profiler._start(self._profile_key)
+            try:
+                stream = cls.__call__(self, stream, directives, ctxt, **vars)
+            finally:
+                profiler._stop(1)
+            if stream is not None and not isinstance(stream, (list, tuple)):
+                stream = profiler._iterate(self._profile_key, iter(stream))
+            return stream
+        # Keep the name of the class, which is also used to derive the tag
+        # name of directives
+        profiled = type(cls)(cls.__name__, (cls,), {
+            '__slots__': ['_profiler', '_profile_key'],
+            '__call__': __call__,
+            '__module__': cls.__module__
+        })
+        _profiled_classes[cls] = profiled
+    return profiled
+
+
+class _ProfiledLoader(object):
+    """Wraps a template loader so that the templates it loads are profiled."""
+
+    def __init__(self, profiler, loader):
+        self._profiler = profiler
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def load(self, *args, **kwargs):
+        return self._profiler.instrument(self._loader.load(*args, **kwargs))
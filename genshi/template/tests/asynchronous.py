@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import time
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+else:
+    # Compiled at runtime, as the module has to remain parseable by Python 2
+    exec(compile("""
+async def value(result, delay=0):
+    await asyncio.sleep(delay)
+    return result
+""", __file__, 'exec'))
+
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+
+class AsyncStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def _value(self, result, delay=0):
+        return value(result, delay)
+
+    def test_no_awaitables(self):
+        tmpl = MarkupTemplate('<p>${greeting}</p>')
+        stream = tmpl.generate_async(greeting='Hello')
+        self.assertEqual('<p>Hello</p>', self._run(stream.render()))
+        self.assertEqual(b'<p>Hello</p>',
+                         self._run(stream.render(encoding='utf-8')))
+
+    def test_awaitable_expressions(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items()" py:attrs="attrs(item)">${label(item)}</li>
+        </ul>""")
+        stream = tmpl.generate_async(
+            items=lambda: self._value([1, 2]),
+            attrs=lambda item: self._value({'class': 'item%d' % item}),
+            label=lambda item: self._value('Item %d' % item))
+        self.assertEqual("""<ul>
+          <li class="item1">Item 1</li><li class="item2">Item 2</li>
+        </ul>""", self._run(stream.render()))
+
+    def test_awaitable_data(self):
+        tmpl = MarkupTemplate('<p>${user.upper()}</p>')
+        stream = tmpl.generate_async(user=self._value('joe'))
+        self.assertEqual('<p>JOE</p>', self._run(stream.render()))
+
+    def test_awaitable_condition(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:if="visible()" py:with="items = items()">${len(items)}</p>
+        </div>""")
+        stream = tmpl.generate_async(visible=lambda: self._value(True),
+                                     items=lambda: self._value([1, 2, 3]))
+        self.assertEqual("""<div>
+          <p>3</p>
+        </div>""", self._run(stream.render()))
+
+    def test_text_template(self):
+        tmpl = NewTextTemplate('Hello, ${name()}!')
+        stream = tmpl.generate_async(name=lambda: self._value('world'))
+        self.assertEqual('Hello, world!', self._run(stream.render()))
+
+    def test_same_awaitable_twice(self):
+        class Item(object):
+            value = self._value('x')
+        tmpl = MarkupTemplate('<p>${item.value}${item.value}</p>')
+        stream = tmpl.generate_async(item=Item())
+        self.assertEqual('<p>xx</p>', self._run(stream.render()))
+
+    def test_awaitable_data_run_concurrently(self):
+        tmpl = MarkupTemplate('<p>$a$b$c$d$e</p>')
+        data = dict([(name, self._value(name, 0.1)) for name in 'abcde'])
+        stream = tmpl.generate_async(**data)
+        start = time.time()
+        self.assertEqual('<p>abcde</p>', self._run(stream.render()))
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_prefetch_awaitables_run_concurrently(self):
+        tmpl = MarkupTemplate("""<p xmlns:py="http://genshi.edgewall.org/"
+            py:prefetch="a = fetch('a'); b = fetch('b'); c = fetch('c');
+                         d = fetch('d'); e = fetch('e')">$a$b$c$d$e</p>""")
+        stream = tmpl.generate_async(fetch=lambda item: self._value(item, 0.1))
+        start = time.time()
+        self.assertEqual('<p>abcde</p>', self._run(stream.render()))
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_event_loop_not_blocked(self):
+        ticks = []
+        def tick():
+            ticks.append(None)
+            self.loop.call_soon(tick)
+        self.loop.call_soon(tick)
+        tmpl = MarkupTemplate("""<p xmlns:py="http://genshi.edgewall.org/">
+          <b py:for="idx in range(1000)">$idx</b>
+        </p>""")
+        stream = tmpl.generate_async()
+        self._run(stream.render())
+        self.assertTrue(len(ticks) >= 10)
+
+    def test_iter_encoded(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="idx in range(10)">${value(idx)}</li>
+        </ul>""")
+        stream = tmpl.generate_async(value=self._value)
+        iterator = stream.iter_encoded(chunk_size=20)
+        self.assertTrue(iterator.__aiter__() is iterator)
+        chunks = []
+        while 1:
+            try:
+                chunks.append(self._run(iterator.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(self._run(stream.render(encoding='utf-8')),
+                         b''.join(chunks))
+
+    def test_iter_encoded_before_awaiting(self):
+        calls = []
+        def fetch():
+            calls.append(None)
+            return self._value('x')
+        tmpl = MarkupTemplate("""<html><head><title>Test</title></head>
+          <body>${fetch()}</body></html>""")
+        stream = tmpl.generate_async(fetch=fetch)
+        iterator = stream.iter_encoded(flush_after='</head>')
+        self.assertEqual(b'<html><head><title>Test</title></head>',
+                         self._run(iterator.__anext__()))
+        self.assertEqual([], calls)
+        self.assertEqual(b'\n          <body>x</body></html>',
+                         self._run(iterator.__anext__()))
+        self.assertEqual([None], calls)
+        self.assertRaises(StopAsyncIteration, self._run,
+                          iterator.__anext__())
+
+    def test_resolve(self):
+        tmpl = MarkupTemplate('<p>${value()}</p>')
+        stream = tmpl.generate_async(value=lambda: self._value('x'))
+        self.assertEqual('<p>x</p>', str(self._run(stream.resolve())))
+
+    def test_results_follow_values(self):
+        fetched = []
+        def fetch(item):
+            fetched.append(item)
+            return self._value('fetched-%s' % item)
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/"
+                                   py:with="its = items()">
+          <p py:for="i in list(its) + ['z']">${fetch(i)}</p>
+        </div>""")
+        stream = tmpl.generate_async(items=lambda: self._value(['a']),
+                                     fetch=fetch)
+        self.assertEqual("""<div>
+          <p>fetched-a</p><p>fetched-z</p>
+        </div>""", self._run(stream.render()))
+        self.assertEqual(['a', 'z'], fetched)
+
+    def test_macro_in_and_after_loop(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:def function="show(item)"><b>${fetch(item)}</b></py:def>
+          <py:for each="item in items()">${show(item)}</py:for>
+          ${show('last')}
+        </div>""")
+        stream = tmpl.generate_async(items=lambda: self._value(['a', 'b']),
+                                     fetch=lambda item: self._value(item))
+        self.assertEqual("""<div>
+          <b>a</b><b>b</b>
+          <b>last</b>
+        </div>""", self._run(stream.render()))
+
+    def test_dependent_awaitable_not_awaited_early(self):
+        fetched = []
+        def profile(user):
+            fetched.append(user)
+            return self._value(user.upper())
+        tmpl = MarkupTemplate("""<p xmlns:py="http://genshi.edgewall.org/"
+                                 py:with="user = user()">${profile(user)}</p>""")
+        stream = tmpl.generate_async(user=lambda: self._value('joe'),
+                                     profile=profile)
+        self.assertEqual('<p>JOE</p>', self._run(stream.render()))
+        self.assertEqual(['joe'], fetched)
+
+    def test_side_effects_once(self):
+        calls = []
+        def fetch(item):
+            calls.append(item)
+            return self._value(item * 2)
+        tmpl = MarkupTemplate("""<p xmlns:py="http://genshi.edgewall.org/">
+          <?python
+            calls.append('python')
+            count = len(calls)
+          ?>${fetch(count)}
+          <py:with vars="six = fetch(3)">${fetch(six)}</py:with>
+        </p>""")
+        stream = tmpl.generate_async(calls=calls, fetch=fetch)
+        self.assertEqual("""<p>
+          2
+          12
+        </p>""", self._run(stream.render()))
+        self.assertEqual(['python', 1, 3, 6], calls)
+
+    def test_error_in_expression(self):
+        tmpl = MarkupTemplate("""<p xmlns:py="http://genshi.edgewall.org/">
+          ${value()}<py:with vars="zero = zero()">${1 // zero}</py:with>
+        </p>""")
+        stream = tmpl.generate_async(value=lambda: self._value('x'),
+                                     zero=lambda: self._value(0))
+        self.assertRaises(ZeroDivisionError, self._run, stream.render())
+
+    def test_error_in_awaitable(self):
+        future = self.loop.create_future()
+        future.set_exception(KeyError('fail'))
+        tmpl = MarkupTemplate('<p>${value()}</p>')
+        stream = tmpl.generate_async(value=lambda: future)
+        self.assertRaises(KeyError, self._run, stream.render())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    if asyncio is not None:
+        from genshi.template import asynchronous
+        suite.addTest(doctest.DocTestSuite(asynchronous))
+        suite.addTest(unittest.makeSuite(AsyncStreamTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
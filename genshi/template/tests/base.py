@@ -15,6 +15,7 @@ import doctest
 import unittest
 
 from genshi.template.base import Template, Context
+from genshi.template.eval import Expression
 
 
 class ContextTestCase(unittest.TestCase):
@@ -30,6 +31,56 @@ class ContextTestCase(unittest.TestCase):
         self.assertEqual(repr(orig_ctxt), repr(ctxt))
         self.assertEqual(orig_ctxt._match_templates, ctxt._match_templates)
         self.assertEqual(orig_ctxt._choice_stack, ctxt._choice_stack)
+        self.assertEqual(7, ctxt['c'])
+        ctxt.pop()
+        self.assertEqual(None, ctxt.get('c'))
+        self.assertEqual(7, orig_ctxt['c'])
+
+    def test_shadowing(self):
+        ctxt = Context(a=1, b=2)
+        for depth in range(10):
+            ctxt.push({'a': depth})
+        self.assertEqual(9, ctxt['a'])
+        self.assertEqual(2, ctxt['b'])
+        ctxt['b'] = 3
+        self.assertEqual(3, ctxt['b'])
+        self.assertEqual({'a': 9, 'b': 3}, ctxt.pop())
+        self.assertEqual(8, ctxt['a'])
+        self.assertEqual(2, ctxt['b'])
+        for depth in range(9):
+            ctxt.pop()
+        self.assertEqual(1, ctxt['a'])
+        self.assertEqual([('a', 1), ('b', 2)], sorted([item for item
+                                                       in ctxt.items()
+                                                       if item[0] in 'ab']))
+
+    def test_update_and_delete(self):
+        ctxt = Context(a=1)
+        frame = {}
+        ctxt.push(frame)
+        frame['b'] = 2 # added directly, but not shadowing anything
+        self.assertEqual(2, ctxt['b'])
+        frame['a'] = 3
+        ctxt.update(frame)
+        self.assertEqual(3, ctxt['a'])
+        del ctxt['a']
+        self.assertFalse('a' in ctxt)
+        self.assertEqual({'b': 2}, ctxt.pop())
+        self.assertFalse('a' in ctxt)
+        self.assertFalse('b' in ctxt)
+        self.assertRaises(KeyError, ctxt.__getitem__, 'b')
+
+    def test_direct_frame_mutation(self):
+        ctxt = Context(a=1)
+        ctxt.push({})
+        ctxt.frames[0]['a'] = 2 # as done by some directives
+        self.assertEqual(2, ctxt['a'])
+        self.assertEqual(2, ctxt.get('a'))
+        self.assertEqual(2, dict(ctxt.items())['a'])
+        self.assertEqual(2, Expression('a').evaluate(ctxt))
+        self.assertEqual(3, Expression('a + 1').evaluate(ctxt))
+        ctxt.pop()
+        self.assertEqual(1, ctxt['a'])
 
 
 def suite():
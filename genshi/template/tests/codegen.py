@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from genshi.compat import BytesIO
+from genshi.core import Markup
+from genshi.template import codegen
+from genshi.template.base import TemplateRuntimeError
+from genshi.template.codegen import CompiledMarkupTemplate
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+
+
+class CompiledMarkupTemplateTestCase(unittest.TestCase):
+    """Tests for compiled markup templates."""
+
+    def _assert_same(self, source, **data):
+        expected = MarkupTemplate(source).generate(**data).render(encoding=None)
+        tmpl = CompiledMarkupTemplate(source)
+        self.assertEqual(expected, tmpl.generate(**data).render(encoding=None))
+        self.assertTrue(tmpl._render)
+        return expected
+
+    def test_expressions(self):
+        self._assert_same("""<div>
+          ${text} ${markup} ${number} ${items} ${obj} ${none}
+        </div>""", text='<b>', markup=Markup('<i>x</i>'),
+                   number=42.5, items=['a', 1], obj=object, none=None)
+
+    def test_interpolated_attrs(self):
+        self._assert_same("""<div>
+          <span class="${a} ${b}" title="$none" id="x${n}"
+                lang="${items}">$a</span>
+        </div>""", a='foo', b=None, none=None, n=3, items=['x', 2])
+
+    def test_for_if(self):
+        self._assert_same("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="idx, (key, value) in enumerate(items)"
+              py:if="idx % 2">$key: $value</li>
+        </ul>""", items=[('a', 1), ('b', 2), ('c', 3)])
+
+    def test_nested_for(self):
+        self._assert_same("""<table xmlns:py="http://genshi.edgewall.org/">
+          <tr py:for="row in rows"><td py:for="cell in row">$cell</td></tr>
+        </table>""", rows=[[1, 2], [3, 4]])
+
+    def test_choose(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:for each="value in range(4)"><py:choose test="value">
+            <span py:when="1">one</span>
+            <span py:when="2">two</span>
+            <span py:otherwise="">other</span>
+          </py:choose><py:choose>
+            <span py:when="value > 1">big</span>
+            <span py:otherwise="">small</span>
+          </py:choose></py:for>
+        </div>""")
+
+    def test_when_outside_choose(self):
+        tmpl = CompiledMarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <div py:when="xy" />
+        </doc>""")
+        self.assertRaises(TemplateRuntimeError, str, tmpl.generate())
+
+    def test_with(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <span py:with="x = 7; y, z = x * 2, x * 3">$x $y $z</span>
+          <py:with vars="x = 1">$x</py:with>
+        </div>""", x=42)
+
+    def test_def(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:def="echo(greeting, name='world')" class="message">
+            ${greeting}, ${name}!
+          </p>
+          <py:def function="empty()"></py:def>
+          ${echo('Hi', name='you')} ${echo('Hello')} ${empty()}
+        </div>""")
+
+    def test_attrs_and_strip(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <span class="foo" title="${title}" py:attrs="attrs">text</span>
+          <span py:strip="strip">stripped</span>
+          <span py:strip="not strip">kept</span>
+          <span py:strip="">always stripped</span>
+          <span py:attrs="attrs" py:strip="strip">both</span>
+        </div>""", attrs={'class': 'bar', 'id': None}, strip=True,
+                   title='Hello')
+
+    def test_exec(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <?python
+            x = 21 * 2
+          ?>
+          $x
+        </div>""")
+
+    def test_match(self):
+        self._assert_same("""<html xmlns:py="http://genshi.edgewall.org/">
+          <span py:match="greeting" py:if="True">
+            Hello ${select('@name')}
+          </span>
+          <greeting name="$name" py:for="name in names" />
+        </html>""", names=['Dude', 'Guy'])
+
+    def test_pickle(self):
+        tmpl = CompiledMarkupTemplate('<root>$var</root>')
+        self.assertEqual('<root>42</root>', str(tmpl.generate(var=42)))
+        buf = BytesIO()
+        pickle.dump(tmpl, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        self.assertEqual('<root>42</root>', str(unpickled.generate(var=42)))
+
+    def test_translator_disables_compilation(self):
+        from genshi.filters.i18n import Translator
+        tmpl = CompiledMarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <p>Hello ${name}</p>
+        </html>""")
+        Translator(lambda s: s.upper()).setup(tmpl)
+        self.assertEqual("""<html>
+          <p>HELLO World</p>
+        </html>""", str(tmpl.generate(name='World')))
+
+
+class CompiledIncludeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, filename, text):
+        file = open(os.path.join(self.dirname, filename), 'w')
+        try:
+            file.write(text)
+        finally:
+            file.close()
+
+    def test_include(self):
+        self._write('tmpl1.html', """<div>Included $x</div>""")
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+          <xi:include href="missing.html"><xi:fallback>Missing</xi:fallback></xi:include>
+        </html>""")
+        for auto_reload in (False, True):
+            loader = TemplateLoader([self.dirname], auto_reload=auto_reload,
+                                    default_class=CompiledMarkupTemplate)
+            tmpl = loader.load('tmpl2.html')
+            self.assertEqual("""<html>
+          <div>Included 1</div>
+          Missing
+        </html>""", tmpl.generate(x=1).render(encoding=None))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(codegen))
+    suite.addTest(unittest.makeSuite(CompiledMarkupTemplateTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CompiledIncludeTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
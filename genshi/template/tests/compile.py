@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from genshi.compat import StringIO
+from genshi.template.compile import compile_templates, main
+from genshi.template.loader import TemplateLoader, directory, prefixed
+
+
+class CompileTestCase(unittest.TestCase):
+    """Tests for the template precompilation tool."""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+        self.cache_dir = os.path.join(self.dirname, 'cache')
+        os.mkdir(os.path.join(self.dirname, 'templates'))
+        os.mkdir(os.path.join(self.dirname, 'templates', 'sub'))
+        self._write('index.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="sub/layout.html" />
+        </html>""")
+        self._write('sub/layout.html', """<div>$title</div>""")
+        self._write('mail.txt', """Hello $name""")
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.dirname)
+
+    def _write(self, filename, text):
+        path = os.path.join(self.dirname, 'templates', *filename.split('/'))
+        fileobj = open(path, 'w')
+        try:
+            fileobj.write(text)
+        finally:
+            fileobj.close()
+
+    def test_list_templates(self):
+        templates = os.path.join(self.dirname, 'templates')
+        loader = TemplateLoader([templates])
+        self.assertEqual(['index.html', 'mail.txt', 'sub/layout.html'],
+                         loader.list_templates())
+        loader = TemplateLoader([prefixed(app=directory(templates),
+                                          other=templates)])
+        self.assertEqual(['app/index.html', 'app/mail.txt',
+                          'app/sub/layout.html', 'other/index.html',
+                          'other/mail.txt', 'other/sub/layout.html'],
+                         loader.list_templates())
+
+    def test_compile_templates(self):
+        loader = TemplateLoader([os.path.join(self.dirname, 'templates')],
+                                cache_dir=self.cache_dir)
+        results = list(compile_templates(loader, patterns=['*.html']))
+        self.assertEqual(['index.html', 'sub/layout.html'],
+                         [name for name, seconds, error in results])
+        self.assertEqual([None, None],
+                         [error for name, seconds, error in results])
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_main(self):
+        status = main(['-d', self.cache_dir, '-p', '*.html',
+                       os.path.join(self.dirname, 'templates')])
+        self.assertEqual(0, status)
+        output = sys.stdout.getvalue()
+        self.assertTrue('index.html' in output)
+        self.assertTrue('2 templates compiled' in output)
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_main_text_templates(self):
+        status = main(['-q', '-d', self.cache_dir, '-p', '*.txt', '-c',
+                       'genshi.template:NewTextTemplate',
+                       os.path.join(self.dirname, 'templates')])
+        self.assertEqual(0, status)
+        self.assertEqual('', sys.stdout.getvalue())
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    def test_main_syntax_error(self):
+        self._write('broken.html', """<div>${title</div>""")
+        status = main(['-d', self.cache_dir, '-p', '*.html',
+                       os.path.join(self.dirname, 'templates')])
+        self.assertEqual(1, status)
+        self.assertTrue('broken.html' in sys.stderr.getvalue())
+        self.assertTrue('1 failed' in sys.stdout.getvalue())
+
+    def test_main_jobs(self):
+        self._write('broken.html', """<div>${title</div>""")
+        status = main(['-j', '2', '-d', self.cache_dir, '-p', '*.html',
+                       os.path.join(self.dirname, 'templates')])
+        self.assertEqual(1, status)
+        self.assertTrue('broken.html' in sys.stderr.getvalue())
+        self.assertTrue('2 templates compiled' in sys.stdout.getvalue())
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_main_include_error(self):
+        self._write('broken.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="missing.html" />
+        </html>""")
+        status = main(['-d', self.cache_dir, '-p', 'broken.html',
+                       os.path.join(self.dirname, 'templates')])
+        self.assertEqual(1, status)
+        self.assertTrue('missing.html' in sys.stderr.getvalue())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CompileTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
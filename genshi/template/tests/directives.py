@@ -14,10 +14,12 @@
 import doctest
 import re
 import sys
+import threading
 import unittest
 
-from genshi.template import directives, MarkupTemplate, TextTemplate, \
-                            TemplateRuntimeError, TemplateSyntaxError
+from genshi.template import directives, MarkupTemplate, NewTextTemplate, \
+                            TextTemplate, TemplateRuntimeError, \
+                            TemplateSyntaxError
 
 
 class AttrsDirectiveTestCase(unittest.TestCase):
@@ -1212,6 +1214,105 @@ class WithDirectiveTestCase(unittest.TestCase):
           <span>Text</span></div>""", tmpl.generate().render(encoding=None))
 
 
+class PrefetchDirectiveTestCase(unittest.TestCase):
+    """Tests for the `py:prefetch` template directive."""
+
+    def test_as_element(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:prefetch vars="y = x * 2; z = x + 1">${y} ${z}</py:prefetch>
+          ${x}
+        </div>""")
+        self.assertEqual("""<div>
+          84 43
+          42
+        </div>""", tmpl.generate(x=42).render(encoding=None))
+
+    def test_concurrent_evaluation(self):
+        first, second = threading.Event(), threading.Event()
+        def wait(own, other):
+            own.set()
+            other.wait(10)
+            return other.isSet()
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:prefetch="a = wait(first, second); b = wait(second, first)">
+            $a $b
+          </p>
+        </div>""")
+        self.assertEqual("""<div>
+          <p>
+            True True
+          </p>
+        </div>""", tmpl.generate(wait=wait, first=first,
+                                 second=second).render(encoding=None))
+
+    def test_loop_variable(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items" py:prefetch="a = item * 2; b = item * 3">$a $b</li>
+        </ul>""")
+        self.assertEqual("""<ul>
+          <li>2 3</li><li>4 6</li>
+        </ul>""", tmpl.generate(items=[1, 2]).render(encoding=None))
+
+    def test_error(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:prefetch="a = 1; b = 1 // 0">$a $b</p>
+        </div>""")
+        self.assertRaises(ZeroDivisionError, tmpl.generate().render)
+
+    def test_variable_of_same_directive(self):
+        for value in ('a = 1; b = a + 1', 'a, (b, c) = x; d = [c]'):
+            tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+              <p py:prefetch="%s">$a</p>
+            </div>""" % value)
+            self.assertRaises(TemplateSyntaxError, tmpl.generate)
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:prefetch="a = a + 1; b = c * 2">$a $b</p>
+        </div>""")
+        self.assertEqual("""<div>
+          <p>2 6</p>
+        </div>""", tmpl.generate(a=1, c=3).render(encoding=None))
+
+    def test_nested(self):
+        calls = []
+        class Executor(object):
+            def submit(self, func, *args):
+                calls.append(func)
+                return directives._ThreadExecutor().submit(func, *args)
+        inner = MarkupTemplate("""<b xmlns:py="http://genshi.edgewall.org/"
+             py:prefetch="a = x; b = x + 1">$a $b</b>""")
+        def render(x):
+            return inner.generate(x=x).render(encoding=None)
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:prefetch="a = render(1); b = render(3)">$a $b</p>
+        </div>""")
+        executor = directives.PrefetchDirective.executor
+        directives.PrefetchDirective.executor = Executor()
+        try:
+            self.assertEqual("""<div>
+          <p>&lt;b&gt;1 2&lt;/b&gt; &lt;b&gt;3 4&lt;/b&gt;</p>
+        </div>""", tmpl.generate(render=render).render(encoding=None))
+        finally:
+            directives.PrefetchDirective.executor = executor
+        # The inner directive evaluated by the executor does not use it
+        self.assertEqual(2, len(calls))
+
+    def test_executor(self):
+        calls = []
+        class Executor(object):
+            def submit(self, func, *args):
+                calls.append(func)
+                return directives._ThreadExecutor().submit(func, *args)
+        tmpl = NewTextTemplate("""{% prefetch a = 1; b = 2; c = 3 %}\
+${a} ${b} ${c}{% end %}""")
+        executor = directives.PrefetchDirective.executor
+        directives.PrefetchDirective.executor = Executor()
+        try:
+            self.assertEqual('1 2 3', tmpl.generate().render(encoding=None))
+        finally:
+            directives.PrefetchDirective.executor = executor
+        self.assertEqual(2, len(calls))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocTestSuite(directives))
@@ -1225,6 +1326,7 @@ def suite():
     suite.addTest(unittest.makeSuite(ReplaceDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(StripDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(WithDirectiveTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(PrefetchDirectiveTestCase, 'test'))
     return suite
 
 if __name__ == '__main__':
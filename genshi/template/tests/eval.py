@@ -21,7 +21,7 @@ import unittest
 from genshi.core import Markup
 from genshi.template.base import Context
 from genshi.template.eval import Expression, Suite, Undefined, UndefinedError, \
-                                 UNDEFINED
+                                 UNDEFINED, LenientLookup, StrictLookup
 from genshi.compat import BytesIO, IS_PYTHON2, wrapped_bytes
 
 
@@ -51,6 +51,68 @@ class ExpressionTestCase(unittest.TestCase):
         self.assertEqual('bar', Expression('id').evaluate({'id': 'bar'}))
         self.assertEqual(None, Expression('id').evaluate({'id': None}))
 
+    def test_name_chain_lookup(self):
+        class Something(object):
+            attr = {'item': 'foo'}
+        data = {'obj': Something()}
+        expr = Expression('obj.attr.item')
+        self.assertEqual(('obj', ('attr', 'item')), expr._chain)
+        self.assertEqual('foo', expr.evaluate(data))
+        self.assertEqual(None, Expression('x + 1')._chain)
+        self.assertEqual(None, Expression('None')._chain)
+        self.assertRaises(UndefinedError, Expression('obj.nil').evaluate,
+                          data)
+        expr = Expression('obj.nil.item', lookup='lenient')
+        self.assertRaises(UndefinedError, expr.evaluate, data)
+        expr = Expression('nothing', lookup='lenient')
+        self.assertEqual(Undefined, type(expr.evaluate(data)))
+
+    def test_name_chain_error(self):
+        calls = []
+        class Something(object):
+            def prop(self):
+                calls.append('prop')
+                raise ValueError('failed')
+            prop = property(prop)
+            def __getattr__(self, name):
+                calls.append(name)
+                return name
+        data = {'obj': Something()}
+        try:
+            Expression('obj.prop').evaluate(data)
+            self.fail('Expected ValueError')
+        except ValueError, e:
+            self.assertEqual('failed', str(e))
+        self.assertEqual(['prop'], calls)
+        del calls[:]
+        self.assertEqual('other', Expression('obj.other').evaluate(data))
+        self.assertEqual(['other'], calls)
+
+    def test_name_chain_undefined(self):
+        calls = []
+        class Something(object):
+            def prop(self):
+                calls.append('prop')
+                return {}
+            prop = property(prop)
+        expr = Expression('obj.prop.nil', filename='index.html', lineno=50)
+        try:
+            expr.evaluate({'obj': Something()})
+            self.fail('Expected UndefinedError')
+        except UndefinedError, e:
+            self.assertEqual('{} has no member named "nil" '
+                             '(index.html, line 50)', str(e))
+        self.assertEqual(['prop'], calls)
+
+    def test_pickle_name_chain(self):
+        expr = Expression('obj.attr', lookup='lenient')
+        buf = BytesIO()
+        pickle.dump(expr, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        self.assertEqual(('obj', ('attr',)), unpickled._chain)
+        self.assertEqual(Undefined, type(unpickled.evaluate({'obj': 42})))
+
     def test_builtins(self):
         expr = Expression('Markup')
         self.assertEqual(expr.evaluate({}), Markup)
@@ -417,18 +479,11 @@ class ExpressionTestCase(unittest.TestCase):
             expr.evaluate({})
             self.fail('Expected UndefinedError')
         except UndefinedError, e:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            frame = exc_traceback.tb_next
-            frames = []
-            while frame.tb_next:
-                frame = frame.tb_next
-                frames.append(frame)
-            self.assertEqual('"nothing" not defined', str(e))
-            self.assertEqual("<Expression 'nothing'>",
-                             frames[-3].tb_frame.f_code.co_name)
-            self.assertEqual('index.html',
-                             frames[-3].tb_frame.f_code.co_filename)
-            self.assertEqual(50, frames[-3].tb_lineno)
+            self.assertEqual('"nothing" not defined', e.msg)
+            self.assertEqual('"nothing" not defined (index.html, line 50)',
+                             str(e))
+            self.assertEqual('index.html', e.filename)
+            self.assertEqual(50, e.lineno)
 
     def test_error_getattr_undefined(self):
         class Something(object):
@@ -440,19 +495,9 @@ class ExpressionTestCase(unittest.TestCase):
             expr.evaluate({'something': Something()})
             self.fail('Expected UndefinedError')
         except UndefinedError, e:
-            self.assertEqual('<Something> has no member named "nil"', str(e))
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            search_string = "<Expression 'something.nil'>"
-            frame = exc_traceback.tb_next
-            while frame.tb_next:
-                frame = frame.tb_next
-                code = frame.tb_frame.f_code
-                if code.co_name == search_string:
-                    break
-            else:
-                self.fail("never found the frame I was looking for")
-            self.assertEqual('index.html', code.co_filename)
-            self.assertEqual(50, frame.tb_lineno)
+            self.assertEqual('<Something> has no member named "nil"', e.msg)
+            self.assertEqual('index.html', e.filename)
+            self.assertEqual(50, e.lineno)
 
     def test_error_getitem_undefined_string(self):
         class Something(object):
@@ -464,7 +509,9 @@ class ExpressionTestCase(unittest.TestCase):
             expr.evaluate({'something': Something()})
             self.fail('Expected UndefinedError')
         except UndefinedError, e:
-            self.assertEqual('<Something> has no member named "nil"', str(e))
+            self.assertEqual('<Something> has no member named "nil"', e.msg)
+            self.assertEqual('index.html', e.filename)
+            self.assertEqual(50, e.lineno)
             exc_type, exc_value, exc_traceback = sys.exc_info()
             search_string = '''<Expression 'something["nil"]'>'''
             frame = exc_traceback.tb_next
@@ -702,6 +749,21 @@ x = create()
         assert 'repeat' not in data
         self.assertEqual([1, 1, 1], list(data['fun']()))
 
+    def test_globals_shared_in_context(self):
+        data = Context(items=[1, 2, 3], limit=1)
+        Suite("""def above(value):
+    return value > limit
+""").execute(data)
+        expr = Expression('[item for item in items if above(item)]')
+        self.assertEqual([2, 3], expr.evaluate(data))
+        data['limit'] = 2
+        self.assertEqual([3], expr.evaluate(data))
+        self.assertEqual(1, len(data._globals))
+        _globals = data._globals.values()[0]
+        self.assertTrue(_globals is StrictLookup.globals(data))
+        self.assertFalse(_globals is LenientLookup.globals(data))
+        self.assertFalse(StrictLookup.globals({}) is StrictLookup.globals({}))
+
     def test_for(self):
         suite = Suite("""x = []
 for i in range(3):
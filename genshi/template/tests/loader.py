@@ -15,11 +15,14 @@ import doctest
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 
 from genshi.core import TEXT
-from genshi.template.loader import TemplateLoader
+from genshi.filters.i18n import Translator
+from genshi.template.loader import TemplateLoader, event_count
 from genshi.template.markup import MarkupTemplate
+from genshi.template.watch import PollingWatcher
 
 
 class TemplateLoaderTestCase(unittest.TestCase):
@@ -416,6 +419,333 @@ class TemplateLoaderTestCase(unittest.TestCase):
               <p>Hello, hello</p>
             </html>""", tmpl.generate().render(encoding=None))
 
+    def test_load_concurrently(self):
+        self._write('slow.html', """<div>Slow</div>""")
+        self._write('fast.html', """<div>Fast</div>""")
+        self._write('other.html', """<div>Other</div>""")
+        started = threading.Event()
+        proceed = threading.Event()
+        def template_loaded(template):
+            if template.filename == 'slow.html':
+                started.set()
+                proceed.wait(5)
+        loader = TemplateLoader([self.dirname], callback=template_loaded)
+        fast = loader.load('fast.html')
+
+        thread = threading.Thread(target=loader.load, args=['slow.html'])
+        thread.start()
+        try:
+            started.wait(5)
+            # Neither cache hits nor loading other templates have to wait for
+            # the slow template
+            self.assertTrue(loader.load('fast.html') is fast)
+            loader.load('other.html')
+            self.assertTrue(thread.is_alive())
+        finally:
+            proceed.set()
+            thread.join()
+        self.assertEqual({}, loader._loading)
+
+    def test_load_concurrently_same_template(self):
+        self._write('tmpl.html', """<div>Hello</div>""")
+        instantiated = []
+        started = threading.Event()
+        proceed = threading.Event()
+        class SlowLoader(TemplateLoader):
+            def _instantiate(self, cls, fileobj, filepath, filename,
+                             encoding=None):
+                instantiated.append(filename)
+                started.set()
+                proceed.wait(5)
+                return TemplateLoader._instantiate(self, cls, fileobj,
+                                                   filepath, filename,
+                                                   encoding=encoding)
+        loader = SlowLoader([self.dirname])
+        loaded = []
+        def load():
+            loaded.append(loader.load('tmpl.html'))
+        threads = [threading.Thread(target=load) for idx in range(3)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertEqual(3, len(loaded))
+        self.assertTrue(loaded[0] is loaded[1] is loaded[2])
+
+    def test_load_nested_in_callback(self):
+        self._write('tmpl1.html', """<div>One</div>""")
+        self._write('tmpl2.html', """<div>Two</div>""")
+        def template_loaded(template):
+            if template.filename == 'tmpl1.html':
+                template.loader.load('tmpl2.html')
+        loader = TemplateLoader([self.dirname], callback=template_loaded)
+        tmpl = loader.load('tmpl1.html')
+        self.assertTrue(loader.load('tmpl1.html') is tmpl)
+        self.assertEqual(['tmpl1.html', 'tmpl2.html'], list(loader._cache))
+        self.assertEqual({}, loader._loading)
+
+    def _counting_directory(self, checks):
+        load = TemplateLoader.directory(self.dirname)
+        def _load(filename):
+            filepath, filename, fileobj, uptodate = load(filename)
+            def _uptodate():
+                checks.append(filename)
+                return uptodate()
+            return filepath, filename, fileobj, _uptodate
+        return _load
+
+    def _write_mtime(self, filename, text, mtime):
+        self._write(filename, text)
+        os.utime(os.path.join(self.dirname, filename), (mtime, mtime))
+
+    def test_reload_interval(self):
+        self._write_mtime('tmpl.html', """<div>Hello</div>""", 1000)
+        checks = []
+        loader = TemplateLoader([self._counting_directory(checks)],
+                                auto_reload=True, reload_interval=3600)
+        tmpl = loader.load('tmpl.html')
+        self._write_mtime('tmpl.html', """<div>Changed</div>""", 2000)
+        self.assertTrue(loader.load('tmpl.html') is tmpl)
+        self.assertEqual([], checks)
+
+        loader.reload_interval = 0
+        self.assertEqual('<div>Changed</div>',
+                         str(loader.load('tmpl.html').generate()))
+        self.assertTrue(checks)
+
+    def test_reload_watcher(self):
+        self._write_mtime('tmpl.html', """<div>Hello</div>""", 1000)
+        checks = []
+        watcher = PollingWatcher(interval=None)
+        loader = TemplateLoader([self._counting_directory(checks)],
+                                auto_reload=True, reload_watcher=watcher)
+        tmpl = loader.load('tmpl.html')
+        del checks[:]
+        for idx in range(3):
+            self.assertTrue(loader.load('tmpl.html') is tmpl)
+        self.assertEqual([], checks)
+
+        watcher.check()
+        self._write_mtime('tmpl.html', """<div>Changed</div>""", 2000)
+        self.assertTrue(loader.load('tmpl.html') is tmpl)
+        watcher.check()
+        self.assertEqual('<div>Changed</div>',
+                         str(loader.load('tmpl.html').generate()))
+        del checks[:]
+        loader.load('tmpl.html')
+        self.assertEqual([], checks)
+
+    def test_auto_reload_inlined_include_changed(self):
+        self._write_mtime('tmpl1.html', """<div>Included</div>""", 1000)
+        self._write_mtime('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""", 1000)
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual([], [kind for kind, data, pos in tmpl.stream
+                              if kind is MarkupTemplate.INCLUDE])
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+        self._write_mtime('tmpl1.html', """<div>Changed</div>""", 2000)
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual("""<html>
+          <div>Changed</div>
+        </html>""", tmpl.generate().render(encoding=None))
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+    def test_auto_reload_missing_include_added(self):
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html"><xi:fallback>Missing</xi:fallback></xi:include>
+        </html>""")
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual("""<html>
+          Missing
+        </html>""", tmpl.generate().render(encoding=None))
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+        self._write('tmpl1.html', """<div>Found</div>""")
+        self.assertEqual("""<html>
+          <div>Found</div>
+        </html>""", loader.load('tmpl2.html').generate().render(encoding=None))
+
+    def test_reload_watcher_inlined_include_changed(self):
+        self._write_mtime('tmpl1.html', """<div>Included</div>""", 1000)
+        self._write_mtime('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""", 1000)
+        watcher = PollingWatcher(interval=None)
+        loader = TemplateLoader([self.dirname], auto_reload=True,
+                                reload_watcher=watcher)
+        tmpl = loader.load('tmpl2.html')
+        self._write_mtime('tmpl1.html', """<div>Changed</div>""", 2000)
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+        watcher.check()
+        self.assertEqual("""<html>
+          <div>Changed</div>
+        </html>""", loader.load('tmpl2.html').generate().render(encoding=None))
+
+    def test_setup_after_load(self):
+        self._write('tmpl1.html', """<div>Included</div>""")
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude"
+              xmlns:i18n="http://genshi.edgewall.org/i18n">
+          <p i18n:msg="">Hello</p>
+          <xi:include href="tmpl1.html" />
+        </html>""")
+        for auto_reload in (False, True):
+            loader = TemplateLoader([self.dirname], auto_reload=auto_reload)
+            tmpl = loader.load('tmpl2.html')
+            Translator(lambda message: message.upper()).setup(tmpl)
+            self.assertEqual("""<html>
+          <p>HELLO</p>
+          <div>INCLUDED</div>
+        </html>""", tmpl.generate().render(encoding=None))
+            self.assertEqual(['tmpl1.html'], loader.dependencies('tmpl2.html'))
+
+    def test_dependencies(self):
+        self._write('tmpl1.html', """<div>Included</div>""")
+        self._write('tmpl2.html', """<div xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </div>""")
+        self._write('tmpl3.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude"
+              xmlns:py="http://genshi.edgewall.org/">
+          <xi:include href="tmpl2.html" />
+          <xi:include href="missing.html"><xi:fallback /></xi:include>
+          <xi:include href="${name}.html" />
+        </html>""")
+        for auto_reload in (False, True):
+            loader = TemplateLoader([self.dirname], auto_reload=auto_reload)
+            self.assertEqual(['tmpl2.html', 'tmpl1.html', 'missing.html'],
+                             loader.dependencies('tmpl3.html'))
+            self.assertEqual(['tmpl1.html'], loader.dependencies('tmpl2.html'))
+            self.assertEqual([], loader.dependencies('tmpl1.html'))
+            self.assertEqual(['tmpl2.html', 'tmpl3.html'],
+                             loader.dependents('tmpl1.html'))
+            self.assertEqual([], loader.dependents('tmpl3.html'))
+
+    def test_cache_info(self):
+        for num in range(3):
+            self._write('tmpl%d.html' % num, """<div>%d</div>""" % num)
+        loader = TemplateLoader([self.dirname], max_cache_size=2)
+        loader.load('tmpl0.html')
+        loader.load('tmpl0.html')
+        loader.load('tmpl1.html')
+        loader.load('tmpl2.html')
+        loader.load('tmpl2.html')
+        info = loader.cache_info()
+        self.assertEqual(2, info['hits'])
+        self.assertEqual(3, info['misses'])
+        self.assertEqual(1, info['evictions'])
+        self.assertEqual(2, info['size'])
+        self.assertEqual(2, info['weight'])
+        self.assertEqual(2, info['capacity'])
+        self.assertEqual([('tmpl2.html', 1), ('tmpl1.html', 1)],
+                         info['entries'])
+
+    def test_cache_info_threads(self):
+        self._write('tmpl.html', """<div>Hello</div>""")
+        loader = TemplateLoader([self.dirname])
+        def _load():
+            for idx in range(200):
+                loader.load('tmpl.html')
+        threads = [threading.Thread(target=_load) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = loader.cache_info()
+        self.assertEqual(1, info['misses'])
+        self.assertTrue(0 < info['hits'] <= 799)
+
+    def test_cache_weight(self):
+        self._write('small.html', """<div>Small</div>""")
+        self._write('large.html', """<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="item in items">$item</p>
+          <p py:for="item in items">$item</p>
+          <p py:for="item in items">$item</p>
+        </div>""")
+        self._write('small2.html', """<div>Small</div>""")
+        loader = TemplateLoader([self.dirname], max_cache_size=22,
+                                cache_weight=event_count)
+        loader.load('small.html')
+        loader.load('large.html')
+        self.assertEqual([('large.html', 18), ('small.html', 3)],
+                         loader.cache_info()['entries'])
+
+        loader.load('small.html')
+        loader.load('small2.html')
+        info = loader.cache_info()
+        self.assertEqual(['small2.html', 'small.html'],
+                         [name for name, weight in info['entries']])
+        self.assertEqual(6, info['weight'])
+        self.assertEqual(1, info['evictions'])
+
+    def _write_preload_templates(self):
+        os.mkdir(os.path.join(self.dirname, 'sub'))
+        self._write('tmpl1.html', """<div>$x</div>""")
+        self._write('sub/tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="../tmpl1.html" />
+        </html>""")
+        self._write('broken.html', """<div>${x</div>""")
+        self._write('include.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="missing.html" />
+        </html>""")
+        self._write('mail.txt', """Hello $name""")
+
+    def test_preload(self):
+        self._write_preload_templates()
+        for workers in (1, 3):
+            loader = TemplateLoader([self.dirname])
+            results = loader.preload(['*.html'], workers=workers)
+            self.assertEqual(['broken.html', 'include.html',
+                              'sub/tmpl2.html', 'tmpl1.html'],
+                             [name for name, seconds, error in results])
+            self.assertEqual(['TemplateSyntaxError', 'TemplateNotFound',
+                              'NoneType', 'NoneType'],
+                             [type(error).__name__
+                              for name, seconds, error in results])
+            self.assertEqual(['include.html', 'sub/tmpl2.html',
+                              'tmpl1.html'],
+                             sorted([name for name in loader._cache]))
+            tmpl = loader.load('sub/tmpl2.html')
+            self.assertEqual(True, tmpl._prepared)
+
+    def test_preload_callback_error(self):
+        self._write_preload_templates()
+        def callback(tmpl):
+            if tmpl.filename == 'tmpl1.html':
+                raise ValueError('rejected')
+        for workers in (1, 3):
+            loader = TemplateLoader([self.dirname], callback=callback)
+            results = loader.preload(['tmpl1.html', 'broken.html'],
+                                     workers=workers)
+            self.assertEqual(['broken.html', 'tmpl1.html'],
+                             [name for name, seconds, error in results])
+            self.assertEqual(['TemplateSyntaxError', 'ValueError'],
+                             [type(error).__name__
+                              for name, seconds, error in results])
+
+    def test_preload_processes(self):
+        self._write_preload_templates()
+        cache_dir = os.path.join(self.dirname, 'cache')
+        loader = TemplateLoader([self.dirname], cache_dir=cache_dir)
+        results = loader.preload(['sub/*', 'tmpl*', 'broken.html'],
+                                 workers=2, processes=True)
+        self.assertEqual(['broken.html', 'sub/tmpl2.html', 'tmpl1.html'],
+                         [name for name, seconds, error in results])
+        self.assertEqual(['TemplateSyntaxError', 'NoneType', 'NoneType'],
+                         [type(error).__name__
+                          for name, seconds, error in results])
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+        self.assertEqual('<div>1</div>',
+                         str(loader.load('tmpl1.html').generate(x=1)))
+
+        loader = TemplateLoader([self.dirname])
+        self.assertRaises(ValueError, loader.preload, processes=True)
+
     def test_prefix_delegation_to_directories(self):
         """
         Test prefix delegation with the following layout:
@@ -518,6 +848,103 @@ class TemplateLoaderTestCase(unittest.TestCase):
               <div>bar/tmpl3</div> from sub1
             </html>""", tmpl.generate().render(encoding=None))
 
+    def _write(self, filename, text):
+        fileobj = open(os.path.join(self.dirname, filename), 'w')
+        try:
+            fileobj.write(text)
+        finally:
+            fileobj.close()
+
+    def _cache_loader(self, **kwargs):
+        instantiated = []
+        class CountingLoader(TemplateLoader):
+            def _instantiate(self, cls, fileobj, filepath, filename,
+                             encoding=None):
+                instantiated.append(filename)
+                return TemplateLoader._instantiate(self, cls, fileobj,
+                                                   filepath, filename,
+                                                   encoding=encoding)
+        cache_dir = os.path.join(self.dirname, 'cache')
+        loader = CountingLoader([self.dirname], cache_dir=cache_dir, **kwargs)
+        return loader, instantiated
+
+    def test_cache_dir(self):
+        self._write('tmpl.html', """<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="x, y in items" py:with="z = x * y">$x $y $z</li>
+        </ul>""")
+        loader, instantiated = self._cache_loader()
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertEqual(1, len(os.listdir(os.path.join(self.dirname,
+                                                        'cache'))))
+
+        loader, instantiated = self._cache_loader()
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual([], instantiated)
+        self.assertTrue(tmpl.loader is loader)
+        self.assertEqual("""<ul>
+          <li>1 2 2</li><li>3 4 12</li>
+        </ul>""", tmpl.generate(items=[(1, 2), (3, 4)]).render(encoding=None))
+
+    def test_cache_dir_source_changed(self):
+        self._write('tmpl.html', """<div>$x</div>""")
+        loader, instantiated = self._cache_loader()
+        self.assertEqual('<div>1</div>',
+                         str(loader.load('tmpl.html').generate(x=1)))
+
+        self._write('tmpl.html', """<p>$x</p>""")
+        loader, instantiated = self._cache_loader()
+        self.assertEqual('<p>1</p>',
+                         str(loader.load('tmpl.html').generate(x=1)))
+        self.assertEqual(['tmpl.html'], instantiated)
+
+    def test_cache_dir_include_changed(self):
+        self._write('tmpl1.html', """<div>Included</div>""")
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+          <xi:include href="tmpl3.html"><xi:fallback>Missing</xi:fallback></xi:include>
+        </html>""")
+        loader, instantiated = self._cache_loader()
+        loader.load('tmpl2.html')
+        self.assertEqual(['tmpl2.html', 'tmpl1.html'], instantiated)
+
+        loader, instantiated = self._cache_loader()
+        loader.load('tmpl2.html')
+        self.assertEqual([], instantiated)
+
+        self._write('tmpl1.html', """<div>Changed</div>""")
+        loader, instantiated = self._cache_loader()
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual(['tmpl2.html', 'tmpl1.html'], instantiated)
+        self.assertEqual("""<html>
+          <div>Changed</div>
+          Missing
+        </html>""", tmpl.generate().render(encoding=None))
+
+        self._write('tmpl3.html', """<p>Found</p>""")
+        loader, instantiated = self._cache_loader()
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual("""<html>
+          <div>Changed</div>
+          <p>Found</p>
+        </html>""", tmpl.generate().render(encoding=None))
+
+    def test_cache_dir_with_callback(self):
+        from genshi.filters.i18n import Translator
+        self._write('tmpl.html', """<html xmlns:i18n="http://genshi.edgewall.org/i18n">
+          <p i18n:msg="name">Hello, $name!</p>
+        </html>""")
+        def template_loaded(template):
+            Translator(lambda s: s.replace('Hello', 'Hallo')).setup(template)
+        for idx in range(2):
+            loader, instantiated = self._cache_loader(
+                callback=template_loaded)
+            tmpl = loader.load('tmpl.html')
+            self.assertEqual("""<html>
+          <p>Hallo, John!</p>
+        </html>""", tmpl.generate(name='John').render(encoding=None))
+        self.assertEqual([], instantiated)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -20,11 +20,14 @@ import tempfile
 import unittest
 
 from genshi.compat import BytesIO, StringIO
-from genshi.core import Markup
+from genshi.core import Markup, START
 from genshi.input import XML
-from genshi.template.base import BadDirectiveError, TemplateSyntaxError
+from genshi.output import CHUNK
+from genshi.template.base import BadDirectiveError, TemplateRuntimeError, \
+                                 TemplateSyntaxError
 from genshi.template.loader import TemplateLoader, TemplateNotFound
-from genshi.template.markup import MarkupTemplate
+from genshi.template.directives import MatchDirective
+from genshi.template.markup import MarkupTemplate, _index_match_templates
 
 
 class MarkupTemplateTestCase(unittest.TestCase):
@@ -783,6 +786,261 @@ class MarkupTemplateTestCase(unittest.TestCase):
         </rhyme>""", tmpl.generate().render(encoding=None)) 
 
 
+    def test_static_markup_folded(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <head><title>Static</title></head>
+          <body>
+            <h1>$title</h1>
+            <ul><li py:for="item in items"><b>Item</b> $item</li></ul>
+            <p>Some <em>static</em> text</p><!-- comment --><hr />
+          </body>
+        </html>""")
+        tmpl.stream
+        chunks = [event[1] for event in tmpl._chunked if event[0] is CHUNK]
+        self.assertEqual(2, len(chunks))
+        self.assertEqual([START, START],
+                         [chunk.events[0][0] for chunk in chunks])
+        self.assertEqual("""<html>
+          <head><title>Static</title></head>
+          <body>
+            <h1>Title</h1>
+            <ul><li><b>Item</b> 1</li><li><b>Item</b> 2</li></ul>
+            <p>Some <em>static</em> text</p><!-- comment --><hr/>
+          </body>
+        </html>""", tmpl.generate(title='Title', items=[1, 2]).render(
+                     encoding=None))
+
+        # The body of the loop contains a chunk for the <b> element
+        loop = [event[1][1] for event in tmpl._chunked
+                if event[0] is MarkupTemplate.SUB][0]
+        self.assertEqual([CHUNK], [event[0] for event in loop[1:-1]
+                                   if event[0] is CHUNK])
+
+    def test_static_markup_not_folded_with_changed_filters(self):
+        tmpl = MarkupTemplate("""<div><p>Static</p></div>""")
+        tmpl.filters.append(lambda stream, ctxt, **vars: stream)
+        self.assertEqual(None, tmpl._chunked_stream())
+        self.assertEqual([], [event for event in tmpl.generate()
+                              if event[0] is CHUNK])
+        self.assertEqual('<div><p>Static</p></div>', str(tmpl.generate()))
+
+    def test_static_markup_expanded_on_iteration(self):
+        tmpl = MarkupTemplate("""<div><p>Static <b>text</b></p></div>""")
+        stream = tmpl.generate()
+        self.assertEqual([], [event for event in stream if event[0] is CHUNK])
+        stream = tmpl.generate().select('p/b')
+        self.assertEqual('<b>text</b>', stream.render(encoding=None))
+
+    def test_match_static_markup(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <b py:match="b">[${select('text()')}]</b>
+          <p>Static <b>text</b></p>
+        </div>""")
+        self.assertEqual("""<div>
+          <p>Static <b>[text]</b></p>
+        </div>""", tmpl.generate().render(encoding=None))
+
+    def test_pickle_static_markup(self):
+        tmpl = MarkupTemplate("""<div><p>Static <b>$x</b></p><p>Text</p></div>""")
+        self.assertEqual('<div><p>Static <b>1</b></p><p>Text</p></div>',
+                         str(tmpl.generate(x=1)))
+        buf = BytesIO()
+        pickle.dump(tmpl, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        self.assertEqual('<div><p>Static <b>2</b></p><p>Text</p></div>',
+                         str(unpickled.generate(x=2)))
+
+    def test_match_templates_indexed_by_name(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/"
+                                     xmlns:x="http://example.org/">
+          <b py:match="x:item[2]">second</b>
+          <i py:match="item[@type='a']|entry">${select('@type')}</i>
+          <u py:match="list/item">${select('text()')}</u>
+          <py:match path="*[@once]" once="true"><em>once</em></py:match>
+          <list>
+            <item type="a" /><item>1</item><item>2</item><entry type="b" />
+            <x:item>x</x:item><x:item>y</x:item><other once="" /><other once="" />
+          </list>
+        </html>""")
+        by_name, generic = _index_match_templates(
+            [(None, MatchDirective(path, tmpl).path) for path in
+             ['x:item[2]', "item[@type='a']|entry", 'list/item', '*[@once]']])
+        self.assertEqual({'item': [0, 1, 2, 3], 'entry': [1, 2, 3]}, by_name)
+        self.assertEqual([2, 3], generic)
+        self.assertEqual("""<html xmlns:x="http://example.org/">
+          <list>
+            <i>a</i><u>1</u><u>2</u><i>b</i>
+            <u>x</u><b>second</b><em>once</em><other once=""/>
+          </list>
+        </html>""", tmpl.generate().render(encoding=None))
+
+    def _weave(self, source, **data):
+        expected = MarkupTemplate(source).generate(**data).render(encoding=None)
+        tmpl = MarkupTemplate(source)
+        tmpl.weave_matches = True
+        self.assertEqual(expected, tmpl.generate(**data).render(encoding=None))
+        return expected, [event[1][0] for event in tmpl.stream
+                          if event[0] is MarkupTemplate.SUB]
+
+    def test_weave_matches(self):
+        output, subs = self._weave("""<html xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="head" once="true">
+            <head py:attrs="select('@*')">
+              <title py:with="title = list(select('title/text()'))">Site: $title</title>
+            </head>
+          </py:match>
+          <py:match path="body" once="true">
+            <body py:attrs="select('@*')">
+              <div id="header" py:with="x = 1">Header $x</div>
+              ${select('*|text()')}
+              <div id="footer" py:if="True">Footer</div>
+            </body>
+          </py:match>
+          <head><title>Index</title></head>
+          <body class="index">
+            <!-- comment --><h2>Hello $name</h2>
+            <ul><li py:for="item in items">$item</li></ul>
+          </body>
+        </html>""", name='World', items=[1, 2])
+        self.assertEqual("""<html>
+            <head>
+              <title>Site: Index</title>
+            </head>
+            <body class="index">
+              <div id="header">Header 1</div>
+            <h2>Hello World</h2>
+            <ul><li>1</li><li>2</li></ul>
+              <div id="footer">Footer</div>
+            </body>
+        </html>""", output)
+        # The body template is woven, but not the head template, which uses
+        # select() in a py:with directive
+        self.assertEqual(['MatchDirective', 'WithDirective', 'ForDirective'],
+                         [type(directives[0]).__name__ for directives in subs])
+
+    def test_weave_matches_select_in_with(self):
+        output, subs = self._weave("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="greeting" once="true">
+            <p py:with="x = 'inner'">${select('*|text()')}</p>
+          </py:match>
+          <greeting>$x</greeting>
+        </div>""", x='outer')
+        self.assertEqual("""<div>
+            <p>outer</p>
+        </div>""", output)
+        self.assertEqual(['MatchDirective'],
+                         [type(directives[0]).__name__ for directives in subs])
+
+    def test_weave_matches_select_in_for(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="greeting" once="true">
+            <p py:for="idx in range(2)">${select('*|text()')}</p>
+          </py:match>
+          <greeting>${counter()}</greeting>
+        </div>""")
+        tmpl.weave_matches = True
+        self.assertEqual("""<div>
+            <p>1</p><p>1</p>
+        </div>""", tmpl.generate(counter=iter(range(1, 10)).next)
+                      .render(encoding=None))
+
+    def test_weave_matches_static_select_in_for(self):
+        output, subs = self._weave("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="greeting" once="true">
+            <p py:for="idx in range(2)">${select('*|text()')}</p>
+          </py:match>
+          <greeting>Hello</greeting>
+        </div>""")
+        self.assertEqual("""<div>
+            <p>Hello</p><p>Hello</p>
+        </div>""", output)
+        self.assertEqual(['ForDirective'],
+                         [type(directives[0]).__name__ for directives in subs])
+
+    def test_weave_matches_dynamic_elements(self):
+        for source in [
+            """<div xmlns:py="http://genshi.edgewall.org/">
+              <py:match path="greeting"><b>${select('text()')}</b></py:match>
+              <greeting>Hello</greeting>
+            </div>""",
+            """<div xmlns:py="http://genshi.edgewall.org/">
+              <py:match path="greeting" once="true"><b>${select('text()')}</b></py:match>
+              <greeting py:if="show">Hello</greeting><greeting>Hi</greeting>
+            </div>""",
+            """<div xmlns:py="http://genshi.edgewall.org/">
+              <py:match path="greeting" once="true"><b>${select('text()')}</b></py:match>
+              <greeting>Hello $name</greeting>
+            </div>""",
+            """<div xmlns:py="http://genshi.edgewall.org/">
+              <py:match path="greeting" once="true"><b>${list(select('text()'))}</b></py:match>
+              <greeting>Hello</greeting>
+            </div>""",
+            """<div xmlns:py="http://genshi.edgewall.org/">
+              <py:match path="b"><i>${select('text()')}</i></py:match>
+              <py:match path="greeting" once="true"><b>${select('text()')}</b></py:match>
+              <greeting>Hello</greeting>
+            </div>"""]:
+            output, subs = self._weave(source, show=False, name='you')
+            names = [type(directives[0]).__name__ for directives in subs]
+            self.assertEqual(source.count('<py:match'),
+                             names.count('MatchDirective'))
+
+    def test_constants_folded(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p title="${'a' + 'b'} ${None}" class="${None}">${2 * 21} ${'x' * 3} ${None}</p>
+          <p py:if="1 > 2">Never</p>
+          <p py:if="True">Always</p>
+          <p py:strip="">Stripped</p>
+          <p py:strip="False">Kept</p>
+          <py:choose>
+            <p py:when="False">Never</p>
+            <p py:when="x">X</p>
+          </py:choose>
+          <py:choose test="2">
+            <p py:when="1">One</p>
+            <p py:when="2">Two</p>
+          </py:choose>
+        </div>""")
+        kinds = set([event[0] for event in tmpl.stream])
+        self.assertTrue(MarkupTemplate.EXPR not in kinds)
+        subs = [event[1] for event in tmpl.stream
+                if event[0] is MarkupTemplate.SUB]
+        self.assertEqual(['ChooseDirective', 'ChooseDirective'],
+                         [type(directives[0]).__name__
+                          for directives, substream in subs])
+        # Only one branch is left in each py:choose
+        self.assertEqual([1, 1], [len([1 for event in substream
+                                       if event[0] is MarkupTemplate.SUB])
+                                  for directives, substream in subs])
+        self.assertEqual("""<div>
+          <p title="ab ">42 xxx </p>
+          <p>Always</p>
+          Stripped
+          <p>Kept</p>
+            <p>X</p>
+            <p>Two</p>
+        </div>""", tmpl.generate(x=True).render(encoding=None))
+
+    def test_constants_not_folded_with_errors(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:if="False">${1 / 0}</p>
+          <p py:when="False">Outside choose</p>
+        </div>""")
+        self.assertRaises(TemplateRuntimeError, tmpl.generate().render)
+        tmpl = MarkupTemplate("""<div>${1 / 0}</div>""")
+        self.assertRaises(ZeroDivisionError, tmpl.generate().render)
+
+    def test_constants_not_folded_with_changed_filters(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:if="False">${'text'}</p>
+        </div>""")
+        tmpl.filters.insert(0, lambda stream, ctxt, **vars: stream)
+        self.assertEqual([MarkupTemplate.SUB],
+                         [event[0] for event in tmpl.stream
+                          if event[0] is MarkupTemplate.SUB])
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocTestSuite(MarkupTemplate.__module__))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import shutil
+import tempfile
+import unittest
+
+from genshi.compat import StringIO
+from genshi.template import profiler
+from genshi.template.codegen import CompiledMarkupTemplate
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.profiler import Profiler
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Use a clock that only advances when the template calls work(), so
+        # that the timings are predictable
+        self.clock = [0]
+        self.profiler = Profiler(timer=lambda: self.clock[0])
+
+    def _work(self, amount):
+        self.clock[0] += amount
+        return amount
+
+    def _stats(self, sort='lineno'):
+        return [(lineno, description, calls, tottime, cumtime)
+                for filename, lineno, description, calls, tottime, cumtime
+                in self.profiler.stats(sort)]
+
+    def test_expressions_and_directives(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="idx in range(2)">
+            <b py:if="work(1)">${work(10)}</b>
+          </p>
+        </div>""", filename='test.html')
+        self.profiler.generate(tmpl, work=self._work).render()
+        self.assertEqual([
+            (2, '<ForDirective>', 1, 0, 0),
+            (3, '${work(10)}', 2, 20, 20),
+            (3, '<IfDirective "work(1)">', 2, 2, 2),
+        ], self._stats())
+
+    def test_nested_directives(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="idx in range(3)" py:if="work(1)">${work(10)}</p>
+        </div>""", filename='test.html')
+        self.profiler.generate(tmpl, work=self._work).render()
+        self.assertEqual([
+            (2, '${work(10)}', 3, 30, 30),
+            (2, '<ForDirective>', 1, 0, 3),
+            (2, '<IfDirective "work(1)">', 3, 3, 3),
+        ], self._stats())
+
+    def test_attributes_and_code_blocks(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <?python
+            work(3)
+          ?>
+          <p class="c${work(5)}"/>
+        </div>""", filename='test.html')
+        output = self.profiler.generate(tmpl, work=self._work).render()
+        self.assertTrue('class="c5"' in output)
+        self.assertEqual([
+            (2, '<?python work(3) ?>', 1, 3, 3),
+            (5, '${work(5)}', 1, 5, 5),
+        ], self._stats())
+
+    def test_template_not_modified(self):
+        tmpl = MarkupTemplate("""<p>${work(1)}</p>""", filename='test.html')
+        stream = tmpl.stream
+        self.profiler.generate(tmpl, work=self._work).render()
+        self.assertTrue(tmpl.stream is stream)
+        tmpl.generate(work=self._work).render()
+        self.assertEqual([(1, '${work(1)}', 1, 1, 1)], self._stats())
+        self.assertTrue(self.profiler.instrument(tmpl) is
+                        self.profiler.instrument(tmpl))
+
+    def test_compiled_template(self):
+        tmpl = CompiledMarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="idx in range(2)">${work(10)}</li>
+        </ul>""", filename='test.html')
+        self.assertEqual("""<ul>
+          <li>10</li><li>10</li>
+        </ul>""", str(self.profiler.generate(tmpl, work=self._work)))
+        self.assertEqual([
+            (2, '${work(10)}', 2, 20, 20),
+            (2, '<ForDirective>', 1, 0, 0),
+        ], self._stats())
+
+    def test_includes(self):
+        dirname = tempfile.mkdtemp(suffix='genshi_test')
+        try:
+            for filename, text in [
+                    ('tmpl1.html', '<div>${work(1)}</div>'),
+                    ('tmpl2.html', '<div>${work(2)}</div>'),
+                    ('index.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+                      <xi:include href="tmpl1.html" />
+                      <xi:include href="${name}.html" />
+                    </html>""")]:
+                fileobj = open(os.path.join(dirname, filename), 'w')
+                try:
+                    fileobj.write(text)
+                finally:
+                    fileobj.close()
+            loader = TemplateLoader([dirname])
+            tmpl = loader.load('index.html')
+            self.profiler.generate(tmpl, work=self._work,
+                                   name='tmpl2').render()
+            self.assertEqual([
+                ('index.html', 3, '${name}'),
+                ('tmpl1.html', 1, '${work(1)}'),
+                ('tmpl2.html', 1, '${work(2)}'),
+            ], [(os.path.basename(filename), lineno, description)
+                for filename, lineno, description, calls, tottime, cumtime
+                in self.profiler.stats('filename')])
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_print_stats(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="idx in range(2)">${work(1)}</p>
+          <p>${work(5)}</p>
+        </div>""", filename='test.html')
+        self.profiler.generate(tmpl, work=self._work).render()
+        out = StringIO()
+        self.profiler.print_stats(sort='tottime', limit=2, out=out)
+        self.assertEqual("""\
+   calls    tottime    cumtime  filename:lineno(description)
+       1   5.000000   5.000000  test.html:3(${work(5)})
+       2   2.000000   2.000000  test.html:2(${work(1)})
+""", out.getvalue())
+        self.assertRaises(ValueError, self.profiler.stats, 'name')
+
+        self.profiler.reset()
+        self.assertEqual([], self.profiler.stats())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(profiler))
+    suite.addTest(unittest.makeSuite(ProfilerTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from genshi.template import watch
+from genshi.template.loader import directory
+from genshi.template.watch import InotifyWatcher, PollingWatcher
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+        self.changed = []
+        self.notified = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, filename, text, mtime=None):
+        filepath = os.path.join(self.dirname, filename)
+        fileobj = open(filepath, 'w')
+        try:
+            fileobj.write(text)
+        finally:
+            fileobj.close()
+        if mtime is not None:
+            os.utime(filepath, (mtime, mtime))
+
+    def _watch(self, watcher, filename):
+        filepath, _, fileobj, uptodate = directory(self.dirname)(filename)
+        fileobj.close()
+        watcher.watch(filename, filepath, uptodate, self._callback)
+
+    def _callback(self, key):
+        self.changed.append(key)
+        self.notified.set()
+
+    def test_polling(self):
+        self._write('tmpl1.html', '<div/>', mtime=1000)
+        self._write('tmpl2.html', '<div/>', mtime=1000)
+        watcher = PollingWatcher(interval=None)
+        self._watch(watcher, 'tmpl1.html')
+        self._watch(watcher, 'tmpl2.html')
+        watcher.check()
+        self.assertEqual([], self.changed)
+
+        self._write('tmpl2.html', '<p/>', mtime=2000)
+        watcher.check()
+        self.assertEqual(['tmpl2.html'], self.changed)
+
+        os.remove(os.path.join(self.dirname, 'tmpl1.html'))
+        watcher.check()
+        self.assertEqual(['tmpl2.html', 'tmpl1.html'], self.changed)
+
+    def test_polling_thread(self):
+        self._write('tmpl.html', '<div/>', mtime=1000)
+        watcher = PollingWatcher(interval=0.01)
+        try:
+            self._watch(watcher, 'tmpl.html')
+            self._write('tmpl.html', '<p/>', mtime=2000)
+            self.notified.wait(5)
+        finally:
+            watcher.stop()
+        self.assertEqual(['tmpl.html'], self.changed)
+
+    def test_unwatch(self):
+        self._write('tmpl.html', '<div/>', mtime=1000)
+        watcher = PollingWatcher(interval=None)
+        self._watch(watcher, 'tmpl.html')
+        watcher.unwatch('tmpl.html')
+        self._write('tmpl.html', '<p/>', mtime=2000)
+        watcher.check()
+        self.assertEqual([], self.changed)
+
+    def test_inotify(self):
+        try:
+            watcher = InotifyWatcher(interval=5)
+        except (AttributeError, ImportError, OSError):
+            return
+        self._write('tmpl1.html', '<div/>')
+        self._write('tmpl2.html', '<div/>')
+        try:
+            self._watch(watcher, 'tmpl1.html')
+            self._watch(watcher, 'tmpl2.html')
+            self._write('tmpl2.html', '<p/>')
+            self.notified.wait(5)
+            time.sleep(0.05)
+        finally:
+            watcher.stop()
+        self.assertEqual(['tmpl2.html'], self.changed)
+
+    def test_inotify_polls_unwatchable_files(self):
+        try:
+            watcher = InotifyWatcher(interval=0.01)
+        except (AttributeError, ImportError, OSError):
+            return
+        uptodate = [True]
+        try:
+            watcher.watch('tmpl.html', '/nonexistent/tmpl.html',
+                          lambda: uptodate[0], self._callback)
+            uptodate[0] = False
+            self.notified.wait(5)
+        finally:
+            watcher.stop()
+        self.assertEqual(['tmpl.html'], self.changed)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(watch))
+    suite.addTest(unittest.makeSuite(WatcherTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
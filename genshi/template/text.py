@@ -124,7 +124,8 @@ class NewTextTemplate(Template):
                   ('for', ForDirective),
                   ('if', IfDirective),
                   ('choose', ChooseDirective),
-                  ('with', WithDirective)]
+                  ('with', WithDirective),
+                  ('prefetch', PrefetchDirective)]
     serializer = 'text'
 
     _DIRECTIVE_RE = r'((?<!\\)%s\s*(\w+)\s*(.*?)\s*%s|(?<!\\)%s.*?%s)'
@@ -265,7 +266,8 @@ class OldTextTemplate(Template):
                   ('for', ForDirective),
                   ('if', IfDirective),
                   ('choose', ChooseDirective),
-                  ('with', WithDirective)]
+                  ('with', WithDirective),
+                  ('prefetch', PrefetchDirective)]
     serializer = 'text'
 
     _DIRECTIVE_RE = re.compile(r'(?:^[ \t]*(?<!\\)#(end).*\n?)|'
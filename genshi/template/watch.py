@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Watching template files for changes in a background thread.
+
+A watcher can be passed to a `TemplateLoader` with the ``auto_reload`` option
+enabled, so that the loader no longer has to check whether a cached template
+has changed every time it is requested. Instead, the watcher tells the loader
+when the file of a template may have changed, and only then is the file
+checked again.
+
+>>> from genshi.template import TemplateLoader
+>>> loader = TemplateLoader(['templates'], auto_reload=True,
+...                         reload_watcher=default_watcher())
+
+The `InotifyWatcher` uses the inotify API of the Linux kernel to be notified
+of changes. On other platforms, `default_watcher()` returns a
+`PollingWatcher`, which checks the modification times of the watched files at
+a regular interval.
+"""
+
+import errno
+import os
+import select
+import struct
+import sys
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+__all__ = ['InotifyWatcher', 'PollingWatcher', 'default_watcher']
+__docformat__ = 'restructuredtext en'
+
+
+class PollingWatcher(object):
+    """Watches files by checking whether they are still up to date at a
+    regular interval.
+
+    Files are watched using the ``uptodate`` functions returned by the load
+    functions of the template loader, so this watcher works for any kind of
+    template source those functions support.
+
+    >>> changed = []
+    >>> watcher = PollingWatcher(interval=None)
+    >>> watcher.watch('a', '/path/a.html', lambda: True, changed.append)
+    >>> watcher.watch('b', '/path/b.html', lambda: False, changed.append)
+    >>> watcher.check()
+    >>> changed
+    ['b']
+
+    Every callback is only invoked once; to be notified of further changes,
+    the file needs to be watched again:
+
+    >>> watcher.check()
+    >>> changed
+    ['b']
+    """
+
+    def __init__(self, interval=1.0):
+        """Create the watcher.
+
+        :param interval: the number of seconds between two checks of the
+                         watched files, or ``None`` to not start a background
+                         thread, in which case the `check()` method must be
+                         called to check the files
+        """
+        self.interval = interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def watch(self, key, filepath, uptodate, callback):
+        """Start watching a file.
+
+        :param key: a hashable object identifying the watch; watching a file
+                    with the same key again replaces the previous watch
+        :param filepath: the path of the file
+        :param uptodate: a function that returns whether the file is still
+                         unchanged, or raises `OSError` if it is gone
+        :param callback: the function to invoke with the `key` when the file
+                         may have changed
+        """
+        self._lock.acquire()
+        try:
+            self._entries[key] = (filepath, uptodate, callback)
+            self._add(key, filepath)
+        finally:
+            self._lock.release()
+        if self._thread is None and self.interval is not None:
+            self._start()
+
+    def unwatch(self, key):
+        """Stop watching the file with the given key.
+
+        :param key: the key that was passed to `watch()`
+        """
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def check(self):
+        """Check all the watched files, invoking the callbacks of the files
+        that have changed.
+        """
+        changed = []
+        for key, (filepath, uptodate, callback) in self._polled():
+            try:
+                if uptodate():
+                    continue
+            except OSError:
+                pass
+            changed.append(key)
+        self._notify(changed)
+
+    def stop(self):
+        """Stop the background thread of the watcher."""
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+
+    def _add(self, key, filepath):
+        pass
+
+    def _polled(self):
+        self._lock.acquire()
+        try:
+            return list(self._entries.items())
+        finally:
+            self._lock.release()
+
+    def _notify(self, keys):
+        callbacks = []
+        self._lock.acquire()
+        try:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    callbacks.append((entry[2], key))
+        finally:
+            self._lock.release()
+        for callback, key in callbacks:
+            callback(key)
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name=type(self).__name__)
+            self._thread.setDaemon(True)
+        finally:
+            self._lock.release()
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(self.interval)
+            if not self._stopped.isSet():
+                self.check()
+
+
+class InotifyWatcher(PollingWatcher):
+    """Watches files using the inotify API of the Linux kernel.
+
+    The watcher is notified about any change in the directories containing
+    the watched files, so files are not checked unless something has
+    happened. Files that can not be watched this way, for example because
+    they were not loaded from a directory, are polled at the given interval
+    instead.
+    """
+
+    _MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    """Modify, attrib, close write, moved from/to, create, delete and delete
+    self/move self events."""
+
+    _OVERFLOW = 0x4000
+    _IGNORED = 0x8000
+    _HEADER = struct.Struct('iIII')
+
+    def __init__(self, interval=1.0):
+        """Create the watcher.
+
+        :param interval: the number of seconds between two checks of the files
+                         that can not be watched using inotify
+        :raise OSError: if inotify is not available on the system
+        """
+        PollingWatcher.__init__(self, interval)
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(_errno(), 'inotify_init() failed')
+        self._wakeup = os.pipe()
+        self._dirs = {}
+        self._wds = {}
+        self._unwatched = set()
+        if interval is None:
+            # Events are only received by the background thread
+            self.interval = 1.0
+
+    def check(self):
+        """Check the files that can not be watched using inotify."""
+        PollingWatcher.check(self)
+
+    def stop(self):
+        """Stop the background thread of the watcher and release the inotify
+        instance.
+        """
+        self._stopped.set()
+        if self._fd >= 0:
+            os.write(self._wakeup[1], 'x'.encode('ascii'))
+        PollingWatcher.stop(self)
+        if self._fd >= 0:
+            os.close(self._fd)
+            for fd in self._wakeup:
+                os.close(fd)
+            self._fd = -1
+
+    def _add(self, key, filepath):
+        self._unwatched.discard(key)
+        dirname = os.path.dirname(os.path.abspath(filepath))
+        if dirname not in self._dirs:
+            path = dirname
+            if not isinstance(path, bytes):
+                path = path.encode(sys.getfilesystemencoding())
+            wd = self._libc.inotify_add_watch(self._fd, path, self._MASK)
+            if wd < 0:
+                self._unwatched.add(key)
+                return
+            self._dirs[dirname] = wd
+            self._wds[wd] = dirname
+
+    def _polled(self):
+        self._lock.acquire()
+        try:
+            return [(key, entry) for key, entry in self._entries.items()
+                    if key in self._unwatched]
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while not self._stopped.isSet():
+            try:
+                readable = select.select([self._fd, self._wakeup[0]], [], [],
+                                         self.interval)[0]
+            except (OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._stopped.isSet():
+                break
+            if self._fd in readable:
+                self._read()
+            self.check()
+
+    def _read(self):
+        data = os.read(self._fd, 65536)
+        paths = set()
+        overflow = False
+        offset = 0
+        while offset + self._HEADER.size <= len(data):
+            wd, mask, cookie, size = self._HEADER.unpack_from(data, offset)
+            offset += self._HEADER.size
+            name = data[offset:offset + size].rstrip('\0'.encode('ascii'))
+            offset += size
+            if mask & self._OVERFLOW:
+                overflow = True
+                continue
+            dirname = self._wds.get(wd)
+            if dirname is None:
+                continue
+            if mask & self._IGNORED:
+                # The directory itself is gone
+                self._lock.acquire()
+                try:
+                    del self._wds[wd]
+                    self._dirs.pop(dirname, None)
+                finally:
+                    self._lock.release()
+            if name:
+                if not isinstance(dirname, bytes):
+                    name = name.decode(sys.getfilesystemencoding())
+                paths.add(os.path.join(dirname, name))
+            else:
+                paths.add(dirname)
+
+        changed = []
+        self._lock.acquire()
+        try:
+            for key, (filepath, uptodate, callback) in self._entries.items():
+                filepath = os.path.abspath(filepath)
+                if overflow or filepath in paths or \
+                        os.path.dirname(filepath) in paths:
+                    changed.append(key)
+        finally:
+            self._lock.release()
+        self._notify(changed)
+
+
+def default_watcher(interval=1.0):
+    """Return an `InotifyWatcher` if inotify is available on the system, or a
+    `PollingWatcher` otherwise.
+
+    :param interval: the number of seconds between two checks of files that
+                     need to be polled
+    """
+    try:
+        return InotifyWatcher(interval)
+    except (AttributeError, ImportError, OSError):
+        return PollingWatcher(interval)
+
+
+def _libc():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc.inotify_init
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+
+def _errno():
+    import ctypes
+    return ctypes.get_errno()
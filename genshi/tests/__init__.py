@@ -15,17 +15,20 @@ import unittest
 
 def suite():
     import genshi
-    from genshi.tests import builder, core, input, output, path, util
+    from genshi.tests import bench, builder, core, input, output, path, \
+                             stats, util
     from genshi.filters import tests as filters
     from genshi.template import tests as template
 
     suite = unittest.TestSuite()
+    suite.addTest(bench.suite())
     suite.addTest(builder.suite())
     suite.addTest(core.suite())
     suite.addTest(filters.suite())
     suite.addTest(input.suite())
     suite.addTest(output.suite())
     suite.addTest(path.suite())
+    suite.addTest(stats.suite())
     suite.addTest(template.suite())
     suite.addTest(util.suite())
     return suite
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from genshi import bench
+from genshi.compat import StringIO
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.dirname)
+
+    def _run(self, *args):
+        return bench.main(['--rows', '2', '--repeat', '1', '--min-time', '0',
+                           '--no-memory'] + list(args))
+
+    def test_run(self):
+        results = bench.run(rows=2, repeat=1, min_time=0, memory=False)
+        self.assertEqual([phase.__name__ for phase in bench.PHASES],
+                         [name for name in [phase.__name__ for phase
+                          in bench.PHASES] if name in results['phases']])
+        for name, result in results['phases'].items():
+            self.assertTrue(result['seconds'] > 0, name)
+            self.assertTrue(result['events'] > 0, name)
+            self.assertEqual(None, result['peak_memory'])
+
+    def test_run_memory(self):
+        results = bench.run(['generate'], rows=2, repeat=1, min_time=0)
+        peak = results['phases']['generate']['peak_memory']
+        self.assertTrue(peak is None or peak >= 0)
+
+    def test_run_unknown_phase(self):
+        self.assertRaises(ValueError, bench.run, ['compile'])
+
+    def test_compare(self):
+        baseline = {'phases': {'parse': {'seconds': 1.0},
+                               'prepare': {'seconds': 1.0}}}
+        results = {'phases': {'parse': {'seconds': 1.05},
+                              'prepare': {'seconds': 1.5},
+                              'generate': {'seconds': 1.0}}}
+        self.assertEqual([('parse', 1.0, 1.05, 1.05, False),
+                          ('prepare', 1.0, 1.5, 1.5, True)],
+                         bench.compare(results, baseline, tolerance=0.1))
+
+    def test_main(self):
+        output = os.path.join(self.dirname, 'results.json')
+        self.assertEqual(0, self._run('-o', output, 'parse', 'serialize_xml'))
+        report = sys.stdout.getvalue()
+        self.assertTrue('parse' in report)
+        self.assertTrue('serialize_xml' in report)
+        self.assertTrue(os.path.isfile(output))
+
+    def test_main_baseline(self):
+        baseline = os.path.join(self.dirname, 'baseline.json')
+        fileobj = open(baseline, 'w')
+        try:
+            fileobj.write('{"phases": {"parse": {"seconds": 1e-9}}}')
+        finally:
+            fileobj.close()
+        self.assertEqual(1, self._run('-b', baseline, '--json', 'parse'))
+        self.assertTrue('"baseline"' in sys.stdout.getvalue())
+        self.assertTrue('regressions: parse' in sys.stderr.getvalue())
+
+    def test_main_unknown_phase(self):
+        self.assertEqual(2, self._run('compile'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BenchmarkTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
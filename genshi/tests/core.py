@@ -11,6 +11,7 @@
 # individuals. For the exact contribution history, see the revision
 # history and logs, available at http://genshi.edgewall.org/log/.
 
+import codecs
 import doctest
 import pickle
 import unittest
@@ -48,6 +49,42 @@ class StreamTestCase(unittest.TestCase):
         self.assertEqual(None, xml.render(encoding=None, out=strio))
         self.assertEqual(u'<li>Über uns</li>', strio.getvalue())
 
+    def test_render_output_stream_buffered(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 1000))
+        writes = []
+        class Output(object):
+            def write(self, data):
+                writes.append(data)
+        self.assertEqual(None, xml.render(encoding='utf-8', out=Output()))
+        self.assertEqual(xml.render(encoding='utf-8'), ''.encode().join(writes))
+        self.assertTrue(1 < len(writes) < 10)
+
+    def test_iter_encoded(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 1000))
+        chunks = list(xml.iter_encoded(chunk_size=1000))
+        self.assertEqual(xml.render(encoding='utf-8'), ''.encode().join(chunks))
+        self.assertTrue(10 < len(chunks) < 20)
+        for chunk in chunks[:-1]:
+            self.assertTrue(1000 <= len(chunk.decode('utf-8')) < 1020)
+
+    def test_iter_encoded_incremental(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 100))
+        chunks = list(xml.iter_encoded(encoding='utf-16', chunk_size=100))
+        self.assertEqual(xml.render(encoding='utf-16'), ''.encode().join(chunks))
+        boms = (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+        self.assertTrue(chunks[0][:2] in boms)
+        for chunk in chunks[1:]:
+            self.assertFalse(chunk[:2] in boms)
+
+    def test_iter_encoded_flush_after(self):
+        xml = XML('<html><head><title>Foo</title></head><body>%s</body>'
+                  '</html>' % ('<p>Bar</p>' * 100))
+        chunks = list(xml.iter_encoded(method='html', encoding=None,
+                                       flush_after='</head>'))
+        self.assertEqual([u'<html><head><title>Foo</title></head>',
+                          u'<body>%s</body></html>' % (u'<p>Bar</p>' * 100)],
+                         chunks)
+
     def test_pickle(self):
         xml = XML('<li>Foo</li>')
         buf = BytesIO()
@@ -12,13 +12,18 @@
 # history and logs, available at http://genshi.edgewall.org/log/.
 
 import doctest
+import pickle
 import unittest
 import sys
 
+from genshi.compat import BytesIO
 from genshi.core import Attrs, Markup, QName, Stream
 from genshi.input import HTML, XML
 from genshi.output import DocType, XMLSerializer, XHTMLSerializer, \
-                          HTMLSerializer, EmptyTagFilter
+                          HTMLSerializer, TextSerializer, EmptyTagFilter, \
+                          CHUNK, Chunk, get_serializer, CACHE_SIZE, \
+                          CACHE_TEXT_LENGTH, _prepare_cache, encode, \
+                          iterencode, wsgi_response
 
 
 class XMLSerializerTestCase(unittest.TestCase):
@@ -468,12 +473,240 @@ class EmptyTagFilterTestCase(unittest.TestCase):
                          [ev[0] for ev in stream])
 
 
+class EncodeTestCase(unittest.TestCase):
+
+    def test_iterencode(self):
+        chunks = list(iterencode([u'<p>', u'Über', u'</p>', u'<br/>'],
+                                 encoding='utf-8', buffer_size=6))
+        self.assertEqual([u'<p>Über'.encode('utf-8'),
+                          u'</p><br/>'.encode('utf-8')], chunks)
+
+    def test_iterencode_unbuffered(self):
+        chunks = list(iterencode([u'<p>', u'Über', u'</p>'], buffer_size=0))
+        self.assertEqual([u'<p>', u'Über', u'</p>'], chunks)
+
+    def test_iterencode_errors(self):
+        self.assertEqual([u'<p>&#220;ber</p>'.encode('ascii')],
+                         list(iterencode([u'<p>Über</p>'], encoding='ascii')))
+        self.assertEqual([u'?ber'.encode('ascii')],
+                         list(iterencode([u'Über'], method='text',
+                                         encoding='ascii')))
+
+    def test_wsgi_response(self):
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, headers))
+        stream = XML('<p>Über</p>')
+        body = wsgi_response(stream, start_response, '404 Not Found',
+                             [('Content-Type', 'application/atom+xml'),
+                              ('Cache-Control', 'no-cache')])
+        self.assertEqual([('404 Not Found',
+                           [('Content-Type', 'application/atom+xml'),
+                            ('Cache-Control', 'no-cache')])], responses)
+        self.assertEqual([u'<p>Über</p>'.encode('utf-8')], list(body))
+
+        del responses[:]
+        body = wsgi_response(stream, start_response, method='text',
+                             encoding='iso-8859-1')
+        self.assertEqual([('200 OK', [('Content-Type',
+                                       'text/plain; charset=iso-8859-1')])],
+                         responses)
+        self.assertEqual([u'Über'.encode('iso-8859-1')], list(body))
+
+    def test_encode_out(self):
+        buf = BytesIO()
+        encode([u'<p>', u'Über', u'</p>'] * 10, encoding='utf-8', out=buf,
+               buffer_size=20)
+        self.assertEqual(u'<p>Über</p>'.encode('utf-8') * 10, buf.getvalue())
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def test_size(self):
+        _emit, _get, cache = _prepare_cache(2)
+        for idx in range(5):
+            _emit(Stream.END, QName('elem%d' % idx), '</elem%d>' % idx)
+        self.assertEqual(2, len(cache))
+        self.assertEqual('</elem4>', _get((Stream.END, QName('elem4'))))
+
+    def test_default_size(self):
+        _emit, _get, cache = _prepare_cache()
+        for idx in range(CACHE_SIZE + 10):
+            _emit(Stream.END, QName('elem%d' % idx), '</elem%d>' % idx)
+        self.assertEqual(CACHE_SIZE, len(cache))
+
+    def test_long_text(self):
+        _emit, _get, cache = _prepare_cache()
+        text = 'x' * (CACHE_TEXT_LENGTH + 1)
+        self.assertEqual(text, _emit(Stream.TEXT, text, text))
+        self.assertEqual(None, _get((Stream.TEXT, text)))
+        _emit(Stream.TEXT, 'x', 'x')
+        self.assertEqual('x', _get((Stream.TEXT, 'x')))
+
+    def test_disabled(self):
+        _emit, _get, cache = _prepare_cache(False)
+        _emit(Stream.END, QName('elem'), '</elem>')
+        self.assertEqual(None, _get((Stream.END, QName('elem'))))
+
+    def test_serializer_option(self):
+        text = '<div>%s</div>' % ''.join(['<p id="p%d">%d</p>' % (idx, idx)
+                                          for idx in range(10)])
+        expected = XML(text).render('xhtml', encoding=None)
+        for cache in (True, False, 1, 3):
+            for method in ('xml', 'xhtml', 'html'):
+                serializer = get_serializer(method, cache=cache,
+                                            strip_whitespace=False)
+                self.assertEqual(cache, serializer.cache)
+            self.assertEqual(expected, XML(text).render('xhtml', cache=cache,
+                                                        encoding=None))
+
+
+class FusedSerializerTestCase(unittest.TestCase):
+
+    def _assert_same(self, text, method, **kwargs):
+        serializer = get_serializer(method, **kwargs)
+        self.assertNotEqual(None, serializer._fused_filters())
+        events = list(XML(text))
+        expected = ''.join(serializer._serialize(serializer._filter(events)))
+        self.assertEqual(expected, ''.join(serializer(events)))
+
+    def test_methods(self):
+        text = """<?xml version="1.0"?>
+        <html xmlns="http://www.w3.org/1999/xhtml" xmlns:x="urn:x">
+          <head><script>a &lt; b</script><style>p > a {}</style></head>
+          <body><x:p x:id="1">Hello,  \n\n\n <em>world</em>!<br/></x:p>
+            <pre>  foo  \n\n\n  </pre><![CDATA[ <b> ]]><!-- c -->
+            <textarea></textarea><input checked="checked" xml:lang="en"/>
+          </body>
+        </html>"""
+        for method in ('xml', 'xhtml', 'html'):
+            self._assert_same(text, method)
+            self._assert_same(text, method, strip_whitespace=False)
+            self._assert_same(text, method, doctype='html5')
+            self._assert_same(text, method, cache=False)
+
+    def test_namespaces(self):
+        text = """<doc xmlns:x="urn:x"><x:a/><x:a/>
+          <b xmlns="urn:y" xmlns:z="urn:z" z:c="1"><c xmlns="urn:x"/></b>
+        </doc>"""
+        for method in ('xml', 'xhtml'):
+            self._assert_same(text, method)
+
+    def test_custom_filters(self):
+        class UpperFilter(object):
+            def __call__(self, stream):
+                for kind, data, pos in stream:
+                    if kind is Stream.TEXT:
+                        data = data.upper()
+                    yield kind, data, pos
+        serializer = XMLSerializer()
+        serializer.filters.insert(0, UpperFilter())
+        self.assertEqual(None, serializer._fused_filters())
+        self.assertEqual('<p>FOO<br/></p>',
+                         ''.join(serializer(XML('<p>foo<br></br></p>'))))
+
+
+class ChunkTestCase(unittest.TestCase):
+
+    def _chunked(self, text, tag):
+        """Parse the text, and replace the first element with the given tag
+        name by a chunk event.
+        """
+        events = list(XML(text))
+        start = depth = None
+        for idx, (kind, data, pos) in enumerate(events):
+            if kind is Stream.START:
+                if start is None and data[0].localname == tag:
+                    start, depth = idx, 0
+                elif start is not None:
+                    depth += 1
+            elif kind is Stream.END and start is not None:
+                if not depth:
+                    break
+                depth -= 1
+        return events[:start] + \
+               [(CHUNK, Chunk(events[start:idx + 1]), (None, -1, -1))] + \
+               events[idx + 1:]
+
+    def _assert_same(self, text, tag, method, **kwargs):
+        expected = XML(text).render(method, encoding=None, **kwargs)
+        stream = Stream(self._chunked(text, tag))
+        self.assertEqual(expected, stream.render(method, encoding=None,
+                                                 **kwargs))
+        # Second run uses the cached output
+        self.assertEqual(expected, stream.render(method, encoding=None,
+                                                 **kwargs))
+
+    def test_methods(self):
+        text = """<div>
+          <p class="x">Hello,  \n\n\n <em>world</em>!<br/></p>
+          <script>a &lt; b</script>
+        </div>"""
+        for method in ('xml', 'xhtml', 'html', 'text'):
+            self._assert_same(text, 'p', method)
+        for method in ('xml', 'xhtml', 'html'):
+            self._assert_same(text, 'p', method, strip_whitespace=False)
+
+    def test_cached_per_serializer(self):
+        chunk = Chunk(list(XML('<p>Hello<br/></p>')))
+        stream = Stream([(CHUNK, chunk, (None, -1, -1))])
+        self.assertEqual('<p>Hello<br/></p>', stream.render('xml'))
+        self.assertEqual('<p>Hello<br></p>', stream.render('html'))
+        self.assertEqual(1, len(chunk._cache))
+        self.assertEqual('<p>Hello<br/></p>', stream.render('xml'))
+
+    def test_preserved_space(self):
+        text = """<div><pre class="x">  <b>  foo  \n\n\n</b>  </pre></div>"""
+        self._assert_same(text, 'b', 'xhtml')
+        text = """<div xml:space="preserve"><b>  foo  \n\n\n</b></div>"""
+        self._assert_same(text, 'b', 'xml')
+
+    def test_unescaped_content(self):
+        text = """<script type="text/html"><p>a &lt; b</p></script>"""
+        self._assert_same(text, 'p', 'html')
+        self._assert_same(text, 'p', 'html', strip_whitespace=False)
+
+    def test_namespaces(self):
+        text = """<html xmlns="http://www.w3.org/1999/xhtml"
+                         xmlns:x="urn:x"><body>
+          <x:p x:id="1"><span>foo</span></x:p>
+        </body></html>"""
+        self._assert_same(text, 'p', 'xml')
+        self._assert_same(text, 'p', 'xhtml')
+        self._assert_same(text, 'p', 'xml', namespace_prefixes={'urn:x': 'y'})
+
+    def test_namespace_declaration(self):
+        text = """<doc><x:p xmlns:x="urn:x"><x:span>foo</x:span></x:p></doc>"""
+        self._assert_same(text, 'p', 'xml')
+
+    def test_unknown_namespace(self):
+        events = list(XML('<x:p xmlns:x="urn:x"><x:b>foo</x:b></x:p>'))
+        stream = Stream([(CHUNK, Chunk(events[1:-1]), (None, -1, -1))])
+        self.assertEqual('<p xmlns="urn:x"><b>foo</b></p>', stream.render())
+
+    def test_pickle(self):
+        chunk = Chunk(list(XML('<p>Hello</p>')))
+        stream = Stream([(CHUNK, chunk, (None, -1, -1))])
+        self.assertEqual('<p>Hello</p>', stream.render())
+        buf = BytesIO()
+        pickle.dump(chunk, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        self.assertEqual({}, unpickled._cache)
+        stream = Stream([(CHUNK, unpickled, (None, -1, -1))])
+        self.assertEqual('<p>Hello</p>', stream.render())
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(XHTMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(HTMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(EmptyTagFilterTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(EncodeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TokenCacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(FusedSerializerTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ChunkTestCase, 'test'))
     suite.addTest(doctest.DocTestSuite(XMLSerializer.__module__))
     return suite
 
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+from genshi import stats
+from genshi.input import XML
+from genshi.template.loader import TemplateLoader
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+
+    def tearDown(self):
+        stats.disable()
+        stats.reset()
+
+    def test_disabled(self):
+        XML('<p><b>1</b><b>2</b></p>').render('xhtml')
+        info = stats.snapshot().get('XHTMLSerializer')
+        if info is not None:
+            self.assertEqual(0, info['hits'])
+            self.assertEqual(0, info['misses'])
+
+    def test_serializers(self):
+        stats.enable()
+        stream = XML('<p><b>1</b><b>2</b></p>')
+        stream.render('html')
+        stream.render('html')
+        snapshot = stats.snapshot()
+        self.assertEqual(4, snapshot['HTMLSerializer']['hits'])
+        self.assertEqual(4, snapshot['NamespaceFlattener']['hits'])
+        self.assertEqual(0, snapshot['HTMLSerializer']['clears'])
+
+    def test_bounded_cache(self):
+        stats.enable()
+        XML('<p><b>1</b><i>2</i><u>3</u></p>').render('xml', cache=2)
+        info = stats.snapshot()['XMLSerializer']
+        self.assertEqual(2, info['size'])
+        self.assertEqual(6, info['evictions'])
+
+    def test_namespace_flattener_clears(self):
+        stats.enable()
+        XML('<doc xmlns:x="http://example.org/"><x:a/><x:a/></doc>').render()
+        info = stats.snapshot()['NamespaceFlattener']
+        self.assertEqual(2, info['clears'])
+        self.assertEqual(1, info['hits'])
+
+    def test_template_loader(self):
+        dirname = tempfile.mkdtemp(suffix='genshi_test')
+        try:
+            fileobj = open(os.path.join(dirname, 'tmpl.html'), 'w')
+            try:
+                fileobj.write('<div/>')
+            finally:
+                fileobj.close()
+            gc.collect()
+            size = stats.snapshot().get('TemplateLoader', {}).get('size', 0)
+            loader = TemplateLoader([dirname])
+            loader.load('tmpl.html')
+            loader.load('tmpl.html')
+            info = stats.snapshot()['TemplateLoader']
+            self.assertEqual(1, info['hits'])
+            self.assertEqual(1, info['misses'])
+            self.assertEqual(size + 1, info['size'])
+
+            stats.reset()
+            info = stats.snapshot()['TemplateLoader']
+            self.assertEqual(0, info['hits'])
+            self.assertEqual(size + 1, info['size'])
+            # The loader still reports its own counters
+            self.assertEqual(1, loader.cache_info()['hits'])
+            loader.load('tmpl.html')
+            self.assertEqual(1, stats.snapshot()['TemplateLoader']['hits'])
+            self.assertEqual(2, loader.cache_info()['hits'])
+
+            del loader
+            gc.collect()
+            self.assertEqual(size, stats.snapshot()['TemplateLoader']['size'])
+        finally:
+            shutil.rmtree(dirname)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(stats))
+    suite.addTest(unittest.makeSuite(StatsTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -83,6 +83,52 @@ class LRUCacheTestCase(unittest.TestCase):
         self.assertEqual(item_a, item_b.prv)
         self.assertEqual(None, item_b.nxt)
 
+    def test_peek(self):
+        cache = LRUCache(2)
+        cache['A'] = 0
+        cache['B'] = 1
+
+        self.assertEqual(0, cache.peek('A'))
+        self.assertEqual(None, cache.peek('C'))
+        self.assertEqual(2, cache.peek('C', 2))
+        self.assertEqual('B', cache.head.key)
+        self.assertEqual('A', cache.tail.key)
+        self.assertEqual((0, 0), (cache.hits, cache.misses))
+
+    def test_counters(self):
+        cache = LRUCache(2)
+        cache['A'] = 0
+        cache['B'] = 1
+        cache['A']
+        self.assertRaises(KeyError, cache.__getitem__, 'C')
+        self.assertEqual(None, cache.get('C'))
+        cache['C'] = 2
+        cache['A'] = 3
+
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(['A', 'C'], list(cache))
+
+    def test_weighted(self):
+        cache = LRUCache(10, weigh=len)
+        cache['A'] = 'aaa'
+        cache['B'] = 'bbb'
+        cache['C'] = 'ccc'
+        self.assertEqual(9, cache.weight)
+
+        cache['A'] = 'aaaaaa'
+        self.assertEqual(['A', 'C'], list(cache))
+        self.assertEqual([('A', 6), ('C', 3)], cache.weights())
+        self.assertEqual(9, cache.weight)
+        self.assertEqual(1, cache.evictions)
+
+        cache['D'] = 'd' * 20
+        self.assertEqual([('D', 20)], cache.weights())
+        self.assertEqual(20, cache.weight)
+        self.assertEqual('D', cache.tail.key)
+        self.assertEqual(3, cache.evictions)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -53,6 +53,29 @@ class LRUCache(dict):
     A
     C
 
+    The cache counts how often items were found (`hits`), not found
+    (`misses`), and dropped to make room for new items (`evictions`):
+    
+    >>> cache.hits, cache.misses, cache.evictions
+    (1, 0, 1)
+    
+    Instead of limiting the number of items, the cache can limit their total
+    weight, as computed by a function passed as the `weigh` argument. The
+    least recently used items are then dropped until the total weight of the
+    items is no longer larger than the capacity, although the most recently
+    added item is always kept:
+    
+    >>> cache = LRUCache(10, weigh=len)
+    >>> cache['A'] = 'aaaa'
+    >>> cache['B'] = 'bbbbb'
+    >>> cache.weight
+    9
+    >>> cache['C'] = 'cc'
+    >>> cache.weights()
+    [('C', 2), ('B', 5)]
+    >>> cache.weight
+    7
+
     This code is based on the LRUCache class from ``myghtyutils.util``, written
     by Mike Bayer and released under the MIT license. See:
 
@@ -60,16 +83,30 @@ class LRUCache(dict):
     """
 
     class _Item(object):
-        def __init__(self, key, value):
+        def __init__(self, key, value, weight=1):
             self.prv = self.nxt = None
             self.key = key
             self.value = value
+            self.weight = weight
         def __repr__(self):
             return repr(self.value)
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, weigh=None):
+        """Create the cache.
+        
+        :param capacity: the maximum number of items, or the maximum total
+                         weight of the items if `weigh` is specified
+        :param weigh: (optional) a function that is passed a value and
+                      returns its weight, for example an estimate of its size
+        
+        :note: Changed in 0.8: Added the `weigh` argument
+        """
         self._dict = dict()
         self.capacity = capacity
+        self.weigh = weigh
+        self.weight = 0
+        """The total weight of the items in the cache"""
+        self.hits = self.misses = self.evictions = 0
         self.head = None
         self.tail = None
 
@@ -86,21 +123,87 @@ class LRUCache(dict):
         return len(self._dict)
 
     def __getitem__(self, key):
-        item = self._dict[key]
+        item = self._dict.get(key)
+        if item is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
         self._update_item(item)
         return item.value
 
+    def get(self, key, default=None):
+        """Return the value stored for the given key and mark it as recently
+        used, or return `default` if the key is not in the cache.
+        
+        >>> cache = LRUCache(2)
+        >>> cache['A'] = 0
+        >>> cache.get('A'), cache.get('B')
+        (0, None)
+        >>> cache.hits, cache.misses
+        (1, 1)
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key, default=None):
+        """Return the value stored for the given key without marking it as
+        recently used, or `default` if the key is not in the cache.
+        
+        As this method does not modify the cache, it can be used without
+        locking while other threads update the cache. It is not counted as a
+        hit or miss either.
+        
+        >>> cache = LRUCache(2)
+        >>> cache['A'] = 0
+        >>> cache['B'] = 1
+        >>> cache.peek('A')
+        0
+        >>> cache.peek('C') is None
+        True
+        >>> list(cache)
+        ['B', 'A']
+        """
+        item = self._dict.get(key)
+        if item is None:
+            return default
+        return item.value
+
     def __setitem__(self, key, value):
+        weight = 1
+        if self.weigh is not None:
+            weight = self.weigh(value)
         item = self._dict.get(key)
         if item is None:
-            item = self._Item(key, value)
+            item = self._Item(key, value, weight)
             self._dict[key] = item
+            self.weight += weight
             self._insert_item(item)
         else:
             item.value = value
+            self.weight += weight - item.weight
+            item.weight = weight
             self._update_item(item)
             self._manage_size()
 
+    def weights(self):
+        """Return a list of ``(key, weight)`` tuples for the items in the
+        cache, starting with the most recently used.
+        
+        >>> cache = LRUCache(3)
+        >>> cache['A'] = 0
+        >>> cache['B'] = 1
+        >>> cache.weights()
+        [('B', 1), ('A', 1)]
+        """
+        retval = []
+        cur = self.head
+        while cur:
+            retval.append((cur.key, cur.weight))
+            cur = cur.nxt
+        return retval
+
     def __repr__(self):
         return repr(self._dict)
 
@@ -115,9 +218,13 @@ class LRUCache(dict):
         self._manage_size()
 
     def _manage_size(self):
-        while len(self._dict) > self.capacity:
+        while self.tail is not None and self.weight > self.capacity:
+            if self.weigh is not None and self.tail is self.head:
+                break
             olditem = self._dict[self.tail.key]
             del self._dict[self.tail.key]
+            self.weight -= olditem.weight
+            self.evictions += 1
             if self.tail != self.head:
                 self.tail = self.tail.prv
                 self.tail.nxt = None
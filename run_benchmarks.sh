@@ -26,6 +26,26 @@ echo "-- bigtable --"
 "$PYTHON" "$BENCH_DIR/bigtable.py"
 echo
 
+echo "-- expressions --"
+"$PYTHON" "$BENCH_DIR/expressions.py"
+echo
+
 echo "-- xpath --"
 "$PYTHON" "$BENCH_DIR/xpath.py"
 echo
+
+echo "-- matches --"
+"$PYTHON" "$BENCH_DIR/matches.py"
+echo
+
+echo "-- nesting --"
+"$PYTHON" "$BENCH_DIR/nesting.py"
+echo
+
+echo "-- loading --"
+"$PYTHON" "$BENCH_DIR/loading.py"
+echo
+
+echo "-- phases --"
+"$PYTHON" -m genshi.bench --output "$BENCH_DIR/phases.json"
+echo
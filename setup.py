@@ -66,18 +66,25 @@ available.""")
 
 if Feature:
     # Optional C extension module for speeding up Genshi:
-    # Not activated by default on:
-    # - PyPy (where it harms performance)
-    # - CPython >= 3.3 (the new Unicode C API is not supported yet)
+    # Not activated by default on PyPy (where it harms performance)
     speedups = Feature(
         "optional C speed-enhancements",
-        standard = not is_pypy and sys.version_info < (3, 3),
+        standard = not is_pypy,
         ext_modules = [
             Extension('genshi._speedups', ['genshi/_speedups.c']),
         ],
     )
+    ext_modules = []
 else:
+    # Without setuptools features, build the extension unless on PyPy or
+    # disabled with the same option as the feature
     speedups = None
+    ext_modules = []
+    if '--without-speedups' in sys.argv:
+        sys.argv.remove('--without-speedups')
+    elif not is_pypy:
+        ext_modules.append(Extension('genshi._speedups',
+                                     ['genshi/_speedups.c']))
 
 
 # Setuptools need some help figuring out if the egg is "zip_safe" or not
@@ -161,6 +168,7 @@ feature is a template language, which is heavily inspired by Kid.""",
     """,
 
     features = {'speedups': speedups},
+    ext_modules = ext_modules,
     cmdclass = cmdclass,
 
     **extra